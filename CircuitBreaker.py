@@ -0,0 +1,118 @@
+import random
+import time
+import requests
+from constants import ACTION_NEEDED_ERROR_SLEEP_TIME
+from pyicloud.exceptions import (
+    PyiCloudAPIResponseError,
+    PyiCloudFailedLoginException,
+    PyiCloudRateLimitExceeded,
+    PyiCloud2SARequiredError,
+    PyiCloudServiceNotActivatedErrror
+)
+
+ERROR_AUTH = 'auth'
+ERROR_THROTTLE = 'throttle'
+ERROR_TRANSIENT = 'transient'
+ERROR_ACTION_NEEDED = 'action needed'
+ERROR_BUG = 'bug'
+
+# first backoff after an error, doubled for every next failure
+BACKOFF_BASE_IN_S = {
+    ERROR_AUTH: 60,
+    ERROR_THROTTLE: 120,
+    ERROR_TRANSIENT: 15,
+    ERROR_ACTION_NEEDED: ACTION_NEEDED_ERROR_SLEEP_TIME,
+    ERROR_BUG: 300,
+}
+MAX_BACKOFF_IN_S = ACTION_NEEDED_ERROR_SLEEP_TIME
+
+AUTH_ERROR_CODES = (401, 421, 450, 'AUTHENTICATION_FAILED')  # 450: session expired
+THROTTLE_ERROR_CODES = (429, 503, 'ACCESS_DENIED')
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half-open'
+
+
+def classify_error(error):
+    if isinstance(error, (PyiCloud2SARequiredError, PyiCloudServiceNotActivatedErrror)):
+        return ERROR_ACTION_NEEDED
+    if isinstance(error, PyiCloudFailedLoginException):
+        return ERROR_AUTH
+    if isinstance(error, PyiCloudRateLimitExceeded):
+        return ERROR_THROTTLE
+    if isinstance(error, PyiCloudAPIResponseError):
+        if error.code in AUTH_ERROR_CODES:
+            return ERROR_AUTH
+        if error.code in THROTTLE_ERROR_CODES:
+            return ERROR_THROTTLE
+        return ERROR_TRANSIENT
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return ERROR_TRANSIENT
+    return ERROR_BUG
+
+
+class CircuitBreaker(object):
+    '''
+    Stops calling an endpoint (or updating a device) after an error, for a jittered exponential backoff time.
+    When the backoff time has passed, one probe call is allowed (half-open). If the probe succeeds the circuit
+    is closed again, otherwise the next, longer, backoff starts.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.state = STATE_CLOSED
+        self.failure_count = 0
+        self.error_type = None
+        self.retry_timestamp = 0
+
+    def allow(self):
+        if self.state == STATE_CLOSED:
+            return True
+        if self.state == STATE_OPEN and time.time() >= self.retry_timestamp:
+            self.state = STATE_HALF_OPEN
+            return True
+        return False
+
+    def is_closed(self):
+        return self.state == STATE_CLOSED
+
+    def is_open(self):
+        '''
+        Returns whether calls are not allowed yet, without starting a probe like allow() does
+        '''
+        return self.state == STATE_HALF_OPEN or (self.state == STATE_OPEN and time.time() < self.retry_timestamp)
+
+    def get_retry_delay(self):
+        if self.state == STATE_CLOSED:
+            return 0
+        return max(0, self.retry_timestamp - time.time())
+
+    def cancel_probe(self):
+        '''
+        Ends a probe without a result, e.g. when the call failed because of another breaker, so the next allow()
+        probes again
+        '''
+        if self.state == STATE_HALF_OPEN:
+            self.state = STATE_OPEN
+
+    def record_success(self):
+        self.state = STATE_CLOSED
+        self.failure_count = 0
+        self.error_type = None
+
+    def record_failure(self, error_type):
+        self.failure_count += 1
+        self.error_type = error_type
+        backoff = min(BACKOFF_BASE_IN_S[error_type] * 2 ** (self.failure_count - 1), MAX_BACKOFF_IN_S)
+        # equal jitter, so several breakers opened by the same outage do not retry at the same moment
+        backoff = backoff / 2.0 + random.uniform(0, backoff / 2.0)
+        self.state = STATE_OPEN
+        self.retry_timestamp = time.time() + backoff
+        return backoff
+
+    def __str__(self):
+        if self.state == STATE_CLOSED:
+            return "%s: closed" % self.name
+        return "%s: %s after %d %s error(s), retry in %d seconds" \
+               % (self.name, self.state, self.failure_count, self.error_type, self.get_retry_delay())
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import math
+from Location import Location
+
+FILTER_SPEED_IN_M_PER_S = 3  # assumed movement between fixes, used to grow the uncertainty of the estimate
+MIN_FILTER_ACCURACY_IN_M = 1  # accuracy is used as variance, so never allow 0
+
+
+class LocationFilter(object):
+    '''
+    Simple Kalman filter which fuses successive locations of one device, weighted by their accuracy.
+    Several mediocre fixes at the same spot will result in an estimate which is more accurate than
+    each of the individual fixes. When a fix does not overlap the estimate the device is moving, and
+    the filter restarts from that fix, so the filter never lags behind a moving device.
+    '''
+
+    def __init__(self, speed_in_m_per_s=FILTER_SPEED_IN_M_PER_S):
+        self.speed_in_m_per_s = speed_in_m_per_s
+        self.estimate = None
+        self.variance = 0.0
+        self.fused_count = 0
+
+    def reset(self):
+        self.estimate = None
+        self.variance = 0.0
+        self.fused_count = 0
+
+    def _restart(self, location):
+        self.estimate = location
+        self.variance = float(max(location.accuracy, MIN_FILTER_ACCURACY_IN_M)) ** 2
+        self.fused_count = 1
+        return self.estimate
+
+    def process(self, location):
+        '''
+        Fuses the location into the current estimate.
+        :return: a Location with the estimate, the accuracy being the uncertainty of the estimate
+        '''
+        if self.estimate is None:
+            return self._restart(location)
+
+        # iCloud returns the same fix until the device reports a new one, never fuse a fix twice
+        if location.timestamp <= self.estimate.timestamp:
+            return self.estimate
+
+        # uncertainty grows with the time elapsed since the previous fix
+        elapsed_time = location.timestamp - self.estimate.timestamp
+        predicted_variance = self.variance + (elapsed_time * self.speed_in_m_per_s) ** 2
+
+        # when the new fix does not overlap with the estimate, the device has moved
+        if location.distance_to(self.estimate) > math.sqrt(predicted_variance) + location.accuracy:
+            return self._restart(location)
+
+        location_variance = float(max(location.accuracy, MIN_FILTER_ACCURACY_IN_M)) ** 2
+        gain = predicted_variance / (predicted_variance + location_variance)
+        latitude = self.estimate.latitude + gain * (location.latitude - self.estimate.latitude)
+        longitude = self.estimate.longitude + gain * (location.longitude - self.estimate.longitude)
+        self.variance = (1 - gain) * predicted_variance
+        self.fused_count += 1
+
+        self.estimate = Location(latitude, longitude, math.floor(math.sqrt(self.variance)), location.timestamp)
+        return self.estimate
+
+    def __str__(self):
+        if self.estimate is None:
+            return 'No estimate'
+        return "%s, %d fixes" % (self.estimate, self.fused_count)
@@ -0,0 +1,177 @@
+import BaseHTTPServer
+import SocketServer
+import threading
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+METRICS_PATH = '/metrics'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def expose(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Metric(object):
+    '''
+    Base class of the metrics, which are exposed in the Prometheus text format.
+    Values are kept per combination of label values, given as keyword arguments.
+    '''
+    type_name = None
+
+    def __init__(self, name, documentation, label_names=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError("Metric %s requires labels %s, got %s" % (self.name, self.label_names, labels.keys()))
+        return tuple(str(labels[label_name]) for label_name in self.label_names)
+
+    def format_labels(self, key, extra_labels=()):
+        pairs = zip(self.label_names, key) + list(extra_labels)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, escape_label_value(value)) for name, value in pairs)
+
+    def samples(self):
+        '''
+        :return: a list of (name suffix, formatted labels, value)
+        '''
+        with self.lock:
+            return [('', self.format_labels(key), value) for key, value in sorted(self.values.items())]
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.type_name)]
+        for suffix, labels, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, labels, format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, function, **labels):
+        '''
+        Sets a function which is called when the metrics are exposed, to determine the value
+        '''
+        self.set(function, **labels)
+
+    def remove(self, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values.pop(key, None)
+
+    def samples(self):
+        samples = []
+        for suffix, labels, value in super(Gauge, self).samples():
+            if callable(value):
+                value = value()
+            if value is not None:
+                samples.append((suffix, labels, value))
+        return samples
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super(Histogram, self).__init__(name, documentation, label_names, registry)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                for upper_bound, count in zip(self.buckets, counts):
+                    samples.append(('_bucket', self.format_labels(key, [('le', format_value(upper_bound))]), count))
+                samples.append(('_count', self.format_labels(key), counts[-1]))
+                samples.append(('_sum', self.format_labels(key), total))
+        return samples
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] != METRICS_PATH:
+            self.send_error(404)
+            return
+        output = self.registry.expose()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def log_message(self, format, *args):
+        # scrapes are not worth a log line
+        pass
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(port, address='localhost'):
+    '''
+    Serves the metrics on http://address:port/metrics from a background thread
+    '''
+    server = ThreadingHTTPServer((address, port), MetricsRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -1,10 +1,18 @@
 import abc
+import collections
 import datetime
 import math
-import requests
 import time
+from CircuitBreaker import CircuitBreaker
 from constants import ACTION_NEEDED_ERROR_SLEEP_TIME
 from Location import Location
+from LocationFilter import LocationFilter
+from Metrics import Counter, Gauge
+from SendPolicy import SendPolicy
+from Sinks import HttpSink, LocationUpdate
+from Tracing import TRACER
+from pyicloud.ratelimit import PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+from pyicloud.services.findmyiphone import CHANGE_LOCATION
 
 MIN_RETRIEVE_INTERVAL_IN_S = 15
 MAX_RETRIEVE_INTERVAL_IN_S = 3600
@@ -17,28 +25,51 @@ FARAWAY_CLOSEBY_DISTANCE_LIMIT_IN_KM = 15
 SPEED_KM_PER_HOUR_FOR_FARAWAY = 120
 SPEED_KM_PER_HOUR_FOR_CLOSEBY = 90
 
-URL_DISTANCE_PARAM = "__DISTANCE__"
 OUTDATED_LIMIT_IN_S = 60  # if icloud location timestamp is older than this, then retry
 OUTDATED_LIMIT_IN_S_IN_HOME_PERIOD = 600  # if icloud location timestamp is older than this in home period, then retry
 
+UPDATE_URL_SINK_NAME = 'update_url'
+HISTORY_SIZE = 100  # number of stored locations kept in memory
+LOCATION_RETRIES = Counter('icloudlocationfetcher_location_retries_total',
+                           'Location retries by reason', ['device', 'reason'])
+LAST_GOOD_FIX_AGE = Gauge('icloudlocationfetcher_last_good_fix_age_seconds',
+                          'Age of the last recent and accurate location', ['device'])
+LAST_TRIP_RETRIES = Gauge('icloudlocationfetcher_last_trip_retries',
+                          'Location retries during the last trip away from home', ['device'])
+
 
 class MonitorDevice(object):
     __metaclass__ = abc.ABCMeta
     logger = None
     send_to_server = True
+    smooth_locations = True
+    sinks = []
 
     def __init__(self, name, update_url):
         self.name = name
         self.update_url = update_url
-        self.update_url_timestamp = 0
+        self.update_url_sink = HttpSink(UPDATE_URL_SINK_NAME, update_url, devices=[name])
         self.home_period = None
 
         self.apple_device = None
+        self.apple_device_key = None
         self.location_retrieved = None
+        self.location_retrieved_is_new = False
         self.location_stored = None
+        self.history = collections.deque(maxlen=HISTORY_SIZE)
+        self.location_sent = None
+        self.sent_timestamp = 0
+        self.send_policy = SendPolicy()
         self.next_retrieve_timestamp = time.time()
         self.retrieve_retry_count = 0
         self.same_location_count = 0
+        self.location_filter = LocationFilter()
+        self.trip_retry_count = 0
+        self.last_trip_retry_count = None
+        self.circuit_breaker = CircuitBreaker(name)
+        self.last_good_fix_timestamp = None
+        LAST_GOOD_FIX_AGE.set_function(self.get_last_good_fix_age, device=name)
+        LAST_TRIP_RETRIES.set_function(self.get_last_trip_retry_count, device=name)
 
     @classmethod
     def set_logger(cls, value):
@@ -48,21 +79,114 @@ class MonitorDevice(object):
     def set_send_to_server(cls, value):
         cls.send_to_server = value
 
+    @classmethod
+    def set_smooth_locations(cls, value):
+        cls.smooth_locations = value
+
+    @classmethod
+    def set_sinks(cls, value):
+        '''
+        Sets the sinks of the configuration file, which receive the updates of the devices they accept,
+        in addition to the update url of each device
+        '''
+        cls.sinks = value
+
+    def start(self):
+        '''
+        Starts the sink of the update url
+        '''
+        self.update_url_sink.start()
+
     def get_apple_device(self):
         return self.apple_device
 
     def set_apple_device(self, value):
         self.apple_device = value
+        if value is not None:
+            self.apple_device_key = value.stable_key
+
+    def get_apple_device_key(self):
+        return self.apple_device_key
 
     def set_home_period(self, value):
         self.home_period = value
 
+    def set_update_url(self, value):
+        self.update_url = value
+        self.update_url_sink.url = value
+
+    def set_send_policy(self, value):
+        self.send_policy = value
+
+    def resend_stored_distance(self):
+        '''
+        Sends the last sent location to the update url only, as the other sinks already have it
+        '''
+        if self.location_sent is not None:
+            self.send_update(self.location_sent.rounded_distance_km, self.location_sent, [self.update_url_sink])
+
+    def home_position_changed(self):
+        '''
+        Recalculates the distance of the stored location to the new home position, and sends it when it differs from
+        the distance sent before
+        :return: True if the distance has been sent
+        '''
+        self.location_filter.reset()
+        if self.location_stored is None:
+            return False
+        old_location = self.location_stored
+        self.location_stored = Location(old_location.latitude, old_location.longitude, old_location.accuracy,
+                                        old_location.timestamp)
+        if self.location_sent is None or \
+                self.location_sent.rounded_distance_km == self.location_stored.rounded_distance_km:
+            return False
+        self.send_location(self.location_stored)
+        return True
+
+    def unregister(self):
+        self.update_url_sink.stop()
+        if self.update_url_sink.uses_outbox():
+            self.update_url_sink.outbox.remove(UPDATE_URL_SINK_NAME, self.name)
+        LAST_GOOD_FIX_AGE.remove(device=self.name)
+        LAST_TRIP_RETRIES.remove(device=self.name)
+
     def get_next_retrieve_timestamp(self):
         return self.next_retrieve_timestamp
 
+    def get_trip_retry_count(self):
+        return self.trip_retry_count
+
+    def get_last_trip_retry_count(self):
+        return self.last_trip_retry_count
+
+    def get_last_good_fix_age(self):
+        if self.last_good_fix_timestamp is None:
+            return None
+        return time.time() - self.last_good_fix_timestamp
+
     def should_update(self):
         return self.next_retrieve_timestamp < time.time()
 
+    def postpone(self, seconds):
+        self.next_retrieve_timestamp = time.time() + max(MIN_RETRIEVE_INTERVAL_IN_S, seconds)
+
+    def get_priority(self):
+        '''
+        Priority used when the iCloud requests are rate limited:
+        - high: no location yet, or moving close to home
+        - low: at home and not moving
+        - normal: otherwise
+        '''
+        if self.location_stored is None:
+            return PRIORITY_HIGH
+        if self.location_stored.is_home():
+            if self.is_moving():
+                return PRIORITY_NORMAL
+            return PRIORITY_LOW
+        if self.is_moving() and self.location_stored.rounded_distance_km <= FARAWAY_CLOSEBY_DISTANCE_LIMIT_IN_KM:
+            return PRIORITY_HIGH
+        return PRIORITY_NORMAL
+
     def is_moving(self):
         return self.same_location_count == 0
 
@@ -79,16 +203,29 @@ class MonitorDevice(object):
         return False
 
     def update_location_retrieved(self):
-        apple_location = self.apple_device.location()
+        with TRACER.span('refresh_client'):
+            # only locate this device, the other devices are located when they are due
+            apple_location = self.apple_device.location(targeted=True)
+        changes = self.apple_device.pop_changes()
         if apple_location is not None:
+            # iCloud often returns the same location again, which does not need to be processed again
+            if self.location_retrieved is not None and CHANGE_LOCATION not in changes:
+                self.logger.debug("Location of '%s' did not change" % self.name)
+                self.location_retrieved_is_new = False
+                return True
+            self.location_retrieved_is_new = True
             self.logger.debug(apple_location)
             self.logger.debug("location: type=%s, finished=%s, horizontalAccuracy=%f" %
                               (apple_location['positionType'], apple_location['locationFinished'],
                                apple_location['horizontalAccuracy']))
             location_timestamp = apple_location['timeStamp'] / 1000
             accuracy = math.floor(apple_location['horizontalAccuracy'])
-            self.location_retrieved = Location(apple_location['latitude'], apple_location['longitude'], accuracy,
-                                               location_timestamp)
+            location = Location(apple_location['latitude'], apple_location['longitude'], accuracy, location_timestamp)
+            if self.smooth_locations:
+                self.location_retrieved = self.location_filter.process(location)
+                self.logger.debug("Filtered location of '%s': %s" % (self.name, self.location_filter))
+            else:
+                self.location_retrieved = location
             return True
         else:
             self.logger.warn("Unable to get the location for device %s. Next retry in %d seconds" %
@@ -108,25 +245,68 @@ class MonitorDevice(object):
         else:
             return minutes_since_midnight > self.home_period[0] or minutes_since_midnight < self.home_period[1]
 
-    def send_to_update_url(self, old_distance_km, new_distance_km):
-        url = self.update_url.replace(URL_DISTANCE_PARAM, str(new_distance_km))
-        if self.send_to_server:
-            self.logger.debug("About to update '%s' with '%s'" % (self.name, url))
-            try:
-                response = requests.get(url)
-                self.update_url_timestamp = time.time()
-                self.logger.debug("%s -> %s" % (url, response))
-                if response.ok:
-                    self.logger.info("Successfully updated distance of '%s' from %.1f to %.1f km" %
-                                     (self.name, old_distance_km, new_distance_km))
-                else:
-                    self.logger.warn("Unable to update distance of '%s' using '%s'. Response: %s" %
-                                     (self.name, url, response))
-            except requests.ConnectionError, e:
-                self.logger.error('Request failed %s - %s' % (url, e))
-        else:
-            self.update_url_timestamp = time.time()
-            self.logger.info("Skipping sending update for '%s' to '%s'" % (self.name, url))
+    def get_history(self):
+        '''
+        :return: the recently stored locations, oldest first
+        '''
+        return list(self.history)
+
+    def get_sinks(self, every_fix=False):
+        sinks = [x for x in self.sinks if x.accepts(self.name) and x.every_fix == every_fix]
+        if not every_fix:
+            sinks.insert(0, self.update_url_sink)
+        return sinks
+
+    def send_fix(self, old_location):
+        '''
+        Hands the newly stored location to the sinks which receive every fix. These are not subject to the send
+        policy or send_to_server, as they are local outputs to follow the devices.
+        '''
+        sinks = self.get_sinks(every_fix=True)
+        if not sinks:
+            return
+        old_distance_km = -1.0
+        if old_location is not None:
+            old_distance_km = old_location.rounded_distance_km
+        update = LocationUpdate.for_location(self.name, self.location_stored, old_distance_km)
+        for sink in sinks:
+            sink.submit(update)
+
+    def update_sinks(self):
+        '''
+        Sends the stored location to the sinks, if the send policy allows it
+        '''
+        if self.location_stored is None:
+            return
+        (send, reason) = self.send_policy.should_send(self.location_sent, self.location_stored, self.sent_timestamp,
+                                                      self.is_moving())
+        if send:
+            self.logger.debug("Sending distance of '%s': %s" % (self.name, reason))
+            self.send_location(self.location_stored)
+        elif self.location_sent.rounded_distance_km != self.location_stored.rounded_distance_km:
+            self.logger.info("Not sending distance %.1f km of '%s' yet: %s"
+                             % (self.location_stored.rounded_distance_km, self.name, reason))
+
+    def send_location(self, location):
+        old_distance_km = -1.0
+        if self.location_sent is not None:
+            old_distance_km = self.location_sent.rounded_distance_km
+        self.send_update(old_distance_km, location)
+        self.location_sent = location
+        self.sent_timestamp = time.time()
+
+    def send_update(self, old_distance_km, location, sinks=None):
+        '''
+        Hands the location to the sinks, which send it from their own threads, so this does not wait for them
+        '''
+        if sinks is None:
+            sinks = self.get_sinks()
+        if not self.send_to_server:
+            self.logger.info("Skipping sending update for '%s' to %s" % (self.name, ', '.join(x.name for x in sinks)))
+            return
+        update = LocationUpdate.for_location(self.name, location, old_distance_km)
+        for sink in sinks:
+            sink.submit(update)
 
     def is_retrieved_location_better_and_message(self):
         '''
@@ -168,11 +348,16 @@ class MonitorDevice(object):
 
         if not self.location_retrieved.is_recent_enough(recent_limit):
             self.retrieve_retry_count += 1
+            self.trip_retry_count += 1
+            LOCATION_RETRIES.inc(device=self.name, reason='not_recent')
             return 'Location is not recent enough'
         if not self.location_retrieved.is_accurate_enough():
             self.retrieve_retry_count += 1
+            self.trip_retry_count += 1
+            LOCATION_RETRIES.inc(device=self.name, reason='not_accurate')
             return 'Location is not accurate enough'
         self.retrieve_retry_count = 0
+        self.last_good_fix_timestamp = self.location_retrieved.timestamp
         return 'Location is acceptable'
 
     def update_next_retrieve_timestamp(self):
@@ -208,6 +393,14 @@ class MonitorDevice(object):
             seconds_to_wait = int(2 * seconds_to_wait / 3)
         self.next_retrieve_timestamp = time.time() + max(MIN_RETRIEVE_INTERVAL_IN_S, seconds_to_wait)
 
+    def update_trip_retry_count(self):
+        if self.location_stored is None or self.location_stored.is_home() == self.location_retrieved.is_home():
+            return
+        if self.location_retrieved.is_home():
+            self.last_trip_retry_count = self.trip_retry_count
+            self.logger.info("Device %s: trip finished with %d retries" % (self.name, self.trip_retry_count))
+        self.trip_retry_count = 0
+
     def log_update_message(self, status_message, location_message):
         now = time.time()
         next_update = self.next_retrieve_timestamp - now
@@ -226,18 +419,29 @@ class MonitorDevice(object):
     def retrieve_location_and_update(self):
         if self.is_apple_device_ok():
             if self.update_location_retrieved():
+                if not self.location_retrieved_is_new:
+                    # same location as before, so only the next retrieve needs to be scheduled
+                    self.same_location_count += 1
+                    location_message = self.update_retrieve_retry_count()
+                    self.update_next_retrieve_timestamp()
+                    self.log_update_message('No new location', location_message)
+                    # a distance which was held back while moving might be sent now
+                    with TRACER.span('sink'):
+                        self.update_sinks()
+                    return
                 (location_is_better, status_message) = self.is_retrieved_location_better_and_message()
-                if location_is_better:
-                    old_distance_km = -1.0
-                    if self.location_stored is not None:
-                        old_distance_km = self.location_stored.rounded_distance_km
-                    if old_distance_km != self.location_retrieved.rounded_distance_km:
-                        self.send_to_update_url(old_distance_km, self.location_retrieved.rounded_distance_km)
                 location_message = self.update_retrieve_retry_count()
                 self.update_next_retrieve_timestamp()
                 self.log_update_message(status_message, location_message)
                 if location_is_better:
+                    self.update_trip_retry_count()
+                    old_location = self.location_stored
                     self.location_stored = self.location_retrieved
+                    self.history.append(self.location_stored)
+                    # the sinks send from their own threads, so this is the hand-off to them
+                    with TRACER.span('sink'):
+                        self.send_fix(old_location)
+                        self.update_sinks()
             else:
                 self.retrieve_retry_count = 0
                 self.next_retrieve_timestamp = time.time() + ACTION_NEEDED_ERROR_SLEEP_TIME
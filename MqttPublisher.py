@@ -0,0 +1,249 @@
+import collections
+import logging
+import re
+import select
+import socket
+import struct
+import threading
+import time
+from Metrics import Counter, Gauge
+
+CONNECT_TIMEOUT_IN_S = 10
+POLL_INTERVAL_IN_S = 1
+MIN_RECONNECT_DELAY_IN_S = 1
+MAX_RECONNECT_DELAY_IN_S = 300
+
+# MQTT 3.1.1 control packet types
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+MQTT_MESSAGES = Counter('icloudlocationfetcher_mqtt_messages_total', 'MQTT messages by outcome', ['outcome'])
+MQTT_CONNECTED = Gauge('icloudlocationfetcher_mqtt_connected', 'Whether the MQTT broker is connected')
+
+logger = logging.getLogger('locations2domoticz.mqtt')
+
+
+def encode_string(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return struct.pack('!H', len(value)) + value
+
+
+def encode_packet(packet_type, flags, body):
+    remaining_length = len(body)
+    length_bytes = ''
+    while True:
+        digit = remaining_length % 128
+        remaining_length //= 128
+        if remaining_length > 0:
+            digit |= 0x80
+        length_bytes += chr(digit)
+        if remaining_length == 0:
+            break
+    return chr((packet_type << 4) | flags) + length_bytes + body
+
+
+def topic_name(value):
+    return re.sub(r'[^a-z0-9]+', '_', value.lower()).strip('_')
+
+
+class MqttPublisher(object):
+    '''
+    Publishes retained messages to an MQTT (3.1.1) broker over one persistent connection, which is kept by a
+    background thread and reconnected with a backoff after a failure. While disconnected, messages are buffered.
+    As a message is the latest state of its topic, only the latest message per topic is kept. Messages with QoS 1
+    are resent after reconnecting until the broker acknowledges them, unless superseded by a newer message.
+    '''
+
+    def __init__(self, host, port=1883, topic_prefix='icloudlocationfetcher', qos=1, client_id=None,
+                 username=None, password=None, keepalive=60):
+        self.host = host
+        self.port = port
+        self.topic_prefix = topic_prefix
+        self.qos = min(qos, 1)  # QoS 2 is not supported
+        self.client_id = client_id or 'icloudlocationfetcher-%s' % socket.gethostname()
+        self.username = username
+        self.password = password
+        self.keepalive = keepalive
+
+        self.condition = threading.Condition()
+        self.pending = collections.OrderedDict()  # topic: payload
+        self.in_flight = {}  # packet id: (topic, payload)
+        self.next_packet_id = 1
+        self.connection = None
+        self.last_sent_timestamp = 0
+        self.last_received_timestamp = 0
+        self.stopping = False
+        # set when stopping, to end the reconnect backoff, which publishing does not
+        self.stopped = threading.Event()
+        self.thread = None
+        MQTT_CONNECTED.set_function(lambda: 0 if self.connection is None else 1)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='mqtt-publisher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=5):
+        '''
+        Stops the publisher, after trying to send the buffered messages for at most timeout seconds
+        '''
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def device_topic(self, device_name, key):
+        return '%s/%s/%s' % (self.topic_prefix, topic_name(device_name), key)
+
+    def publish_device_state(self, device_name, values):
+        for key, value in values.items():
+            self.publish(self.device_topic(device_name, key), str(value))
+
+    def publish(self, topic, payload):
+        with self.condition:
+            self.pending.pop(topic, None)
+            self.pending[topic] = payload
+            self.condition.notify()
+
+    def run(self):
+        reconnect_delay = MIN_RECONNECT_DELAY_IN_S
+        while not self.stopping:
+            try:
+                self.connect()
+                reconnect_delay = MIN_RECONNECT_DELAY_IN_S
+                self.serve()
+            except (socket.error, IOError, ValueError), e:
+                logger.warn("MQTT connection to %s:%d failed: %s. Reconnecting in %d seconds"
+                            % (self.host, self.port, e, reconnect_delay))
+                self.close()
+                self.stopped.wait(reconnect_delay)
+                reconnect_delay = min(2 * reconnect_delay, MAX_RECONNECT_DELAY_IN_S)
+        self.close()
+
+    def connect(self):
+        connection = socket.create_connection((self.host, self.port), CONNECT_TIMEOUT_IN_S)
+        flags = 0x02  # clean session
+        payload = encode_string(self.client_id)
+        if self.username is not None:
+            flags |= 0x80
+            payload += encode_string(self.username)
+            if self.password is not None:
+                flags |= 0x40
+                payload += encode_string(self.password)
+        body = encode_string('MQTT') + struct.pack('!BBH', 4, flags, self.keepalive) + payload
+        connection.sendall(encode_packet(CONNECT, 0, body))
+        self.connection = connection
+        packet_type, body = self.read_packet()
+        if packet_type != CONNACK or len(body) != 2:
+            raise ValueError("unexpected response to connect")
+        if ord(body[1]) != 0:
+            raise ValueError("connection refused with return code %d" % ord(body[1]))
+        # a broker which stalls for longer than the keepalive interval is treated as a broken connection
+        connection.settimeout(self.keepalive)
+        self.last_sent_timestamp = time.time()
+        logger.info("Connected to MQTT broker %s:%d" % (self.host, self.port))
+
+        # messages which were not acknowledged by the previous connection are sent again
+        with self.condition:
+            for packet_id, (topic, payload) in sorted(self.in_flight.items()):
+                if topic not in self.pending:
+                    self.pending[topic] = payload
+            self.in_flight = {}
+
+    def serve(self):
+        while True:
+            with self.condition:
+                if not self.pending and not self.stopping:
+                    self.condition.wait(POLL_INTERVAL_IN_S)
+                messages = self.pending.items()
+                self.pending.clear()
+                stopping = self.stopping
+            for i, (topic, payload) in enumerate(messages):
+                try:
+                    self.send_publish(topic, payload)
+                except socket.error:
+                    # keep the unsent messages for the next connection
+                    with self.condition:
+                        for unsent_topic, unsent_payload in messages[i:]:
+                            if unsent_topic not in self.pending:
+                                self.pending[unsent_topic] = unsent_payload
+                    raise
+            if stopping:
+                self.wait_for_acknowledgements()
+                self.connection.sendall(encode_packet(DISCONNECT, 0, ''))
+                return
+            while select.select([self.connection], [], [], 0)[0]:
+                self.handle_packet(*self.read_packet())
+            if time.time() - self.last_received_timestamp > 1.5 * self.keepalive:
+                raise IOError("no response from the broker")
+            if time.time() - self.last_sent_timestamp > self.keepalive / 2.0:
+                self.connection.sendall(encode_packet(PINGREQ, 0, ''))
+                self.last_sent_timestamp = time.time()
+
+    def send_publish(self, topic, payload):
+        flags = 0x01  # retain
+        body = encode_string(topic)
+        if self.qos > 0:
+            flags |= self.qos << 1
+            packet_id = self.next_packet_id
+            self.next_packet_id = self.next_packet_id % 65535 + 1
+            body += struct.pack('!H', packet_id)
+            with self.condition:
+                self.in_flight[packet_id] = (topic, payload)
+        self.connection.sendall(encode_packet(PUBLISH, flags, body + payload))
+        self.last_sent_timestamp = time.time()
+        MQTT_MESSAGES.inc(outcome='sent')
+
+    def wait_for_acknowledgements(self):
+        deadline = time.time() + CONNECT_TIMEOUT_IN_S
+        while self.in_flight and time.time() < deadline:
+            if select.select([self.connection], [], [], max(0, deadline - time.time()))[0]:
+                self.handle_packet(*self.read_packet())
+
+    def handle_packet(self, packet_type, body):
+        if packet_type == PUBACK:
+            packet_id = struct.unpack('!H', body[:2])[0]
+            with self.condition:
+                if self.in_flight.pop(packet_id, None) is not None:
+                    MQTT_MESSAGES.inc(outcome='acknowledged')
+        elif packet_type != PINGRESP:
+            logger.debug("Ignoring MQTT packet of type %d" % packet_type)
+
+    def read_packet(self):
+        header = self.read_bytes(1)
+        remaining_length = 0
+        multiplier = 1
+        while True:
+            digit = ord(self.read_bytes(1))
+            remaining_length += (digit & 0x7f) * multiplier
+            if not digit & 0x80:
+                break
+            multiplier *= 128
+        body = self.read_bytes(remaining_length)
+        self.last_received_timestamp = time.time()
+        return ord(header) >> 4, body
+
+    def read_bytes(self, length):
+        data = ''
+        while len(data) < length:
+            chunk = self.connection.recv(length - len(data))
+            if not chunk:
+                raise IOError("connection closed by the broker")
+            data += chunk
+        return data
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except socket.error:
+                pass
+            self.connection = None
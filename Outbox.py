@@ -0,0 +1,68 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger('locations2domoticz.outbox')
+
+
+class Outbox(object):
+    '''
+    Keeps the updates which have not been delivered to a sink yet in a file, so they are sent after a restart as well.
+    Only the latest update per sink and device is kept, as it supersedes the older ones.
+    The file is replaced atomically, so a crash leaves either the old or the new contents.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.updates = {}  # sink name: {device: update as dict}
+        try:
+            with open(path) as source:
+                self.updates = json.load(source)
+        except IOError:
+            pass
+        except ValueError, e:
+            logger.error("Ignoring the unreadable outbox '%s': %s" % (path, e))
+
+    def get(self, sink_name):
+        '''
+        :return: the undelivered updates of the sink, as {device: update as dict}
+        '''
+        with self.lock:
+            return dict(self.updates.get(sink_name, {}))
+
+    def put(self, sink_name, device, update):
+        with self.lock:
+            self.updates.setdefault(sink_name, {})[device] = update
+            self.save()
+
+    def remove(self, sink_name, device, update=None):
+        '''
+        Removes the update of the device, but only if it is the given update, so a newer update is kept
+        '''
+        with self.lock:
+            updates = self.updates.get(sink_name, {})
+            if device not in updates or (update is not None and updates[device] != update):
+                return
+            del updates[device]
+            if not updates:
+                del self.updates[sink_name]
+            self.save()
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle, temporary_path = tempfile.mkstemp(dir=directory, prefix='.outbox')
+        try:
+            with os.fdopen(handle, 'w') as output:
+                json.dump(self.updates, output)
+                output.flush()
+                os.fsync(output.fileno())
+            os.rename(temporary_path, self.path)
+        except (IOError, OSError), e:
+            logger.error("Unable to save the outbox '%s': %s" % (self.path, e))
+            try:
+                os.remove(temporary_path)
+            except OSError:
+                pass
@@ -0,0 +1,52 @@
+import time
+
+DEFAULT_MIN_DISTANCE_CHANGE_KM = 0.0
+DEFAULT_MIN_DISTANCE_CHANGE_PERCENTAGE = 0.0
+DEFAULT_MIN_INTERVAL_IN_S = 0
+
+
+class SendPolicy(object):
+    '''
+    Decides whether a new distance of a device is sent to the sinks, compared to the last distance sent.
+    A change is sent when it is larger than both min_distance_change_km and min_distance_change_percentage of the
+    last distance, so close to home small changes are sent, and far away only larger ones. Changes are not sent
+    more often than once per min_interval seconds.
+    Urgent changes, the first distance and arriving at or leaving home, are always sent immediately. When the device
+    has stopped moving, its final distance is sent even when the change is small.
+    '''
+
+    def __init__(self, min_distance_change_km=DEFAULT_MIN_DISTANCE_CHANGE_KM,
+                 min_distance_change_percentage=DEFAULT_MIN_DISTANCE_CHANGE_PERCENTAGE,
+                 min_interval=DEFAULT_MIN_INTERVAL_IN_S):
+        self.min_distance_change_km = min_distance_change_km
+        self.min_distance_change_percentage = min_distance_change_percentage
+        self.min_interval = min_interval
+
+    def __eq__(self, other):
+        return isinstance(other, SendPolicy) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def should_send(self, sent_location, location, sent_timestamp, moving):
+        '''
+        :return: a boolean, with the reason
+        '''
+        if sent_location is None:
+            return True, "first distance"
+        if sent_location.rounded_distance_km == location.rounded_distance_km:
+            return False, "same distance"
+        if sent_location.is_home() != location.is_home():
+            return True, "arrived home" if location.is_home() else "left home"
+
+        seconds_since_sent = time.time() - sent_timestamp
+        if seconds_since_sent < self.min_interval:
+            return False, "sent %d seconds ago" % seconds_since_sent
+        if not moving:
+            return True, "stopped moving"
+        change_km = round(abs(location.rounded_distance_km - sent_location.rounded_distance_km), 1)
+        min_change_km = max(self.min_distance_change_km,
+                            sent_location.rounded_distance_km * self.min_distance_change_percentage / 100)
+        if change_km <= min_change_km:
+            return False, "changed %.1f km, which is within %.1f km" % (change_km, min_change_km)
+        return True, "changed %.1f km" % change_km
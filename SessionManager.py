@@ -0,0 +1,102 @@
+import logging
+import threading
+
+logger = logging.getLogger('locations2domoticz.session')
+
+
+class SessionManager(object):
+    '''
+    Keeps the iCloud session, and replaces it (rotates it) without blocking the polling. The new session is
+    logged in by a background thread, while the current session is still used, and swapped in by the main loop
+    with swap() as soon as it is ready. So the session is only changed between cycles, and only by the main loop.
+    Only the first login, when there is no session to poll with yet, is done by the main loop itself.
+    '''
+
+    def __init__(self, login):
+        '''
+        :param login: function which logs in and returns a new session, ready to be used
+        '''
+        self.login = login
+        self.session = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.worker = None
+        self.rotated_session = None
+        self.rotation_error = None
+        self.rotation_finished = False
+
+    def get_session(self):
+        return self.session
+
+    def login_now(self):
+        '''
+        Logs in on the calling thread, and uses the new session right away. Exceptions of the login are raised.
+        '''
+        self.set_session(self.login())
+        return self.session
+
+    def set_session(self, session):
+        if self.session is not None and self.session is not session:
+            self.session.session.close()
+        self.session = session
+
+    def discard(self, reason):
+        '''
+        Stops using the session, e.g. when it has expired, so it is not polled with anymore
+        '''
+        if self.session is not None:
+            logger.info("Discarding the iCloud session: %s" % reason)
+            self.set_session(None)
+
+    def is_rotating(self):
+        return self.worker is not None
+
+    def rotate(self, reason, delay=0):
+        '''
+        Starts logging in a new session in the background, after delay seconds.
+        :return: False if a rotation is already busy
+        '''
+        if self.worker is not None:
+            return False
+        logger.info("Rotating the iCloud session in %d seconds: %s" % (delay, reason))
+        self.worker = threading.Thread(target=self.run_rotation, args=(delay,), name='session-rotation')
+        self.worker.daemon = True
+        self.worker.start()
+        return True
+
+    def run_rotation(self, delay):
+        if delay > 0 and self.stopping.wait(delay):
+            return
+        session = None
+        error = None
+        try:
+            session = self.login()
+        except Exception as e:
+            error = e
+        with self.lock:
+            self.rotated_session = session
+            self.rotation_error = error
+            self.rotation_finished = True
+
+    def swap(self):
+        '''
+        Replaces the session by the rotated session, if it finished logging in.
+        :return: (swapped, error), error being the exception of a failed rotation
+        '''
+        with self.lock:
+            if not self.rotation_finished:
+                return False, None
+            session, error = self.rotated_session, self.rotation_error
+            self.rotated_session = None
+            self.rotation_error = None
+            self.rotation_finished = False
+        self.worker.join()
+        self.worker = None
+        if session is None:
+            return False, error
+        self.set_session(session)
+        logger.info("Swapped in the rotated iCloud session")
+        return True, None
+
+    def stop(self):
+        self.stopping.set()
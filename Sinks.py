@@ -0,0 +1,401 @@
+import abc
+import collections
+import errno
+import json
+import logging
+import sqlite3
+import threading
+import time
+import urllib
+import sys
+import requests
+from Metrics import Counter, Histogram
+
+DEFAULT_TIMEOUT_IN_S = 10
+DEFAULT_QUEUE_SIZE = 1000
+STOP_TIMEOUT_IN_S = 5
+MIN_RETRY_DELAY_IN_S = 5
+MAX_RETRY_DELAY_IN_S = 300
+MAX_REJECTIONS = 3  # an update which the output rejects this many times is dropped, as resending will not help
+
+# only the latest update per device is kept while the sink is busy
+BACKPRESSURE_COALESCE = 'coalesce'
+# all updates are kept, up to queue_size, after which the oldest are dropped
+BACKPRESSURE_QUEUE = 'queue'
+BACKPRESSURE_POLICIES = (BACKPRESSURE_COALESCE, BACKPRESSURE_QUEUE)
+
+ZONE_HOME = 'home'
+ZONE_NOT_HOME = 'not_home'
+
+URL_DISTANCE_PARAM = "__DISTANCE__"
+TEMPLATE_PARAMS = {
+    URL_DISTANCE_PARAM: 'distance_km',
+    '__OLD_DISTANCE__': 'old_distance_km',
+    '__LATITUDE__': 'latitude',
+    '__LONGITUDE__': 'longitude',
+    '__ACCURACY__': 'accuracy',
+    '__TIMESTAMP__': 'timestamp',
+    '__ZONE__': 'zone',
+    '__DEVICE__': 'device',
+}
+
+SINK_UPDATES = Counter('icloudlocationfetcher_sink_updates_total', 'Updates to the sinks by outcome',
+                       ['sink', 'device', 'outcome'])
+SINK_DURATION = Histogram('icloudlocationfetcher_sink_duration_seconds', 'Duration of sending an update to a sink',
+                          ['sink'])
+
+logger = logging.getLogger('locations2domoticz.sinks')
+
+
+class LocationUpdate(object):
+    '''
+    The state of a device which is sent to the sinks
+    '''
+
+    def __init__(self, device, latitude, longitude, accuracy, timestamp, distance_km, old_distance_km, zone):
+        self.device = device
+        self.latitude = latitude
+        self.longitude = longitude
+        self.accuracy = accuracy
+        self.timestamp = timestamp
+        self.distance_km = distance_km
+        self.old_distance_km = old_distance_km
+        self.zone = zone
+
+    @classmethod
+    def for_location(cls, device, location, old_distance_km):
+        return cls(device, location.latitude, location.longitude, int(location.accuracy), int(location.timestamp),
+                   location.rounded_distance_km, old_distance_km, ZONE_HOME if location.is_home() else ZONE_NOT_HOME)
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**values)
+
+    def as_dict(self):
+        return dict((key, getattr(self, key)) for key in TEMPLATE_PARAMS.values())
+
+
+class Sink(object):
+    '''
+    Sends the updates of the devices to one output. Each sink has its own worker thread, so a slow or unreachable
+    output delays neither the other sinks nor the polling of iCloud. The updates which arrive while the worker is
+    busy are kept according to the backpressure policy.
+
+    When sending fails, the sink is retried with a backoff, and with the queue policy the update is sent again before
+    the updates which arrived later, if there is room for it. With the coalesce policy the undelivered updates are
+    kept in the outbox as well, so they survive a restart, and only the latest update per device is sent when
+    the output is back.
+    '''
+    __metaclass__ = abc.ABCMeta
+    outbox = None
+
+    def __init__(self, name, devices=None, timeout=DEFAULT_TIMEOUT_IN_S, backpressure=BACKPRESSURE_COALESCE,
+                 queue_size=DEFAULT_QUEUE_SIZE, every_fix=False):
+        if backpressure not in BACKPRESSURE_POLICIES:
+            raise ValueError("Unknown backpressure policy '%s', use one of %s" % (backpressure, BACKPRESSURE_POLICIES))
+        self.name = name
+        self.devices = devices  # None: all devices
+        self.timeout = timeout
+        self.backpressure = backpressure
+        self.queue_size = queue_size
+        # receive every accepted location, instead of only the distances allowed by the send policy
+        self.every_fix = every_fix
+
+        self.condition = threading.Condition()
+        self.pending = collections.OrderedDict() if backpressure == BACKPRESSURE_COALESCE else collections.deque()
+        self.stopping = False
+        self.thread = None
+        self.retry_delay = 0
+        self.retry_timestamp = 0
+        self.rejections = {}  # device: number of times its update was rejected
+
+    @classmethod
+    def set_outbox(cls, value):
+        cls.outbox = value
+
+    def accepts(self, device):
+        return self.devices is None or device in self.devices
+
+    def uses_outbox(self):
+        return self.outbox is not None and self.backpressure == BACKPRESSURE_COALESCE
+
+    def start(self):
+        if self.uses_outbox():
+            for device, values in self.outbox.get(self.name).items():
+                if self.accepts(device):
+                    logger.info("Sending the undelivered update of '%s' to sink '%s'" % (device, self.name))
+                    self.pending[device] = LocationUpdate.from_dict(values)
+        self.thread = threading.Thread(target=self.run, name='sink-%s' % self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=STOP_TIMEOUT_IN_S):
+        '''
+        Stops the worker, after trying to send the pending updates for at most timeout seconds
+        '''
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def submit(self, update):
+        '''
+        Queues the update for the worker, without waiting for it to be sent
+        '''
+        with self.condition:
+            if self.backpressure == BACKPRESSURE_COALESCE:
+                if self.pending.pop(update.device, None) is not None:
+                    SINK_UPDATES.inc(sink=self.name, device=update.device, outcome='superseded')
+                self.pending[update.device] = update
+            else:
+                if len(self.pending) >= self.queue_size:
+                    dropped = self.pending.popleft()
+                    SINK_UPDATES.inc(sink=self.name, device=dropped.device, outcome='dropped')
+                    logger.warn("Sink '%s' is not keeping up, dropped an update of '%s'" % (self.name, dropped.device))
+                self.pending.append(update)
+            self.condition.notify()
+
+    def next_update(self):
+        with self.condition:
+            while not self.stopping and (not self.pending or time.time() < self.retry_timestamp):
+                self.condition.wait(max(0, self.retry_timestamp - time.time()) if self.pending else None)
+            if not self.pending or time.time() < self.retry_timestamp:
+                return None
+            if self.backpressure == BACKPRESSURE_COALESCE:
+                return self.pending.popitem(last=False)[1]
+            return self.pending.popleft()
+
+    def run(self):
+        while True:
+            update = self.next_update()
+            if update is None:
+                break
+            start_time = time.time()
+            try:
+                outcome = 'ok' if self.send(update) else 'rejected'
+            except Exception, e:
+                outcome = 'failed'
+                logger.error("Sink '%s' failed to send the update of '%s': %s" % (self.name, update.device, e))
+            SINK_DURATION.observe(time.time() - start_time, sink=self.name)
+            SINK_UPDATES.inc(sink=self.name, device=update.device, outcome=outcome)
+            if outcome == 'ok':
+                self.delivered(update)
+            else:
+                self.failed(update, rejected=outcome == 'rejected')
+        if self.uses_outbox():
+            # the updates which could not be sent before stopping are sent after a restart
+            with self.condition:
+                pending = self.pending.values()
+            for update in pending:
+                self.outbox.put(self.name, update.device, update.as_dict())
+        self.close()
+
+    def delivered(self, update):
+        if self.retry_delay > 0:
+            logger.info("Sink '%s' accepts updates again" % self.name)
+            self.retry_delay = 0
+        self.rejections.pop(update.device, None)
+        if self.uses_outbox():
+            # a newer update of the device which is still pending is written to the outbox when it fails
+            self.outbox.remove(self.name, update.device)
+
+    def failed(self, update, rejected=False):
+        '''
+        Retries the sink after a backoff. Only the undelivered updates are written to the outbox, by the worker, so
+        submitting an update does not wait for the file.
+        '''
+        self.retry_delay = min(max(2 * self.retry_delay, MIN_RETRY_DELAY_IN_S), MAX_RETRY_DELAY_IN_S)
+        rejections = self.rejections.get(update.device, 0) + 1 if rejected else 0
+        kept = None
+        dropped = None  # why the update is not sent again
+        with self.condition:
+            self.retry_timestamp = time.time() + self.retry_delay
+            if self.backpressure == BACKPRESSURE_COALESCE and update.device in self.pending:
+                # the newer update of the device which has arrived meanwhile is sent instead
+                self.rejections.pop(update.device, None)
+                kept = self.pending[update.device]
+            elif rejections >= MAX_REJECTIONS:
+                self.rejections.pop(update.device, None)
+                dropped = "rejected the update of '%s' %d times" % (update.device, rejections)
+            elif self.backpressure == BACKPRESSURE_QUEUE and len(self.pending) >= self.queue_size:
+                dropped = "is not keeping up, and has no room to retry the update of '%s'" % update.device
+            else:
+                self.rejections[update.device] = rejections
+                if self.backpressure == BACKPRESSURE_COALESCE:
+                    self.pending[update.device] = update
+                else:
+                    # sent again first, so the updates stay in order
+                    self.pending.appendleft(update)
+                kept = update
+        if dropped is not None:
+            logger.warn("Sink '%s' %s, dropping it" % (self.name, dropped))
+            SINK_UPDATES.inc(sink=self.name, device=update.device, outcome='dropped')
+            if self.uses_outbox():
+                self.outbox.remove(self.name, update.device)
+        elif self.uses_outbox():
+            self.outbox.put(self.name, kept.device, kept.as_dict())
+        logger.warn("Retrying sink '%s' in %d seconds" % (self.name, self.retry_delay))
+
+    @abc.abstractmethod
+    def send(self, update):
+        '''
+        Sends the update, in the worker thread
+        :return: True if the output accepted the update
+        '''
+        pass
+
+    def close(self):
+        pass
+
+
+def fill_template(template, update, quote=False):
+    values = update.as_dict()
+    for param, key in TEMPLATE_PARAMS.items():
+        value = unicode(values[key]).encode('utf-8')
+        template = template.replace(param, urllib.quote(value) if quote else value)
+    return template
+
+
+class HttpSink(Sink):
+    '''
+    Requests an url, in which __DISTANCE__, __LATITUDE__, __ZONE__ etc. are replaced by the values of the update.
+    With a body template the body is posted, otherwise the url is requested with GET.
+    '''
+
+    def __init__(self, name, url, body=None, **kwargs):
+        super(HttpSink, self).__init__(name, **kwargs)
+        self.url = url
+        self.body = body
+        self.session = requests.Session()
+
+    def send(self, update):
+        url = fill_template(self.url, update, quote=True)
+        logger.debug("About to update '%s' with '%s'" % (update.device, url))
+        if self.body is None:
+            response = self.session.get(url, timeout=self.timeout)
+        else:
+            response = self.session.post(url, data=fill_template(self.body, update), timeout=self.timeout)
+        logger.debug("%s -> %s" % (url, response))
+        if not response.ok:
+            logger.warn("Unable to update distance of '%s' using '%s'. Response: %s" % (update.device, url, response))
+            return False
+        logger.info("Successfully updated distance of '%s' from %.1f to %.1f km using sink '%s'" %
+                    (update.device, update.old_distance_km, update.distance_km, self.name))
+        return True
+
+    def close(self):
+        self.session.close()
+
+
+class MqttSink(Sink):
+    '''
+    Publishes the distance, zone, accuracy and timestamp as retained messages on <topic prefix>/<device>/<key>.
+    The publisher buffers the messages itself while the broker is unreachable.
+    '''
+
+    def __init__(self, name, publisher, **kwargs):
+        super(MqttSink, self).__init__(name, **kwargs)
+        self.publisher = publisher
+
+    def start(self):
+        self.publisher.start()
+        super(MqttSink, self).start()
+
+    def stop(self, timeout=STOP_TIMEOUT_IN_S):
+        super(MqttSink, self).stop(timeout)
+        self.publisher.stop(timeout)
+
+    def send(self, update):
+        self.publisher.publish_device_state(update.device, {
+            'distance': update.distance_km,
+            'zone': update.zone,
+            'accuracy': update.accuracy,
+            'timestamp': update.timestamp,
+        })
+        return True
+
+
+class FileSink(Sink):
+    '''
+    Appends each update as a line of JSON to a file
+    '''
+
+    def __init__(self, name, path, **kwargs):
+        super(FileSink, self).__init__(name, **kwargs)
+        self.path = path
+
+    def send(self, update):
+        # opened for every update, so the file can be rotated
+        with open(self.path, 'a') as output:
+            output.write(json.dumps(update.as_dict(), sort_keys=True) + '\n')
+        return True
+
+
+class StreamSink(Sink):
+    '''
+    Writes each update as a line of JSON to a named pipe, or to stdout when no path is given. Opening a named pipe
+    waits for a reader, and it is opened again when the reader goes away. While there is no reader, or it reads too
+    slowly, the updates are kept up to queue_size.
+    '''
+
+    def __init__(self, name, path=None, on_closed=None, backpressure=BACKPRESSURE_QUEUE, **kwargs):
+        super(StreamSink, self).__init__(name, backpressure=backpressure, **kwargs)
+        self.path = path
+        self.on_closed = on_closed  # called when stdout is closed by the reader
+        self.output = None
+
+    def send(self, update):
+        if self.output is None:
+            self.output = sys.stdout if self.path is None else open(self.path, 'w')
+        try:
+            self.output.write(json.dumps(update.as_dict(), sort_keys=True) + '\n')
+            self.output.flush()
+        except IOError, e:
+            if e.errno != errno.EPIPE:
+                raise
+            if self.path is not None:
+                self.close()
+                raise
+            logger.info("The reader of the stream '%s' has gone" % self.name)
+            if self.on_closed is not None:
+                self.on_closed()
+            return False
+        return True
+
+    def close(self):
+        if self.output is not None and self.path is not None:
+            try:
+                self.output.close()
+            except IOError:
+                pass
+        self.output = None
+
+
+class HistorySink(Sink):
+    '''
+    Stores each update in the locations table of an SQLite database
+    '''
+
+    def __init__(self, name, path, backpressure=BACKPRESSURE_QUEUE, **kwargs):
+        super(HistorySink, self).__init__(name, backpressure=backpressure, **kwargs)
+        self.path = path
+        self.connection = None
+
+    def send(self, update):
+        # the connection can only be used by the thread which created it
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=self.timeout)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS locations (device TEXT, timestamp INTEGER, '
+                                    'latitude REAL, longitude REAL, accuracy INTEGER, distance_km REAL, zone TEXT)')
+        with self.connection:
+            self.connection.execute('INSERT INTO locations VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (update.device, update.timestamp, update.latitude, update.longitude,
+                                     update.accuracy, update.distance_km, update.zone))
+        return True
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
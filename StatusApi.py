@@ -0,0 +1,142 @@
+import BaseHTTPServer
+import json
+import threading
+import time
+import urllib
+import urllib2
+from Metrics import ThreadingHTTPServer
+from Sinks import LocationUpdate, ZONE_HOME, ZONE_NOT_HOME
+
+CONTENT_TYPE = 'application/json'
+DEVICES_PATH = '/devices'
+HISTORY_PATH = 'history'
+CLIENT_TIMEOUT_IN_S = 10
+
+
+def location_state(location):
+    if location is None:
+        return None
+    return {
+        'latitude': location.latitude,
+        'longitude': location.longitude,
+        'accuracy': int(location.accuracy),
+        'timestamp': int(location.timestamp),
+        'distance_km': location.rounded_distance_km,
+        'zone': ZONE_HOME if location.is_home() else ZONE_NOT_HOME,
+    }
+
+
+def device_state(monitor_device):
+    location = monitor_device.location_stored
+    state = {
+        'name': monitor_device.name,
+        'found': monitor_device.get_apple_device() is not None,
+        'location': location_state(location),
+        'fix_age_s': None,
+        'sent_distance_km': None,
+        'moving': monitor_device.is_moving(),
+        'next_update_timestamp': int(monitor_device.get_next_retrieve_timestamp()),
+    }
+    if location is not None:
+        state['fix_age_s'] = int(time.time() - location.timestamp)
+    if monitor_device.location_sent is not None:
+        state['sent_distance_km'] = monitor_device.location_sent.rounded_distance_km
+    return state
+
+
+class StatusRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Serves the state of the monitored devices from memory, so no iCloud requests are made:
+    - /devices: all devices
+    - /devices/<name>: one device
+    - /devices/<name>/history: the recent locations of one device
+    '''
+
+    def do_GET(self):
+        parts = [urllib.unquote(x) for x in self.path.split('?')[0].strip('/').split('/')]
+        if '/' + parts[0] != DEVICES_PATH or len(parts) > 3 or (len(parts) == 3 and parts[2] != HISTORY_PATH):
+            self.send_error(404)
+            return
+        # the list is changed by reloading the configuration, so a copy is used
+        monitor_devices = list(self.server.monitor_devices)
+        if len(parts) == 1:
+            self.send_json({'devices': [device_state(x) for x in monitor_devices]})
+            return
+        matches = [x for x in monitor_devices if x.name == parts[1]]
+        if not matches:
+            self.send_error(404, "Unknown device '%s'" % parts[1])
+            return
+        if len(parts) == 2:
+            self.send_json(device_state(matches[0]))
+        else:
+            self.send_json({'name': matches[0].name,
+                            'history': [location_state(x) for x in matches[0].get_history()]})
+
+    def send_json(self, value):
+        output = json.dumps(value, sort_keys=True)
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_status_server(monitor_devices, port, address='localhost'):
+    '''
+    Serves the state of the monitor_devices on http://address:port/devices from a background thread
+    '''
+    server = ThreadingHTTPServer((address, port), StatusRequestHandler)
+    server.monitor_devices = monitor_devices
+    thread = threading.Thread(target=server.serve_forever, name='status-server')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class StatusClient(object):
+    '''
+    Follows the locations of the devices of a running daemon through its status API, so no iCloud requests are made
+    '''
+
+    def __init__(self, url, timeout=CLIENT_TIMEOUT_IN_S):
+        self.url = url
+        self.timeout = timeout
+        self.locations = {}  # device: the latest location returned
+
+    def get(self, path):
+        response = urllib2.urlopen(self.url + path, timeout=self.timeout)
+        try:
+            return json.load(response)
+        finally:
+            response.close()
+
+    def new_updates(self):
+        '''
+        Returns the locations which the daemon stored since the previous call, oldest first, as LocationUpdates.
+        The first call returns the current location of each device.
+        Raises IOError when the daemon cannot be reached.
+        '''
+        updates = []
+        for state in self.get(DEVICES_PATH)['devices']:
+            name = state['name']
+            previous = self.locations.get(name)
+            location = state['location']
+            if location is None or location == previous:
+                continue
+            if previous is None:
+                locations = [location]
+            else:
+                # the history has the locations which were stored in between as well
+                history = self.get('%s/%s/%s' % (DEVICES_PATH, urllib.quote(name), HISTORY_PATH))['history']
+                locations = [x for x in history if x['timestamp'] > previous['timestamp']] or [location]
+            for location in locations:
+                old_distance_km = previous['distance_km'] if previous is not None else -1.0
+                updates.append(LocationUpdate(name, location['latitude'], location['longitude'],
+                                              location['accuracy'], location['timestamp'], location['distance_km'],
+                                              old_distance_km, location['zone']))
+                previous = location
+            self.locations[name] = previous
+        return updates
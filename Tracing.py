@@ -0,0 +1,158 @@
+import collections
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+from Metrics import Histogram
+
+SUMMARY_WINDOW = 100  # number of durations per span kept for the rolling summary
+SUMMARY_INTERVAL_IN_CYCLES = 100  # log the rolling summary every this number of cycles
+DEFAULT_PROFILE_CYCLES = 10
+
+SPAN_DURATION = Histogram('icloudlocationfetcher_span_duration_seconds',
+                          'Duration of the stages of a cycle', ['span'])
+
+logger = logging.getLogger('locations2domoticz.tracing')
+
+
+class Span(object):
+    def __init__(self, name, parent, start_timestamp):
+        self.name = name
+        self.parent = parent
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.start_timestamp = start_timestamp
+        self.duration = None
+        self.children_duration = 0.0
+
+    def self_duration(self):
+        return self.duration - self.children_duration
+
+
+class Tracer(object):
+    '''
+    Times the stages of a cycle of the main loop. Each cycle is logged as one structured (json) debug record,
+    and the durations are aggregated into a rolling summary, which is logged every SUMMARY_INTERVAL_IN_CYCLES.
+    Spans outside of a cycle, or on another thread than the one running the cycle, are ignored.
+    '''
+
+    def __init__(self):
+        self.cycle_count = 0
+        self.cycle_start_timestamp = None
+        self.cycle_thread = None
+        self.spans = []
+        self.current_span = None
+        self.durations = {}
+
+    def start_cycle(self):
+        self.cycle_count += 1
+        self.cycle_start_timestamp = time.time()
+        self.cycle_thread = threading.current_thread()
+        self.spans = []
+        self.current_span = None
+
+    def is_tracing(self):
+        return self.cycle_start_timestamp is not None and threading.current_thread() is self.cycle_thread
+
+    @contextlib.contextmanager
+    def span(self, name):
+        if not self.is_tracing():
+            yield None
+            return
+        span = Span(name, self.current_span, time.time())
+        self.current_span = span
+        try:
+            yield span
+        finally:
+            self.current_span = span.parent
+            self.finish_span(span, time.time() - span.start_timestamp)
+
+    def record(self, name, duration):
+        '''
+        Records a span which just finished, of which only the duration is known
+        '''
+        if not self.is_tracing():
+            return
+        span = Span(name, self.current_span, time.time() - duration)
+        self.finish_span(span, duration)
+
+    def finish_span(self, span, duration):
+        span.duration = duration
+        if span.parent is not None:
+            span.parent.children_duration += duration
+        self.spans.append(span)
+        SPAN_DURATION.observe(duration, span=span.name)
+        if span.name not in self.durations:
+            self.durations[span.name] = collections.deque(maxlen=SUMMARY_WINDOW)
+        self.durations[span.name].append(duration)
+
+    def end_cycle(self):
+        if self.cycle_start_timestamp is None:
+            return
+        duration = time.time() - self.cycle_start_timestamp
+        if logger.isEnabledFor(logging.DEBUG):
+            record = {
+                'cycle': self.cycle_count,
+                'duration': round(duration, 4),
+                'spans': [{'name': span.name,
+                           'depth': span.depth,
+                           'start': round(span.start_timestamp - self.cycle_start_timestamp, 4),
+                           'duration': round(span.duration, 4),
+                           'self': round(span.self_duration(), 4)}
+                          for span in sorted(self.spans, key=lambda x: (x.start_timestamp, x.depth))]
+            }
+            logger.debug("Cycle trace: %s" % json.dumps(record, sort_keys=True))
+        if self.cycle_count % SUMMARY_INTERVAL_IN_CYCLES == 0:
+            logger.info("Cycle timings of the last %d cycles: %s" % (SUMMARY_INTERVAL_IN_CYCLES, self.get_summary()))
+        self.cycle_start_timestamp = None
+
+    def get_summary(self):
+        summaries = []
+        for name, durations in sorted(self.durations.items()):
+            sorted_durations = sorted(durations)
+            p95 = sorted_durations[min(len(sorted_durations) - 1, int(0.95 * len(sorted_durations)))]
+            summaries.append("%s: n=%d, mean=%.3fs, p95=%.3fs, max=%.3fs"
+                             % (name, len(durations), sum(durations) / len(durations), p95, sorted_durations[-1]))
+        return '; '.join(summaries)
+
+
+class Profiler(object):
+    '''
+    Profiles a number of cycles with cProfile when requested, e.g. from a signal handler, and writes the stats
+    to a file which can be read with pstats. The sleep between the cycles is not profiled.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.requested_cycles = 0
+        self.remaining_cycles = 0
+        self.profile = None
+
+    def request(self, cycles=DEFAULT_PROFILE_CYCLES):
+        self.requested_cycles = cycles
+
+    def start_cycle(self):
+        if self.profile is None and self.requested_cycles > 0:
+            self.remaining_cycles = self.requested_cycles
+            self.requested_cycles = 0
+            self.profile = cProfile.Profile()
+            logger.info("Profiling the next %d cycles" % self.remaining_cycles)
+        if self.profile is not None:
+            self.profile.enable()
+
+    def end_cycle(self):
+        if self.profile is None:
+            return
+        self.profile.disable()
+        self.remaining_cycles -= 1
+        if self.remaining_cycles <= 0:
+            filename = os.path.join(self.directory,
+                                    'iCloudLocationFetcher-%s.prof' % time.strftime('%Y%m%d-%H%M%S'))
+            self.profile.dump_stats(filename)
+            self.profile = None
+            logger.info("Profile written to '%s'" % filename)
+
+
+TRACER = Tracer()
@@ -1,22 +1,47 @@
 #!/usr/bin/python
 
+import argparse
 import ConfigParser
 import logging
 import os
 import pyicloud
-import requests
 import signal
 import sys
 import time
-from pyicloud.exceptions import PyiCloudAPIResponseError
-from constants import ACTION_NEEDED_ERROR_SLEEP_TIME
+from pyicloud.ratelimit import DEFAULT_RATE_LIMITS, RateLimiter
+from CircuitBreaker import CircuitBreaker, classify_error, ERROR_ACTION_NEEDED, ERROR_AUTH, ERROR_BUG
 from Location import Location
+from Metrics import Counter, Gauge, Histogram, start_metrics_server
+from Tracing import TRACER, Profiler, DEFAULT_PROFILE_CYCLES
 from MonitorDevice import MonitorDevice
+from MqttPublisher import MqttPublisher
+from Outbox import Outbox
+from Sinks import Sink, HttpSink, MqttSink, FileSink, HistorySink, StreamSink, DEFAULT_TIMEOUT_IN_S, DEFAULT_QUEUE_SIZE
+from SendPolicy import SendPolicy
+from SessionManager import SessionManager
+from StatusApi import StatusClient, start_status_server
+from pyicloud.exceptions import PyiCloud2SARequiredError
 
 MIN_SLEEP_TIME = 1
 MAX_SLEEP_TIME = 3600
-RECOVERABLE_ERROR_SLEEP_TIME = 60
 MAX_SESSION_TIME = 1800  # icloud will respond with HTTP 450 if session is not used within this time
+SESSION_ROTATION_LEAD_TIME = 60  # when sleeping longer than MAX_SESSION_TIME, log in again this long before waking up
+LOGIN_ENDPOINT = 'login'
+REFRESH_ENDPOINT = 'refreshClient'
+SINK_SECTION_PREFIX = 'sink:'
+SINK_UPDATES_FIXES = 'fixes'
+SINK_UPDATES_DISTANCES = 'distances'
+DEVICE_SECTION_PREFIX = 'device:'
+OUTBOX_FILE_NAME = 'iCloudLocationFetcher.outbox'
+WATCH_INTERVAL_IN_S = 1  # reading the status API of the daemon is cheap, as it does not request iCloud
+
+ICLOUD_REQUEST_DURATION = Histogram('icloudlocationfetcher_icloud_request_duration_seconds',
+                                    'Duration of the requests to iCloud', ['endpoint'])
+ICLOUD_LOGINS = Counter('icloudlocationfetcher_icloud_logins_total', 'Logins to iCloud, by outcome', ['outcome'])
+DUE_DEVICES = Gauge('icloudlocationfetcher_due_devices', 'Devices due for an update in the last cycle')
+SCHEDULER_LAG = Histogram('icloudlocationfetcher_scheduler_lag_seconds',
+                          'Delay of updating a device compared to its planned update time',
+                          buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60))
 
 # Constants (Do not change)
 SCRIPT_VERSION = "1.0.0"
@@ -24,12 +49,13 @@ SCRIPT_DATE = "2018-09-29"
 
 # Global variables
 keep_running = True
+reload_requested = False
 logger = None
 
 
 # Initialisation
-def init_logging(config):
-    log_file = config.get('GENERAL', 'log_file')
+def init_logging(config, log_to_file=True):
+    log_file = config.get('GENERAL', 'log_file') if log_to_file else None
     log_level_from_config = config.get('GENERAL', 'log_level')
     log_to_console = config.getboolean('GENERAL', 'log_to_console')
     log_level = logging.INFO
@@ -40,11 +66,11 @@ def init_logging(config):
     elif log_level_from_config == 'WARNING':
         log_level = logging.WARNING
 
-    # logging to file
+    # logging to file, or to stderr without a file
     logging.basicConfig(level=log_level, format='%(asctime)s %(levelname)-8s %(message)s',
                         filename=log_file, filemode='w')
     # logging to console
-    if log_to_console:
+    if log_to_console and log_file is not None:
         console = logging.StreamHandler()
         formatter = logging.Formatter('%(asctime)s %(levelname)-8s %(message)s')
         console.setFormatter(formatter)
@@ -55,23 +81,17 @@ def init_logging(config):
     return local_logger
 
 
-def get_apple_device(devices, name):
-    device = None
-    i = 0
-    while device is None and i < len(devices.keys()):
-        if devices[i].content['name'] == name:
-            device = devices[i]
-        i += 1
-    return device
-
-
-# Main program
-def main():
-    global keep_running, logger
-
-    # read configuration
+def read_config():
     config = ConfigParser.SafeConfigParser({'low_updates_when_home': None,
+                                            'icloud_rate_limits': None,
+                                            'metrics_port': None,
+                                            'metrics_address': "localhost",
+                                            'api_port': None,
+                                            'api_address': "localhost",
+                                            'outbox_file': None,
+                                            'profile_cycles': str(DEFAULT_PROFILE_CYCLES),
                                             'send_to_server': "true",
+                                            'smooth_locations': "true",
                                             'home_radius': "0.0"})
     config_exists = False
     for loc in os.curdir, os.path.expanduser("~"), os.path.join(os.path.expanduser("~"), "iCloudLocationFetcher"):
@@ -83,11 +103,329 @@ def main():
             pass
 
     if not config_exists:
+        return None
+    return config
+
+
+def parse_home_location(config):
+    home_location_str = config.get('GENERAL', 'home_location')
+    return [float(x.strip()) for x in home_location_str.split(',')]
+
+
+def parse_low_updates_when_home(config):
+    low_updates_when_home_timespan = None
+    low_updates_when_home_str = config.get('GENERAL', 'low_updates_when_home')
+    if low_updates_when_home_str is not None:
+        low_updates_when_home_start_minutes = None
+        low_updates_when_home_end_minutes = None
+        low_updates_when_home_list = [x.strip() for x in low_updates_when_home_str.split('-')]
+        if len(low_updates_when_home_list) == 2:
+            hours_min_start_list = [int(x.strip()) for x in low_updates_when_home_list[0].split(':')]
+            if len(hours_min_start_list) == 2:
+                low_updates_when_home_start_minutes = 60 * hours_min_start_list[0] + hours_min_start_list[1]
+            hours_min_end_list = [int(x.strip()) for x in low_updates_when_home_list[1].split(':')]
+            if len(hours_min_end_list) == 2:
+                low_updates_when_home_end_minutes = 60 * hours_min_end_list[0] + hours_min_end_list[1]
+
+        if low_updates_when_home_start_minutes is None or low_updates_when_home_end_minutes is None:
+            logger.warn("Invalid format of 'low_updates_when_home' parameter in config. Found '%s', but format should be '23:30-07:00'" % low_updates_when_home_str)
+        else:
+            logger.info("Low updates starting from %s (%d minutes) to %s (%d minutes)" % (low_updates_when_home_list[0], low_updates_when_home_start_minutes, low_updates_when_home_list[1], low_updates_when_home_end_minutes))
+            low_updates_when_home_timespan = [low_updates_when_home_start_minutes, low_updates_when_home_end_minutes]
+    return low_updates_when_home_timespan
+
+
+def parse_devices_to_monitor(config):
+    devices_to_monitor_str = config.get('GENERAL', 'devices_to_monitor')
+    devices_to_monitor = devices_to_monitor_str.strip().split('\n')
+    names_and_urls = []
+    for device_to_monitor in devices_to_monitor:
+        name_and_url = device_to_monitor.split(',')
+        names_and_urls.append((name_and_url[0], name_and_url[1]))
+    return names_and_urls
+
+
+def parse_send_policy(config, device_name):
+    '''
+    Reads the send policy of the device from its [device:<name>] section, falling back to the GENERAL section
+    '''
+    # the send options are not in the defaults, as those would override the GENERAL section in the device sections
+    def get_option(option, default):
+        for section in DEVICE_SECTION_PREFIX + device_name, 'GENERAL':
+            if config.has_section(section) and config.has_option(section, option):
+                return float(config.get(section, option))
+        return default
+
+    return SendPolicy(min_distance_change_km=get_option('send_min_distance_change_km', 0.0),
+                      min_distance_change_percentage=get_option('send_min_distance_change_percentage', 0.0),
+                      min_interval=get_option('send_min_interval', 0))
+
+
+def parse_rate_limits(rate_limits_str):
+    # format: refreshClient:10/60, login:4/600
+    if rate_limits_str is None:
+        return DEFAULT_RATE_LIMITS
+    rate_limits = {}
+    for rate_limit_str in rate_limits_str.split(','):
+        endpoint, limit = [x.strip() for x in rate_limit_str.split(':')]
+        requests_str, seconds_str = limit.split('/')
+        rate_limits[endpoint] = (int(requests_str), int(seconds_str))
+    return rate_limits
+
+
+def parse_sinks(config):
+    '''
+    Creates the sinks of the [sink:<name>] sections, which are not started yet
+    '''
+    def get_option(section, option, default=None):
+        if not config.has_option(section, option):
+            return default
+        # templates may contain url encoded characters, so no interpolation
+        return config.get(section, option, raw=True)
+
+    def create_mqtt_publisher(section, prefix=''):
+        return MqttPublisher(config.get(section, prefix + 'host'), int(get_option(section, prefix + 'port', 1883)),
+                             topic_prefix=get_option(section, prefix + 'topic_prefix', 'icloudlocationfetcher'),
+                             qos=int(get_option(section, prefix + 'qos', 1)),
+                             username=get_option(section, prefix + 'username'),
+                             password=get_option(section, prefix + 'password'))
+
+    sinks = []
+    for section in config.sections():
+        if not section.startswith(SINK_SECTION_PREFIX):
+            continue
+        name = section[len(SINK_SECTION_PREFIX):]
+        sink_type = config.get(section, 'type')
+        devices_str = get_option(section, 'devices')
+        kwargs = {'devices': [x.strip() for x in devices_str.split(',')] if devices_str is not None else None,
+                  'timeout': float(get_option(section, 'timeout', DEFAULT_TIMEOUT_IN_S)),
+                  'queue_size': int(get_option(section, 'queue_size', DEFAULT_QUEUE_SIZE))}
+        updates = get_option(section, 'updates', SINK_UPDATES_DISTANCES)
+        if updates not in (SINK_UPDATES_DISTANCES, SINK_UPDATES_FIXES):
+            raise ValueError("Unknown updates '%s' of sink '%s', use distances or fixes" % (updates, name))
+        kwargs['every_fix'] = updates == SINK_UPDATES_FIXES
+        if config.has_option(section, 'backpressure'):
+            kwargs['backpressure'] = get_option(section, 'backpressure')
+        if sink_type == 'http':
+            sink = HttpSink(name, config.get(section, 'url', raw=True), get_option(section, 'body'), **kwargs)
+        elif sink_type == 'mqtt':
+            sink = MqttSink(name, create_mqtt_publisher(section), **kwargs)
+        elif sink_type == 'file':
+            sink = FileSink(name, os.path.expanduser(config.get(section, 'path')), **kwargs)
+        elif sink_type == 'history':
+            sink = HistorySink(name, os.path.expanduser(config.get(section, 'path')), **kwargs)
+        elif sink_type == 'stream':
+            sink = StreamSink(name, os.path.expanduser(config.get(section, 'path')), **kwargs)
+        else:
+            raise ValueError("Unknown type '%s' of sink '%s', use http, mqtt, file, history or stream"
+                             % (sink_type, name))
+        sinks.append(sink)
+
+    if config.has_option('GENERAL', 'mqtt_host'):
+        # the mqtt_* options of GENERAL, from before the sink sections, are still an mqtt sink
+        if config.has_section(SINK_SECTION_PREFIX + 'mqtt'):
+            raise ValueError("Use either the mqtt_* options of GENERAL or the [sink:mqtt] section")
+        logger.warn("The mqtt_* options of GENERAL are deprecated, use a [sink:mqtt] section instead")
+        sinks.append(MqttSink('mqtt', create_mqtt_publisher('GENERAL', 'mqtt_')))
+    return sinks
+
+
+def handle_error(circuit_breaker, error):
+    error_type = classify_error(error)
+    backoff = circuit_breaker.record_failure(error_type)
+    if error_type == ERROR_BUG:
+        logger.exception("Unexpected exception for '%s'. Next retry in %d seconds" % (circuit_breaker.name, backoff))
+    else:
+        logger.warn("%s: %s (%s error for '%s'). Next retry in %d seconds"
+                    % (type(error).__name__, str(error), error_type, circuit_breaker.name, backoff))
+    return error_type
+
+
+def record_icloud_request_duration(response, *args, **kwargs):
+    ICLOUD_REQUEST_DURATION.observe(response.elapsed.total_seconds(),
+                                    endpoint=RateLimiter.endpoint_for_url(response.url))
+    TRACER.record('http', response.elapsed.total_seconds())
+
+
+def login(apple_id, apple_password, rate_limits):
+    '''
+    Logs in to iCloud and retrieves the devices, which might be done by a background thread
+    :return: the new session
+    '''
+    login_start_time = time.time()
+    try:
+        with TRACER.span('authenticate'):
+            icloud = pyicloud.PyiCloudService(apple_id, apple_password, "~/.iCloudLocationFetcher",
+                                              rate_limits=rate_limits)
+        ICLOUD_REQUEST_DURATION.observe(time.time() - login_start_time, endpoint=LOGIN_ENDPOINT)
+        icloud.session.hooks['response'].append(record_icloud_request_duration)
+        if icloud.requires_2sa:
+            logger.error("Two-step authentication required. Please run twostep.py")
+            raise PyiCloud2SARequiredError(apple_id)
+        with TRACER.span('find_devices'):
+            # only the last known locations are needed to find the devices
+            icloud.devices.refresh_client(locate=None)
+    except Exception:
+        ICLOUD_LOGINS.inc(outcome='failure')
+        raise
+    ICLOUD_LOGINS.inc(outcome='success')
+    return icloud
+
+
+def find_apple_devices(monitor_devices, icloud_devices):
+    for monitor_device in monitor_devices:
+        logger.info("Searching for '%s' in iCloud devices" % monitor_device.name)
+        apple_device = get_apple_device(icloud_devices, monitor_device)
+        # a device which is not found anymore is not polled with its device of an old session
+        monitor_device.set_apple_device(apple_device)
+        if apple_device is not None:
+            logger.info("Found iCloud device '%s'" % str(apple_device))
+        else:
+            logger.warn("No iCloud device found with name '%s'" % monitor_device.name)
+
+
+def get_apple_device(devices, monitor_device):
+    # a device found before is found again by its stable key, even when it has been renamed
+    device = None
+    if monitor_device.get_apple_device_key() is not None:
+        device = devices.get_by_stable_key(monitor_device.get_apple_device_key())
+    if device is None:
+        device = devices.get_by_name(monitor_device.name)
+    return device
+
+
+def reload_config(monitor_devices, icloud_devices, apple_id, rate_limits):
+    '''
+    Applies the changes in the configuration file to the monitored devices, without touching the iCloud session
+    or the state of the unchanged devices, so no iCloud requests are needed.
+    Changes of the credentials, logging, metrics, api, sinks and profiling settings require a restart.
+    :return: the rate limits to use for new iCloud sessions
+    '''
+    config = read_config()
+    if config is None:
+        logger.error("Unable to find the 'iCloudLocationFetcher.conf' file, keeping the current configuration")
+        return rate_limits
+    try:
+        home_location = parse_home_location(config)
+        low_updates_when_home_timespan = parse_low_updates_when_home(config)
+        devices_to_monitor = parse_devices_to_monitor(config)
+        send_policies = dict((name, parse_send_policy(config, name)) for name, update_url in devices_to_monitor)
+        new_rate_limits = parse_rate_limits(config.get('GENERAL', 'icloud_rate_limits'))
+        send_to_server = config.getboolean('GENERAL', 'send_to_server')
+        smooth_locations = config.getboolean('GENERAL', 'smooth_locations')
+    except (ConfigParser.Error, ValueError, IndexError), e:
+        logger.error("Invalid configuration, keeping the current configuration: %s" % str(e))
+        return rate_limits
+
+    MonitorDevice.set_send_to_server(send_to_server)
+    MonitorDevice.set_smooth_locations(smooth_locations)
+    RateLimiter.for_account(apple_id).configure(new_rate_limits)
+
+    home_location_changed = home_location != Location.home_position
+    if home_location_changed:
+        logger.info("Home location changed from %s to %s" % (Location.home_position, home_location))
+        Location.set_home_position(home_location)
+
+    update_urls = dict(devices_to_monitor)
+    for monitor_device in list(monitor_devices):
+        if monitor_device.name not in update_urls:
+            logger.info("Stopped monitoring '%s'" % monitor_device.name)
+            monitor_device.unregister()
+            monitor_devices.remove(monitor_device)
+
+    monitored_names = [x.name for x in monitor_devices]
+    for name, update_url in devices_to_monitor:
+        if name not in monitored_names:
+            logger.info("Started monitoring '%s'" % name)
+            monitor_device = MonitorDevice(name, update_url)
+            # without a session, the device will be searched for after logging in
+            if icloud_devices is not None:
+                apple_device = get_apple_device(icloud_devices, monitor_device)
+                if apple_device is not None:
+                    monitor_device.set_apple_device(apple_device)
+                    logger.info("Found iCloud device '%s'" % str(apple_device))
+                else:
+                    logger.warn("No iCloud device found with name '%s'" % name)
+            monitor_device.start()
+            monitor_devices.append(monitor_device)
+
+    for monitor_device in monitor_devices:
+        monitor_device.set_home_period(low_updates_when_home_timespan)
+        if monitor_device.send_policy != send_policies[monitor_device.name]:
+            logger.info("Send policy of '%s' changed" % monitor_device.name)
+            monitor_device.set_send_policy(send_policies[monitor_device.name])
+        update_url_changed = monitor_device.update_url != update_urls[monitor_device.name]
+        if update_url_changed:
+            logger.info("Update url of '%s' changed to '%s'" % (monitor_device.name, update_urls[monitor_device.name]))
+            monitor_device.set_update_url(update_urls[monitor_device.name])
+        distance_sent = home_location_changed and monitor_device.home_position_changed()
+        # the new url does not know the current distance yet
+        if update_url_changed and not distance_sent:
+            monitor_device.resend_stored_distance()
+
+    return new_rate_limits
+
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(description="Sends the distance to home of iCloud devices to a server")
+    parser.add_argument('command', nargs='?', choices=('run', 'watch'), default='run',
+                        help="run: send the distances to the update urls and sinks (default), "
+                             "watch: write every new location of the running daemon as a line of JSON, "
+                             "read from its status API")
+    parser.add_argument('--output', help="watch: named pipe to write to, instead of stdout")
+    parser.add_argument('--buffer', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help="watch: number of locations kept while the reader is not reading (default: %(default)s)")
+    return parser.parse_args(args)
+
+
+def stop_running():
+    global keep_running
+    keep_running = False
+
+
+def watch(config, output, buffer_size):
+    '''
+    Writes every new location of the running daemon as a line of JSON, as read from its status API, so watching
+    neither logs in to iCloud nor polls it
+    '''
+    api_port_str = config.get('GENERAL', 'api_port')
+    if api_port_str is None:
+        logger.error("Watching reads the locations from the status API of the running daemon, "
+                     "configure its 'api_port'")
+        sys.exit(1)
+    api_address = config.get('GENERAL', 'api_address')
+    if api_address in ('', '0.0.0.0'):
+        api_address = 'localhost'
+    client = StatusClient('http://%s:%s' % (api_address, api_port_str))
+    sink = StreamSink('watch', output, on_closed=stop_running if output is None else None, queue_size=buffer_size)
+    sink.start()
+    logger.info("Watching the locations of %s" % client.url)
+    while keep_running:
+        try:
+            for update in client.new_updates():
+                sink.submit(update)
+        except (IOError, ValueError, KeyError), e:
+            logger.warn("Unable to read the locations from %s: %s" % (client.url, e))
+        time.sleep(WATCH_INTERVAL_IN_S)
+    sink.stop()
+
+
+# Main program
+def main(args=None):
+    global keep_running, reload_requested, logger
+
+    arguments = parse_arguments(sys.argv[1:] if args is None else args)
+
+    # read configuration
+    config = read_config()
+    if config is None:
         print("Error: Unable to find the 'iCloudLocationFetcher.conf' file. \n"
               "Put it in the current directory, in ~ or in ~/iCloudLocationFetcher.\n")
         sys.exit(1)
 
-    logger = init_logging(config)
+    # while watching, the log file is left to the running daemon, and the log goes to stderr
+    watching = arguments.command == 'watch'
+    logger = init_logging(config, log_to_file=not watching)
 
     logger.info("---")
     logger.info("iCloudLocationFetcher, v%s, %s" % (SCRIPT_VERSION, SCRIPT_DATE))
@@ -101,6 +439,27 @@ def main():
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
+    if watching:
+        watch(config, arguments.output, arguments.buffer)
+        return
+
+    log_directory = os.path.dirname(os.path.abspath(config.get('GENERAL', 'log_file')))
+    profiler = Profiler(log_directory)
+    profile_cycles = config.getint('GENERAL', 'profile_cycles')
+
+    def profile_signal_handler(signal1, frame):
+        logger.info('Signal received: %s, profiling the next %d cycles' % (signal1, profile_cycles))
+        profiler.request(profile_cycles)
+
+    signal.signal(signal.SIGUSR1, profile_signal_handler)
+
+    def reload_signal_handler(signal1, frame):
+        global reload_requested
+        logger.info('Signal received: %s, reloading the configuration' % signal1)
+        reload_requested = True
+
+    signal.signal(signal.SIGHUP, reload_signal_handler)
+
     # read other configuration
     apple_creds_file = config.get('GENERAL', 'apple_creds_file')
     try:
@@ -111,104 +470,160 @@ def main():
         logger.error("Unable to read the apple credentials file '%s': %s" % (apple_creds_file, str(e)))
         sys.exit(1)
 
-    home_location_str = config.get('GENERAL', 'home_location')
-    home_location = [float(x.strip()) for x in home_location_str.split(',')]
-    Location.set_home_position(home_location)
-
-    low_updates_when_home_timespan = None
-    low_updates_when_home_str = config.get('GENERAL', 'low_updates_when_home')
-    if low_updates_when_home_str is not None:
-        low_updates_when_home_start_minutes = None
-        low_updates_when_home_end_minutes = None
-        low_updates_when_home_list = [x.strip() for x in low_updates_when_home_str.split('-')]
-        if len(low_updates_when_home_list) == 2:
-            hours_min_start_list = [int(x.strip()) for x in low_updates_when_home_list[0].split(':')]
-            if len(hours_min_start_list) == 2:
-                low_updates_when_home_start_minutes = 60 * hours_min_start_list[0] + hours_min_start_list[1]
-            hours_min_end_list = [int(x.strip()) for x in low_updates_when_home_list[1].split(':')]
-            if len(hours_min_end_list) == 2:
-                low_updates_when_home_end_minutes = 60 * hours_min_end_list[0] + hours_min_end_list[1]
-
-        if low_updates_when_home_start_minutes is None or low_updates_when_home_end_minutes is None:
-            logger.warn("Invalid format of 'low_updates_when_home' parameter in config. Found '%s', but format should be '23:30-07:00'" % low_updates_when_home_str)
-        else:
-            logger.info("Low updates starting from %s (%d minutes) to %s (%d minutes)" % (low_updates_when_home_list[0], low_updates_when_home_start_minutes, low_updates_when_home_list[1], low_updates_when_home_end_minutes))
-            low_updates_when_home_timespan = [low_updates_when_home_start_minutes, low_updates_when_home_end_minutes]
+    Location.set_home_position(parse_home_location(config))
+    low_updates_when_home_timespan = parse_low_updates_when_home(config)
 
     send_to_server = config.getboolean('GENERAL', 'send_to_server')
+    smooth_locations = config.getboolean('GENERAL', 'smooth_locations')
+
+    try:
+        rate_limits = parse_rate_limits(config.get('GENERAL', 'icloud_rate_limits'))
+    except ValueError:
+        logger.error("Invalid format of 'icloud_rate_limits' parameter in config. Found '%s', but format should be "
+                     "'refreshClient:10/60, login:4/600'" % config.get('GENERAL', 'icloud_rate_limits'))
+        sys.exit(1)
+    rate_limiter = RateLimiter.for_account(apple_id, rate_limits)
+
+    metrics_port_str = config.get('GENERAL', 'metrics_port')
+    if metrics_port_str is not None:
+        metrics_address = config.get('GENERAL', 'metrics_address')
+        start_metrics_server(int(metrics_port_str), metrics_address)
+        logger.info("Serving metrics on http://%s:%s/metrics" % (metrics_address, metrics_port_str))
+
+    outbox_file = config.get('GENERAL', 'outbox_file')
+    if outbox_file is None:
+        outbox_file = os.path.join(log_directory, OUTBOX_FILE_NAME)
+    Sink.set_outbox(Outbox(os.path.expanduser(outbox_file)))
+    try:
+        sinks = parse_sinks(config)
+    except (ConfigParser.Error, ValueError), e:
+        logger.error("Invalid sink configuration: %s" % str(e))
+        sys.exit(1)
+    for sink in sinks:
+        sink.start()
+        logger.info("Sending updates to sink '%s'" % sink.name)
 
-    devices_to_monitor_str = config.get('GENERAL', 'devices_to_monitor')
-    devices_to_monitor = devices_to_monitor_str.strip().split('\n')
     monitor_devices = []
-    for device_to_monitor in devices_to_monitor:
-        name_and_url = device_to_monitor.split(',')
-        monitor_device = MonitorDevice(name_and_url[0], name_and_url[1])
+    for name, update_url in parse_devices_to_monitor(config):
+        monitor_device = MonitorDevice(name, update_url)
         monitor_device.set_home_period(low_updates_when_home_timespan)
+        monitor_device.set_send_policy(parse_send_policy(config, name))
+        monitor_device.start()
         monitor_devices.append(monitor_device)
 
+    api_port_str = config.get('GENERAL', 'api_port')
+    if api_port_str is not None:
+        api_address = config.get('GENERAL', 'api_address')
+        start_status_server(monitor_devices, int(api_port_str), api_address)
+        logger.info("Serving the device states on http://%s:%s/devices" % (api_address, api_port_str))
+
     MonitorDevice.set_logger(logger)
     MonitorDevice.set_send_to_server(send_to_server)
-
-    sleep_time = MIN_SLEEP_TIME
-    icloud = None
+    MonitorDevice.set_smooth_locations(smooth_locations)
+    MonitorDevice.set_sinks(sinks)
+
+    login_breaker = CircuitBreaker(LOGIN_ENDPOINT)
+    refresh_breaker = CircuitBreaker(REFRESH_ENDPOINT)
+    # rate_limits is read when logging in, so changes by reloading the configuration are used
+    session_manager = SessionManager(lambda: login(apple_id, apple_password, rate_limits))
+    # the current session failed with an authentication error, and is replaced by a rotation
+    session_failed = False
     while keep_running:
-        try:
-            if icloud is None:
-                icloud = pyicloud.PyiCloudService(apple_id, apple_password, "~/.iCloudLocationFetcher")
-                if icloud.requires_2sa:
-                    logger.error("Two-step authentication required. Please run twostep.py")
-                    sleep_time = ACTION_NEEDED_ERROR_SLEEP_TIME
-                    icloud = None
+        TRACER.start_cycle()
+        profiler.start_cycle()
+        swapped, rotation_error = session_manager.swap()
+        if rotation_error is not None:
+            handle_error(login_breaker, rotation_error)
+            if session_failed:
+                # no usable session is left, the main loop logs in when the login breaker allows it
+                session_manager.discard("authentication error, and the new session failed to log in")
+                session_failed = False
+            # otherwise polling continues with the current session
+        elif swapped:
+            login_breaker.record_success()
+            if session_failed:
+                # the errors of the old session do not hold back the new one
+                refresh_breaker.record_success()
+                session_failed = False
+            find_apple_devices(monitor_devices, session_manager.get_session().devices)
+        icloud = session_manager.get_session()
+        if reload_requested:
+            reload_requested = False
+            rate_limits = reload_config(monitor_devices, icloud.devices if icloud is not None else None,
+                                        apple_id, rate_limits)
+        # a rotation which is busy logs in already
+        if icloud is None and not session_manager.is_rotating() and login_breaker.allow():
+            try:
+                icloud = session_manager.login_now()
+                find_apple_devices(monitor_devices, icloud.devices)
+                login_breaker.record_success()
+            except Exception as e:
+                handle_error(login_breaker, e)
+
+        if icloud is not None:
+            now = time.time()
+            next_sleep_time = MAX_SLEEP_TIME
+            DUE_DEVICES.set(len([x for x in monitor_devices if x.should_update()]))
+            # when rate limited, the devices with the highest priority are updated first
+            for monitor_device in sorted(monitor_devices, key=lambda x: x.get_priority()):
+                if monitor_device.should_update():
+                    priority = monitor_device.get_priority()
+                    if monitor_device.circuit_breaker.is_open():
+                        # the device failed before, and is only probed again when its backoff has passed
+                        monitor_device.postpone(monitor_device.circuit_breaker.get_retry_delay())
+                    elif not rate_limiter.admit(REFRESH_ENDPOINT, priority):
+                        wait_time = rate_limiter.wait_time(REFRESH_ENDPOINT, priority)
+                        monitor_device.postpone(wait_time)
+                        logger.info("Rate limit reached, postponing update for '%s' by %d seconds" %
+                                    (monitor_device.name, wait_time))
+                    # as the device breaker is not open, allow() only starts its probe after a failure
+                    elif refresh_breaker.allow() and monitor_device.circuit_breaker.allow():
+                        lag = time.time() - monitor_device.get_next_retrieve_timestamp()
+                        SCHEDULER_LAG.observe(max(0, lag))
+                        try:
+                            with TRACER.span('monitor_device'):
+                                monitor_device.retrieve_location_and_update()
+                            refresh_breaker.record_success()
+                            monitor_device.circuit_breaker.record_success()
+                        except Exception as e:
+                            if classify_error(e) == ERROR_BUG:
+                                # iCloud did respond, so only this device is affected
+                                refresh_breaker.record_success()
+                                handle_error(monitor_device.circuit_breaker, e)
+                                monitor_device.postpone(monitor_device.circuit_breaker.get_retry_delay())
+                            else:
+                                # iCloud failed, which tells nothing about the device
+                                monitor_device.circuit_breaker.cancel_probe()
+                                if handle_error(refresh_breaker, e) in (ERROR_AUTH, ERROR_ACTION_NEEDED):
+                                    # a new session logs in in the background, when the login breaker allows it,
+                                    # while this one is still used until the new one is swapped in
+                                    session_failed = True
+                                    session_manager.rotate("authentication error", login_breaker.get_retry_delay())
+                    next_update = int(monitor_device.get_next_retrieve_timestamp() - now)
+                    next_sleep_time = min(next_sleep_time, next_update + MIN_SLEEP_TIME)
                 else:
-                    sleep_time = MIN_SLEEP_TIME
-                    icloud_devices = icloud.devices
-                    # set corresponding devices
-                    for monitor_device in monitor_devices:
-                        logger.info("Searching for '%s' in iCloud devices" % monitor_device.name)
-                        apple_device = get_apple_device(icloud_devices, monitor_device.name)
-                        if apple_device is not None:
-                            monitor_device.set_apple_device(apple_device)
-                            logger.info("Found iCloud device '%s'" % str(apple_device))
-                        else:
-                            logger.warn("No iCloud device found with name '%s'" % monitor_device.name)
-
-            if icloud is not None:
-                now = time.time()
-                next_sleep_time = MAX_SLEEP_TIME
-                for monitor_device in monitor_devices:
-                    if monitor_device.should_update():
-                        monitor_device.retrieve_location_and_update()
-                        next_update = int(monitor_device.get_next_retrieve_timestamp() - now)
-                        next_sleep_time = min(next_sleep_time, next_update + MIN_SLEEP_TIME)
-                    else:
-                        next_update = int(monitor_device.get_next_retrieve_timestamp() - now)
-                        logger.debug("Update not needed yet for '%s'. Next update in %d seconds" % (monitor_device.name, next_update))
-                        next_sleep_time = min(next_sleep_time, next_update + MIN_SLEEP_TIME)
-                sleep_time = next_sleep_time
-
-        except PyiCloudAPIResponseError as e:
-            logger.warn("PyiCloudAPIResponseError: {0}. Sleeping for {1} seconds".format(str(e), str(RECOVERABLE_ERROR_SLEEP_TIME)))
-            icloud = None
-            sleep_time = RECOVERABLE_ERROR_SLEEP_TIME
-        except requests.exceptions.ConnectionError as e:
-            logger.warn("ConnectionError: {0}. Sleeping for {1} seconds".format(str(e), str(RECOVERABLE_ERROR_SLEEP_TIME)))
-            icloud = None
-            sleep_time = RECOVERABLE_ERROR_SLEEP_TIME
-        except requests.Timeout as e:
-            logger.warn("Timout: {0}. Sleeping for {1} seconds".format(str(e), str(RECOVERABLE_ERROR_SLEEP_TIME)))
-            icloud = None
-            sleep_time = RECOVERABLE_ERROR_SLEEP_TIME
-        except:
-            logger.exception("Unexpected exception. Sleeping for {0} seconds".format(ACTION_NEEDED_ERROR_SLEEP_TIME))
-            icloud = None
-            sleep_time = ACTION_NEEDED_ERROR_SLEEP_TIME
-
-        if sleep_time >= MAX_SESSION_TIME:
-            icloud = None
-            logger.debug("Sleeping for %d seconds and resetting icloud connection" % sleep_time)
+                    next_update = int(monitor_device.get_next_retrieve_timestamp() - now)
+                    logger.debug("Update not needed yet for '%s'. Next update in %d seconds" % (monitor_device.name, next_update))
+                    next_sleep_time = min(next_sleep_time, next_update + MIN_SLEEP_TIME)
+            sleep_time = next_sleep_time
+            if not refresh_breaker.is_closed():
+                sleep_time = max(sleep_time, int(refresh_breaker.get_retry_delay()) + MIN_SLEEP_TIME)
+        if icloud is None:
+            # not logged in, or the session was discarded
+            sleep_time = max(MIN_SLEEP_TIME, int(login_breaker.get_retry_delay()))
+
+        if sleep_time >= MAX_SESSION_TIME and icloud is not None and not login_breaker.is_open():
+            # the session expires while sleeping, the new session is ready when waking up
+            session_manager.rotate("session expires while sleeping", sleep_time - SESSION_ROTATION_LEAD_TIME)
+            logger.debug("Sleeping for %d seconds and rotating the icloud session" % sleep_time)
         else:
             logger.debug("Sleeping for %d seconds" % sleep_time)
+        profiler.end_cycle()
+        TRACER.end_cycle()
         time.sleep(sleep_time)
+    session_manager.stop()
+    for sink in sinks + [x.update_url_sink for x in monitor_devices]:
+        sink.stop()
 
 
 if __name__ == '__main__':
@@ -2,13 +2,17 @@ import six
 import uuid
 import hashlib
 import inspect
+import errno
 import json
 import logging
 import requests
 import sys
 import tempfile
+import threading
+import time
 import os
 from re import match
+from requests.adapters import HTTPAdapter
 
 from pyicloud.exceptions import (
     PyiCloudFailedLoginException,
@@ -16,15 +20,13 @@ from pyicloud.exceptions import (
     PyiCloud2SARequiredError,
     PyiCloudServiceNotActivatedErrror
 )
-from pyicloud.services import (
-    FindMyiPhoneServiceManager,
-    CalendarService,
-    UbiquityService,
-    ContactsService,
-    RemindersService,
-    PhotosService,
-    AccountService
+from pyicloud.services.findmyiphone import FindMyiPhoneServiceManager
+from pyicloud.ratelimit import (
+    PRIORITY_HIGH,
+    RateLimiter,
+    THROTTLE_STATUS_CODES
 )
+from pyicloud.transport import TransportPolicy
 from pyicloud.utils import get_password_from_keyring
 
 if six.PY3:
@@ -35,6 +37,8 @@ else:
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_POOL_SIZE = 10  # connections per host
+
 
 class PyiCloudPasswordFilter(logging.Filter):
     def __init__(self, password):
@@ -49,11 +53,80 @@ class PyiCloudPasswordFilter(logging.Filter):
         return True
 
 
+class PyiCloudCookieJar(cookielib.LWPCookieJar):
+    """ A cookie jar which can be shared by threads.
+
+    The cookies are iterated over a copy, taken while holding the lock of
+    the jar, as requests iterates over the jar for every request while
+    other requests add their cookies. The jar is saved to a temporary file
+    which then replaces the cookie file, so the cookie file is never
+    partially written, not even by concurrent saves.
+    """
+
+    def __iter__(self):
+        with self._cookies_lock:
+            return iter(list(cookielib.LWPCookieJar.__iter__(self)))
+
+    def save(self, filename=None, ignore_discard=False, ignore_expires=False):
+        if filename is None:
+            filename = self.filename
+        if filename is None:
+            raise ValueError(cookielib.MISSING_FILENAME_TEXT)
+
+        fd, temp_filename = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(filename)),
+            prefix='.cookies-'
+        )
+        os.close(fd)
+        try:
+            with self._cookies_lock:
+                cookielib.LWPCookieJar.save(
+                    self, temp_filename, ignore_discard, ignore_expires
+                )
+            if six.PY3:
+                os.replace(temp_filename, filename)
+            else:
+                if sys.platform == 'win32' and os.path.exists(filename):
+                    os.remove(filename)
+                os.rename(temp_filename, filename)
+        except:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
+
+
 class PyiCloudSession(requests.Session):
-    def __init__(self, service):
+    """ The session used for all requests to iCloud.
+
+    Every request gets the timeouts and deadline of its endpoint, which can
+    be overridden with the `timeout` and `deadline` arguments, and failed
+    requests are retried when that is safe, see `TransportPolicy`.
+
+    Responses are compressed if the server supports it. Successful
+    responses of requests with `stream=True` are returned without reading
+    their body, to be decoded while they are received, see
+    `pyicloud.jsonstream`. The caller must read or close them, or their
+    connection is not returned to the pool.
+
+    A session can be shared by threads making requests concurrently: the
+    cookie jar is locked, the rate limiter is thread-safe, and at most
+    `pool_size` connections are opened per host, any further request waits
+    for a free connection. Changing the session itself, e.g. its headers or
+    cookie jar, and authenticating again are not thread-safe, and must not
+    be done while other threads use the session.
+    """
+
+    def __init__(self, service, pool_size=DEFAULT_POOL_SIZE):
         self.service = service
         super(PyiCloudSession, self).__init__()
 
+        adapter = HTTPAdapter(
+            pool_maxsize=pool_size,
+            pool_block=True
+        )
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
     def request(self, *args, **kwargs):
 
         # Charge logging to the right service endpoint
@@ -65,25 +138,105 @@ class PyiCloudSession(requests.Session):
 
         logger.debug("%s %s %s", args[0], args[1], kwargs.get('data', ''))
 
-        response = super(PyiCloudSession, self).request(*args, **kwargs)
+        rate_limiter = self.service.rate_limiter
+        transport = self.service.transport
+        endpoint = rate_limiter.endpoint_for_url(args[1])
+        deadline = time.time() + kwargs.pop(
+            'deadline', transport.deadline(endpoint)
+        )
+        timeout = kwargs.pop('timeout', None)
+
+        attempt = 0
+        while True:
+            # a retry may wait for a token until the deadline
+            rate_limiter.acquire(
+                endpoint, max_wait=max(deadline - time.time(), 0)
+                if attempt else 0
+            )
+            try:
+                response = super(PyiCloudSession, self).request(
+                    *args,
+                    timeout=timeout or transport.timeout(
+                        endpoint, deadline - time.time()
+                    ),
+                    **kwargs
+                )
+                error = None
+            except (requests.ConnectionError, requests.Timeout) as e:
+                response = None
+                error = e
+
+            status_code = None if response is None else response.status_code
+            retry_delay = transport.retry_delay(
+                args[0], endpoint, attempt, deadline - time.time(),
+                error=error,
+                status_code=status_code
+            )
+            if retry_delay is not None and time.time() + max(
+                retry_delay, rate_limiter.wait_time(endpoint, PRIORITY_HIGH)
+            ) >= deadline:
+                # the retry could not start before the deadline
+                retry_delay = None
+            if retry_delay is None:
+                if error is not None:
+                    raise error
+                break
+            logger.warning(
+                "%s %s failed (%s), retrying in %.1f seconds",
+                args[0], endpoint, error or status_code, retry_delay
+            )
+            if response is not None:
+                response.close()
+            time.sleep(retry_delay)
+            attempt += 1
+
+        # a response is counted as throttled once, by its status code or
+        # its error code
+        throttled = response.status_code in THROTTLE_STATUS_CODES
+        if throttled:
+            rate_limiter.throttled(endpoint)
+
+        if kwargs.get('stream') and response.ok:
+            # the body is decoded by the caller while it is received, which
+            # checks a body without the expected data with `check_json`
+            rate_limiter.succeeded(endpoint)
+            response.check_json = lambda json: self._check_json(
+                json, endpoint
+            )
+            return response
 
         content_type = response.headers.get('Content-Type', '').split(';')[0]
         json_mimetypes = ['application/json', 'text/json']
 
         if not response.ok and content_type not in json_mimetypes:
+            # a streamed body is not read, so the connection is released
+            response.close()
             self._raise_error(response.status_code, response.reason)
 
         if content_type not in json_mimetypes:
+            rate_limiter.succeeded(endpoint)
             return response
 
         try:
             json = response.json()
         except:
             logger.warning('Failed to parse response with JSON mimetype')
+            if not throttled:
+                rate_limiter.succeeded(endpoint)
             return response
 
         logger.debug(json)
 
+        if self._check_json(json, endpoint, throttled):
+            throttled = True
+
+        if not throttled:
+            rate_limiter.succeeded(endpoint)
+        return response
+
+    def _check_json(self, json, endpoint, throttled=False):
+        """ Raises the error of a JSON response, if it has one. Returns
+        whether the response was throttled, which is counted once. """
         reason = json.get('errorMessage')
         reason = reason or json.get('reason')
         reason = reason or json.get('errorReason')
@@ -96,10 +249,13 @@ class PyiCloudSession(requests.Session):
         if not code and json.get('serverErrorCode'):
             code = json.get('serverErrorCode')
 
+        if code == 'ACCESS_DENIED' and not throttled:
+            self.service.rate_limiter.throttled(endpoint)
+            throttled = True
+
         if reason:
             self._raise_error(code, reason)
-
-        return response
+        return throttled
 
     def _raise_error(self, code, reason):
         if self.service.requires_2sa and \
@@ -130,22 +286,47 @@ class PyiCloudService(object):
     Usage:
         from pyicloud import PyiCloudService
         pyicloud = PyiCloudService('username@apple.com', 'password')
+        pyicloud.devices.refresh_client()
         pyicloud.iphone.location()
+
+    Requests are limited per endpoint by `rate_limits`, a dict of
+    endpoint name to (requests, seconds), and not limited by default. A
+    request over its limit is not delayed, but raises
+    `PyiCloudRateLimitExceeded`. See `pyicloud.ratelimit`. The
+    timeouts and retries of the requests are decided by `transport`, a
+    `pyicloud.transport.TransportPolicy`.
+
+    One instance can be used by several threads, see `PyiCloudSession`
+    for the details. `pool_size` is the number of connections per host, and
+    should be at least the number of threads using the instance.
+
+    Services are created once per session, and only request data when it
+    is used, so accessing e.g. `pyicloud.devices` repeatedly is cheap. Use
+    their refresh methods to update the data, the devices are only loaded
+    by `pyicloud.devices.refresh_client()`. Except for 'Find my iPhone',
+    the services, and their dependencies, are only imported when first
+    used.
     """
 
     def __init__(
-        self, apple_id, password=None, cookie_directory=None, verify=True
+        self, apple_id, password=None, cookie_directory=None, verify=True,
+        rate_limits=None, pool_size=DEFAULT_POOL_SIZE, transport=None
     ):
         if password is None:
             password = get_password_from_keyring(apple_id)
 
         self.data = {}
+        self._services = {}
+        self._services_lock = threading.Lock()
         self.client_id = str(uuid.uuid1()).upper()
         self.user = {'apple_id': apple_id, 'password': password}
 
         self._password_filter = PyiCloudPasswordFilter(password)
         logger.addFilter(self._password_filter)
 
+        self.rate_limiter = RateLimiter.for_account(apple_id, rate_limits)
+        self.transport = transport or TransportPolicy()
+
         self._home_endpoint = 'https://www.icloud.com'
         self._setup_endpoint = 'https://setup.icloud.com/setup/ws/1'
 
@@ -161,16 +342,17 @@ class PyiCloudService(object):
                 'pyicloud',
             )
 
-        self.session = PyiCloudSession(self)
+        self.session = PyiCloudSession(self, pool_size)
         self.session.verify = verify
         self.session.headers.update({
             'Origin': self._home_endpoint,
             'Referer': '%s/' % self._home_endpoint,
-            'User-Agent': 'Opera/9.52 (X11; Linux i686; U; en)'
+            'User-Agent': 'Opera/9.52 (X11; Linux i686; U; en)',
+            'Accept-Encoding': 'gzip, deflate'
         })
 
         cookiejar_path = self._get_cookiejar_path()
-        self.session.cookies = cookielib.LWPCookieJar(filename=cookiejar_path)
+        self.session.cookies = PyiCloudCookieJar(filename=cookiejar_path)
         if os.path.exists(cookiejar_path):
             try:
                 self.session.cookies.load()
@@ -208,7 +390,6 @@ class PyiCloudService(object):
             req = self.session.post(
                 self._base_login_url,
                 params=self.params,
-                timeout=30,
                 data=json.dumps(data)
             )
         except PyiCloudAPIResponseError as error:
@@ -218,13 +399,20 @@ class PyiCloudService(object):
         resp = req.json()
         self.params.update({'dsid': resp['dsInfo']['dsid']})
 
-        if not os.path.exists(self._cookie_directory):
+        try:
             os.mkdir(self._cookie_directory)
+        except OSError as error:
+            # e.g. created by another instance in the meantime
+            if error.errno != errno.EEXIST:
+                raise
         self.session.cookies.save()
         logger.debug("Cookies saved to %s", self._get_cookiejar_path())
 
         self.data = resp
         self.webservices = self.data['webservices']
+        # the service urls might have changed
+        with self._services_lock:
+            self._services = {}
 
         logger.info("Authentication completed successfully")
         logger.debug(self.params)
@@ -288,24 +476,33 @@ class PyiCloudService(object):
 
         return not self.requires_2sa
 
+    def _get_service(self, name, service_class, webservice):
+        """ Returns the service, which is created once per session.
+
+        Creating a service does not perform any request, the service loads
+        its data when it is first used.
+        """
+        with self._services_lock:
+            if name not in self._services:
+                service_root = self.webservices[webservice]['url']
+                self._services[name] = service_class(
+                    service_root,
+                    self.session,
+                    self.params
+                )
+            return self._services[name]
+
     @property
     def devices(self):
         """ Return all devices."""
-        service_root = self.webservices['findme']['url']
-        return FindMyiPhoneServiceManager(
-            service_root,
-            self.session,
-            self.params
+        return self._get_service(
+            'devices', FindMyiPhoneServiceManager, 'findme'
         )
 
     @property
     def account(self):
-        service_root = self.webservices['account']['url']
-        return AccountService(
-            service_root,
-            self.session,
-            self.params
-        )
+        from pyicloud.services.account import AccountService
+        return self._get_service('account', AccountService, 'account')
 
     @property
     def iphone(self):
@@ -313,40 +510,28 @@ class PyiCloudService(object):
 
     @property
     def files(self):
-        if not hasattr(self, '_files'):
-            service_root = self.webservices['ubiquity']['url']
-            self._files = UbiquityService(
-                service_root,
-                self.session,
-                self.params
-            )
-        return self._files
+        from pyicloud.services.ubiquity import UbiquityService
+        return self._get_service('files', UbiquityService, 'ubiquity')
 
     @property
     def photos(self):
-        if not hasattr(self, '_photos'):
-            service_root = self.webservices['ckdatabasews']['url']
-            self._photos = PhotosService(
-                service_root,
-                self.session,
-                self.params
-            )
-        return self._photos
+        from pyicloud.services.photos import PhotosService
+        return self._get_service('photos', PhotosService, 'ckdatabasews')
 
     @property
     def calendar(self):
-        service_root = self.webservices['calendar']['url']
-        return CalendarService(service_root, self.session, self.params)
+        from pyicloud.services.calendar import CalendarService
+        return self._get_service('calendar', CalendarService, 'calendar')
 
     @property
     def contacts(self):
-        service_root = self.webservices['contacts']['url']
-        return ContactsService(service_root, self.session, self.params)
+        from pyicloud.services.contacts import ContactsService
+        return self._get_service('contacts', ContactsService, 'contacts')
 
     @property
     def reminders(self):
-        service_root = self.webservices['reminders']['url']
-        return RemindersService(service_root, self.session, self.params)
+        from pyicloud.services.reminders import RemindersService
+        return self._get_service('reminders', RemindersService, 'reminders')
 
     def __unicode__(self):
         return 'iCloud API: %s' % self.user.get('apple_id')
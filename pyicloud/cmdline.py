@@ -6,13 +6,28 @@ command line scripts, and related.
 """
 from __future__ import print_function
 import argparse
-import pickle
+import json
+import os
 import sys
+import tempfile
 
+import six
 from click import confirm
 
 import pyicloud
 from . import utils
+from .daemon import (
+    DEFAULT_MAX_AGE,
+    DEFAULT_SOCKET_PATH,
+    DaemonClient,
+    DeviceDaemon,
+    PyiCloudDaemonError,
+    PyiCloudDaemonUnavailable,
+)
+from .services.findmyiphone import LOCATE_ALL
+
+
+DEFAULT_SNAPSHOT_FILE = 'devices.fmip_snapshot'
 
 
 DEVICE_ERROR = (
@@ -20,19 +35,153 @@ DEVICE_ERROR = (
 )
 
 
-def create_pickled_data(idevice, filename):
-    """This helper will output the idevice to a pickled file named
-    after the passed filename.
+def write_snapshot(idevices, filename):
+    """Writes the data of the idevices to one compact JSON file, as a
+    list of their contents.
+
+    The file is replaced at once, so readers never see a partial
+    snapshot. This allows the data to be used without resorting to
+    screen / pipe scrapping."""
+    directory = os.path.dirname(os.path.abspath(filename))
+    handle, temporary_filename = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(handle, 'w') as snapshot_file:
+            json.dump(
+                [idevice.content for idevice in idevices], snapshot_file,
+                separators=(',', ':')
+            )
+        # readable like any file created by this user, not only by them
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temporary_filename, 0o666 & ~umask)
+        if six.PY3:
+            os.replace(temporary_filename, filename)
+        else:
+            if sys.platform == 'win32' and os.path.exists(filename):
+                os.remove(filename)
+            os.rename(temporary_filename, filename)
+    except:
+        if os.path.exists(temporary_filename):
+            os.remove(temporary_filename)
+        raise
+
+
+def login(parser, command_line, password):
+    """Logs in, asking for the password and two-step authentication
+    code when needed, and returns the api"""
+    username = command_line.username
+    failure_count = 0
+    while True:
+        # Which password we use is determined by your username, so we
+        # do need to check for this first and separately.
+        if not username:
+            parser.error('No username supplied')
 
-    This allows the data to be used without resorting to screen / pipe
-    scrapping.  """
-    data = {}
-    for x in idevice.content:
-        data[x] = idevice.content[x]
-    location = filename
-    pickle_file = open(location, 'wb')
-    pickle.dump(data, pickle_file, protocol=pickle.HIGHEST_PROTOCOL)
-    pickle_file.close()
+        if not password:
+            password = utils.get_password(
+                username,
+                interactive=command_line.interactive
+            )
+
+        if not password:
+            parser.error('No password supplied')
+
+        try:
+            api = pyicloud.PyiCloudService(
+                username.strip(),
+                password.strip()
+            )
+            if (
+                not utils.password_exists_in_keyring(username) and
+                command_line.interactive and
+                confirm("Save password in keyring? ")
+            ):
+                utils.store_password_in_keyring(username, password)
+
+            if api.requires_2sa:
+                import click
+                print("Two-step authentication required.",
+                      "Your trusted devices are:")
+
+                devices = api.trusted_devices
+                for i, device in enumerate(devices):
+                    print("  %s: %s" % (
+                        i, device.get(
+                            'deviceName',
+                            "SMS to %s" % device.get('phoneNumber'))))
+
+                device = click.prompt('Which device would you like to use?',
+                                      default=0)
+                device = devices[device]
+                if not api.send_verification_code(device):
+                    print("Failed to send verification code")
+                    sys.exit(1)
+
+                code = click.prompt('Please enter validation code')
+                if not api.validate_verification_code(device, code):
+                    print("Failed to verify verification code")
+                    sys.exit(1)
+
+            return api
+        except pyicloud.exceptions.PyiCloudFailedLoginException:
+            # If they have a stored password; we just used it and
+            # it did not work; let's delete it if there is one.
+            if utils.password_exists_in_keyring(username):
+                utils.delete_password_in_keyring(username)
+
+            message = "Bad username or password for {username}".format(
+                username=username,
+            )
+            password = None
+
+            failure_count += 1
+            if failure_count >= 3:
+                raise RuntimeError(message)
+
+            print(message, file=sys.stderr)
+
+
+def exit_daemon_failed(error):
+    """Reports a failed request to the daemon, which is not done again,
+    as the daemon may have done it"""
+    print(
+        "The daemon failed: %s. Use --direct to log in instead" % error,
+        file=sys.stderr
+    )
+    sys.exit(1)
+
+
+def get_devices_from_daemon(command_line):
+    """Returns the devices of a running daemon of the account, or None
+    if there is no daemon to use"""
+    if not command_line.username:
+        return None
+    client = DaemonClient(
+        command_line.username.strip(), command_line.socket_path
+    )
+    try:
+        return client.devices(command_line.locate, command_line.max_age)
+    except PyiCloudDaemonUnavailable:
+        return None
+    except PyiCloudDaemonError as error:
+        exit_daemon_failed(error)
+
+
+def device_action(dev, action, direct_device, **arguments):
+    """Does the action on the device. When the device is one of a daemon
+    which did not handle the action, it is done on the device returned by
+    `direct_device(dev)` instead, of a session of this run. When the daemon
+    failed, the action is not done again."""
+    try:
+        getattr(dev, action)(**arguments)
+    except PyiCloudDaemonUnavailable as error:
+        print(
+            "The daemon could not do the action (%s), logging in" % error,
+            file=sys.stderr
+        )
+        getattr(direct_device(dev), action)(**arguments)
+    except PyiCloudDaemonError as error:
+        exit_daemon_failed(error)
 
 
 def main(args=None):
@@ -163,13 +312,62 @@ def main(args=None):
         help="Forcibly display this message when activating lost mode.",
     )
 
-    #   Output device data to an pickle file
+    #   Output device data to a snapshot file
     parser.add_argument(
         "--outputfile",
-        action="store_true",
+        action="store",
+        nargs="?",
+        const=DEFAULT_SNAPSHOT_FILE,
         dest="output_to_file",
         default="",
-        help="Save device data to a file in the current directory.",
+        help=(
+            "Save the data of the devices to one JSON file "
+            "(default: %s in the current directory)." % DEFAULT_SNAPSHOT_FILE
+        ),
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        dest="json",
+        default=False,
+        help="Print the data of each device as one line of JSON.",
+    )
+
+    #   Share one session between runs
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        dest="daemon",
+        default=False,
+        help=(
+            "Log in and keep serving the devices to the other runs, "
+            "which then use this session instead of logging in."
+        ),
+    )
+    parser.add_argument(
+        "--direct",
+        action="store_true",
+        dest="direct",
+        default=False,
+        help="Log in, even when a daemon is running.",
+    )
+    parser.add_argument(
+        "--socket",
+        action="store",
+        dest="socket_path",
+        default=DEFAULT_SOCKET_PATH,
+        help="Unix socket of the daemon (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-age",
+        action="store",
+        dest="max_age",
+        type=int,
+        default=DEFAULT_MAX_AGE,
+        help=(
+            "Use the devices of the daemon when refreshed at most this "
+            "many seconds ago (default: %(default)s)"
+        ),
     )
 
     command_line = parser.parse_args(args)
@@ -180,174 +378,136 @@ def main(args=None):
     if username and command_line.delete_from_keyring:
         utils.delete_password_in_keyring(username)
 
-    failure_count = 0
-    while True:
-        # Which password we use is determined by your username, so we
-        # do need to check for this first and separately.
-        if not username:
-            parser.error('No username supplied')
-
-        if not password:
-            password = utils.get_password(
-                username,
-                interactive=command_line.interactive
-            )
-
-        if not password:
-            parser.error('No password supplied')
-
-        try:
-            api = pyicloud.PyiCloudService(
-                username.strip(),
-                password.strip()
-            )
-            if (
-                not utils.password_exists_in_keyring(username) and
-                command_line.interactive and
-                confirm("Save password in keyring? ")
-            ):
-                utils.store_password_in_keyring(username, password)
-
-            if api.requires_2sa:
-                import click
-                print("Two-step authentication required.",
-                      "Your trusted devices are:")
-
-                devices = api.trusted_devices
-                for i, device in enumerate(devices):
-                    print("  %s: %s" % (
-                        i, device.get(
-                            'deviceName',
-                            "SMS to %s" % device.get('phoneNumber'))))
-
-                device = click.prompt('Which device would you like to use?',
-                                      default=0)
-                device = devices[device]
-                if not api.send_verification_code(device):
-                    print("Failed to send verification code")
-                    sys.exit(1)
-
-                code = click.prompt('Please enter validation code')
-                if not api.validate_verification_code(device, code):
-                    print("Failed to verify verification code")
-                    sys.exit(1)
-
-            break
-        except pyicloud.exceptions.PyiCloudFailedLoginException:
-            # If they have a stored password; we just used it and
-            # it did not work; let's delete it if there is one.
-            if utils.password_exists_in_keyring(username):
-                utils.delete_password_in_keyring(username)
-
-            message = "Bad username or password for {username}".format(
-                username=username,
-            )
-            password = None
-
-            failure_count += 1
-            if failure_count >= 3:
-                raise RuntimeError(message)
-
-            print(message, file=sys.stderr)
-
-    for dev in api.devices:
-        if (
-            not command_line.device_id or
-            (
-                command_line.device_id.strip().lower() ==
-                dev.content["id"].strip().lower()
-            )
-        ):
-            #   List device(s)
-            if command_line.locate:
-                dev.location()
-
-            if command_line.output_to_file:
-                create_pickled_data(
-                    dev,
-                    filename=(
-                        dev.content["name"].strip().lower() + ".fmip_snapshot"
+    devices = None
+    if not command_line.daemon and not command_line.direct:
+        devices = get_devices_from_daemon(command_line)
+    if devices is None:
+        api = login(parser, command_line, password)
+        if command_line.daemon:
+            DeviceDaemon(api, command_line.socket_path).serve_forever()
+            return
+        devices = api.devices
+        # a single request locates the selected devices, or only returns
+        # the last known locations
+        locate = None
+        if command_line.locate:
+            locate = command_line.device_id.strip() \
+                if command_line.device_id else LOCATE_ALL
+        devices.refresh_client(locate=locate)
+        if locate not in (None, LOCATE_ALL):
+            # the devices are selected by their id regardless of case, but
+            # only the exact id is located
+            device_ids = [dev.content["id"] for dev in devices]
+            matches = [
+                device_id for device_id in device_ids
+                if device_id.strip().lower() == locate.lower()
+            ]
+            if matches and locate not in device_ids:
+                devices.refresh_client(locate=matches[0])
+
+    def direct_device(dev):
+        api = login(parser, command_line, password)
+        api.devices.refresh_client(locate=None)
+        return api.devices[dev.content["id"]]
+
+    selected_devices = [
+        dev for dev in devices
+        if not command_line.device_id or (
+            command_line.device_id.strip().lower() ==
+            dev.content["id"].strip().lower()
+        )
+    ]
+    if command_line.output_to_file:
+        write_snapshot(selected_devices, command_line.output_to_file)
+
+    for dev in selected_devices:
+        #   List device(s)
+        if command_line.json:
+            print(json.dumps(dev.content, sort_keys=True))
+            # each device is available to a reader at once
+            sys.stdout.flush()
+
+        contents = dev.content
+        if command_line.longlist:
+            print("-"*30)
+            print(contents["name"])
+            for x in contents:
+                print("%20s - %s" % (x, contents[x]))
+        elif command_line.list:
+            print("-"*30)
+            print("Name - %s" % contents["name"])
+            print("Display Name  - %s" % contents["deviceDisplayName"])
+            print("Location      - %s" % contents["location"])
+            print("Battery Level - %s" % contents["batteryLevel"])
+            print("Battery Status- %s" % contents["batteryStatus"])
+            print("Device Class  - %s" % contents["deviceClass"])
+            print("Device Model  - %s" % contents["deviceModel"])
+
+        #   Play a Sound on a device
+        if command_line.sound:
+            if command_line.device_id:
+                device_action(dev, 'play_sound', direct_device)
+            else:
+                raise RuntimeError(
+                    "\n\n\t\t%s %s\n\n" % (
+                        "Sounds can only be played on a singular device.",
+                        DEVICE_ERROR
                     )
                 )
 
-            contents = dev.content
-            if command_line.longlist:
-                print("-"*30)
-                print(contents["name"])
-                for x in contents:
-                    print("%20s - %s" % (x, contents[x]))
-            elif command_line.list:
-                print("-"*30)
-                print("Name - %s" % contents["name"])
-                print("Display Name  - %s" % contents["deviceDisplayName"])
-                print("Location      - %s" % contents["location"])
-                print("Battery Level - %s" % contents["batteryLevel"])
-                print("Battery Status- %s" % contents["batteryStatus"])
-                print("Device Class  - %s" % contents["deviceClass"])
-                print("Device Model  - %s" % contents["deviceModel"])
-
-            #   Play a Sound on a device
-            if command_line.sound:
-                if command_line.device_id:
-                    dev.play_sound()
-                else:
-                    raise RuntimeError(
-                        "\n\n\t\t%s %s\n\n" % (
-                            "Sounds can only be played on a singular device.",
-                            DEVICE_ERROR
-                        )
-                    )
-
-            #   Display a Message on the device
-            if command_line.message:
-                if command_line.device_id:
-                    dev.display_message(
-                        subject='A Message',
-                        message=command_line.message,
-                        sounds=True
-                    )
-                else:
-                    raise RuntimeError(
-                        "%s %s" % (
-                            "Messages can only be played "
-                            "on a singular device.",
-                            DEVICE_ERROR
-                        )
+        #   Display a Message on the device
+        if command_line.message:
+            if command_line.device_id:
+                device_action(
+                    dev, 'display_message', direct_device,
+                    subject='A Message',
+                    message=command_line.message,
+                    sounds=True
+                )
+            else:
+                raise RuntimeError(
+                    "%s %s" % (
+                        "Messages can only be played "
+                        "on a singular device.",
+                        DEVICE_ERROR
                     )
+                )
 
-            #   Display a Silent Message on the device
-            if command_line.silentmessage:
-                if command_line.device_id:
-                    dev.display_message(
-                        subject='A Silent Message',
-                        message=command_line.silentmessage,
-                        sounds=False
-                    )
-                else:
-                    raise RuntimeError(
-                        "%s %s" % (
-                            "Silent Messages can only be played "
-                            "on a singular device.",
-                            DEVICE_ERROR
-                        )
+        #   Display a Silent Message on the device
+        if command_line.silentmessage:
+            if command_line.device_id:
+                device_action(
+                    dev, 'display_message', direct_device,
+                    subject='A Silent Message',
+                    message=command_line.silentmessage,
+                    sounds=False
+                )
+            else:
+                raise RuntimeError(
+                    "%s %s" % (
+                        "Silent Messages can only be played "
+                        "on a singular device.",
+                        DEVICE_ERROR
                     )
+                )
 
-            #   Enable Lost mode
-            if command_line.lostmode:
-                if command_line.device_id:
-                    dev.lost_device(
-                        number=command_line.lost_phone.strip(),
-                        text=command_line.lost_message.strip(),
-                        newpasscode=command_line.lost_password.strip()
-                    )
-                else:
-                    raise RuntimeError(
-                        "%s %s" % (
-                            "Lost Mode can only be activated "
-                            "on a singular device.",
-                            DEVICE_ERROR
-                        )
+        #   Enable Lost mode
+        if command_line.lostmode:
+            if command_line.device_id:
+                device_action(
+                    dev, 'lost_device', direct_device,
+                    number=command_line.lost_phone.strip(),
+                    text=command_line.lost_message.strip(),
+                    newpasscode=command_line.lost_password.strip()
+                )
+            else:
+                raise RuntimeError(
+                    "%s %s" % (
+                        "Lost Mode can only be activated "
+                        "on a singular device.",
+                        DEVICE_ERROR
                     )
+                )
 
 if __name__ == '__main__':
     main()
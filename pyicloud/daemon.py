@@ -0,0 +1,294 @@
+""" Shares one logged in session between runs of the command line tool.
+
+A daemon (`pyicloud --daemon`) logs in once and answers requests on a
+Unix socket, with the devices of its session. Devices are only refreshed
+when the last refresh is older than the `max_age` of a request, so runs
+from e.g. cron share one refresh instead of each logging in and
+refreshing.
+
+The protocol is one JSON request per connection, answered by one JSON
+response, each on a single line. Every request names the Apple ID it is
+for, so a daemon of another account is not used by mistake. A request
+which the daemon did not handle at all is answered with an error marked
+`unavailable`, so the client can do it itself.
+"""
+import errno
+import getpass
+import json
+import logging
+import os
+import socket
+import stat
+import tempfile
+import threading
+import time
+
+from six.moves import socketserver
+
+from pyicloud.exceptions import PyiCloudAPIResponseError, PyiCloudException
+from pyicloud.services.findmyiphone import LOCATE_ALL
+
+
+logger = logging.getLogger(__name__)
+
+# in a directory of the user, which only the user can use
+DEFAULT_SOCKET_PATH = os.path.join(
+    tempfile.gettempdir(), 'pyicloud-%s' % getpass.getuser(), 'daemon.sock'
+)
+DEFAULT_MAX_AGE = 60  # seconds
+CLIENT_TIMEOUT = 120  # seconds, long enough for a locate refresh
+AUTH_ERROR_CODES = (401, 421, 450)
+DEVICE_ACTIONS = ('play_sound', 'display_message', 'lost_device')
+
+
+class PyiCloudDaemonUnavailable(PyiCloudException):
+    """ No daemon handled the request, so it can be done directly. """
+    pass
+
+
+class PyiCloudDaemonError(PyiCloudException):
+    """ The daemon received the request, but failed, or did not answer in
+    time. It may have done (part of) the request, so it is not safe to do
+    it again. """
+    pass
+
+
+def _unavailable(message):
+    """ Returns the response to a request which was not handled. """
+    return {'error': message, 'unavailable': True}
+
+
+def check_socket_directory(directory):
+    """ Raises `PyiCloudException` unless the directory of the socket is
+    owned by the user and can only be used by the user, so no other user
+    can serve or replace the socket. """
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or \
+            info.st_mode & 0o077:
+        raise PyiCloudException(
+            "The socket directory %s must be a directory of this user, "
+            "with mode 0700" % directory
+        )
+
+
+def is_serving(socket_path):
+    """ Returns whether a daemon answers on the socket. """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        connection.close()
+
+
+class DeviceDaemon(object):
+    """ Answers the requests of the command line tool with the devices of
+    the logged in `api`.
+
+    Requests are handled by a thread each. Concurrent requests share the
+    refresh: only the first one refreshes, the others wait for it and use
+    its result.
+    """
+
+    def __init__(self, api, socket_path=DEFAULT_SOCKET_PATH):
+        self.api = api
+        self.socket_path = socket_path
+        self.server = None
+        self._refresh_lock = threading.Lock()
+        self._refreshed_timestamp = None
+        self._located_timestamp = None
+
+    def get_devices(self, locate=False, max_age=DEFAULT_MAX_AGE):
+        """ Returns the contents of the devices, refreshed at most `max_age`
+        seconds ago, and actively located when `locate` is set."""
+        with self._refresh_lock:
+            last_refresh = self._located_timestamp if locate \
+                else self._refreshed_timestamp
+            if last_refresh is None or time.time() - last_refresh > max_age:
+                self._refresh(locate)
+            return [dict(device.content) for device in self.api.devices]
+
+    def _refresh(self, locate):
+        refresh_timestamp = time.time()
+        try:
+            self.api.devices.refresh_client(
+                locate=LOCATE_ALL if locate else None
+            )
+        except PyiCloudAPIResponseError as error:
+            if error.code not in AUTH_ERROR_CODES:
+                raise
+            # the session expired while the daemon was idle
+            logger.info("Session expired, logging in again")
+            self.api.authenticate()
+            self.api.devices.refresh_client(
+                locate=LOCATE_ALL if locate else None
+            )
+        self._refreshed_timestamp = refresh_timestamp
+        if locate:
+            self._located_timestamp = refresh_timestamp
+
+    def handle(self, request):
+        if request.get('apple_id') != self.api.user['apple_id']:
+            return _unavailable("The daemon is logged in to another account")
+        command = request.get('command')
+        if command == 'devices':
+            return {'devices': self.get_devices(
+                request.get('locate', False),
+                request.get('max_age', DEFAULT_MAX_AGE)
+            )}
+        if command in DEVICE_ACTIONS:
+            device = self.api.devices.get_by_id(request['device'])
+            if device is None:
+                return _unavailable("Unknown device %r" % request['device'])
+            getattr(device, command)(**request.get('arguments', {}))
+            return {}
+        return _unavailable("Unknown command %r" % command)
+
+    def serve_forever(self):
+        """ Serves until `shutdown`. Raises `PyiCloudException` when the
+        socket directory is not safe, or another daemon is serving on the
+        socket. """
+        directory = os.path.dirname(self.socket_path)
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        check_socket_directory(directory)
+        if os.path.exists(self.socket_path):
+            if is_serving(self.socket_path):
+                raise PyiCloudException(
+                    "A daemon is already serving on %s" % self.socket_path
+                )
+            # left behind by a daemon which did not stop cleanly
+            os.remove(self.socket_path)
+
+        # only this user can use the session
+        umask = os.umask(0o077)
+        try:
+            self.server = _UnixServer(self.socket_path, _RequestHandler)
+        finally:
+            os.umask(umask)
+        self.server.daemon = self
+        logger.info("Serving on %s", self.socket_path)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.remove(self.socket_path)
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            response = self.server.daemon.handle(request)
+        except Exception as error:
+            logger.exception("Request failed")
+            response = {'error': "%s: %s" % (type(error).__name__, error)}
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class DaemonClient(object):
+    """ Sends requests to a running daemon of the Apple ID.
+
+    Raises `PyiCloudDaemonUnavailable` when no daemon is running, when its
+    socket directory is not safe, or when it did not handle the request,
+    so the caller can do the request itself. Once the daemon accepted the
+    connection, any other failure raises `PyiCloudDaemonError`, as the
+    request may have been done.
+    """
+
+    def __init__(
+        self, apple_id, socket_path=DEFAULT_SOCKET_PATH,
+        timeout=CLIENT_TIMEOUT
+    ):
+        self.apple_id = apple_id
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def request(self, command, **fields):
+        fields.update({'apple_id': self.apple_id, 'command': command})
+        try:
+            check_socket_directory(os.path.dirname(self.socket_path))
+        except (OSError, PyiCloudException) as error:
+            raise PyiCloudDaemonUnavailable(str(error))
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(self.timeout)
+        try:
+            try:
+                connection.connect(self.socket_path)
+            except (socket.error, IOError) as error:
+                raise PyiCloudDaemonUnavailable(str(error))
+            try:
+                connection.sendall(
+                    json.dumps(fields).encode('utf-8') + b'\n'
+                )
+                response = connection.makefile('rb').readline()
+            except (socket.error, IOError) as error:
+                raise PyiCloudDaemonError(
+                    "No response from daemon: %s" % error
+                )
+        finally:
+            connection.close()
+        try:
+            response = json.loads(response.decode('utf-8'))
+        except ValueError:
+            raise PyiCloudDaemonError("Invalid response from daemon")
+        if 'error' in response:
+            if response.get('unavailable'):
+                raise PyiCloudDaemonUnavailable(response['error'])
+            raise PyiCloudDaemonError(response['error'])
+        return response
+
+    def devices(self, locate=False, max_age=DEFAULT_MAX_AGE):
+        response = self.request('devices', locate=locate, max_age=max_age)
+        return [
+            RemoteDevice(self, content) for content in response['devices']
+        ]
+
+
+class RemoteDevice(object):
+    """ A device of the daemon, with the actions of `AppleDevice`. """
+
+    def __init__(self, client, content):
+        self.client = client
+        self.content = content
+
+    def _action(self, command, **arguments):
+        self.client.request(
+            command, device=self.content['id'], arguments=arguments
+        )
+
+    def play_sound(self, subject='Find My iPhone Alert'):
+        self._action('play_sound', subject=subject)
+
+    def display_message(
+        self, subject='Find My iPhone Alert', message="This is a note",
+        sounds=False
+    ):
+        self._action(
+            'display_message', subject=subject, message=message,
+            sounds=sounds
+        )
+
+    def lost_device(
+        self, number, text='This iPhone has been lost. Please call me.',
+        newpasscode=""
+    ):
+        self._action(
+            'lost_device', number=number, text=text, newpasscode=newpasscode
+        )
+
+    def __getitem__(self, key):
+        return self.content[key]
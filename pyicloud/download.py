@@ -0,0 +1,355 @@
+""" Downloads photos in parallel, resuming interrupted downloads.
+
+`DownloadManager` downloads a version of photos, e.g. from
+`api.photos.all`, to a directory with a pool of worker threads sharing
+the pooled session of the service. Every file is first written to a
+`.part` file next to it, which is renamed when complete, so the directory
+never contains a partial photo. After an interruption, the next run
+continues the `.part` files with HTTP Range requests, and skips the
+photos which were completed.
+
+Files larger than `split_size` are downloaded as ranges of that size on
+several workers at once, each range in a `.part<n>` file of its own,
+which are joined when all of them are complete.
+"""
+import logging
+import os
+import shutil
+import threading
+import time
+
+import requests
+from six.moves import queue
+
+from pyicloud.exceptions import PyiCloudException
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+DEFAULT_RETRIES = 3  # per range, for transfers interrupted while reading
+DEFAULT_REPORT_INTERVAL = 5  # seconds
+CHUNK_SIZE = 64 * 1024
+
+DOWNLOADED = 'downloaded'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+def default_path(photo, version):
+    """ Returns the name of the file of the version of a photo: its
+    filename, with the version before the extension unless it is the
+    original, e.g. `IMG_0001-thumb.JPG`."""
+    if version == 'original':
+        return photo.filename
+    name, extension = os.path.splitext(photo.filename)
+    return '%s-%s%s' % (name, version, extension)
+
+
+class DownloadProgress(object):
+    """ The progress of a `DownloadManager.download`.
+
+    `bytes_total` and `bytes_done` include the files and ranges which
+    were already downloaded by an earlier run, `bytes_downloaded` only
+    the bytes received by this run, of which the throughput is computed.
+    """
+
+    def __init__(self):
+        self.start_timestamp = time.time()
+        self.files_total = 0
+        self.files_done = 0
+        self.files_failed = 0
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.bytes_downloaded = 0
+        self.results = []  # (photo, path, outcome, error)
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start_timestamp
+
+    @property
+    def throughput(self):
+        """ The bytes received per second. """
+        return self.bytes_downloaded / max(self.elapsed, 0.001)
+
+    @property
+    def failed(self):
+        return [result for result in self.results if result[2] == FAILED]
+
+    def __str__(self):
+        return "%d/%d files, %d failed, %.1f/%.1f MB, %.2f MB/s" % (
+            self.files_done, self.files_total, self.files_failed,
+            self.bytes_done / 1e6, self.bytes_total / 1e6,
+            self.throughput / 1e6
+        )
+
+
+class _File(object):
+    """ A photo being downloaded, with its ranges. """
+
+    def __init__(self, photo, url, size, path, split_size):
+        self.photo = photo
+        self.url = url
+        self.size = size
+        self.path = path
+        self.error = None
+        if size and split_size and size > split_size:
+            self.ranges = [
+                _Range(self, start, min(split_size, size - start),
+                       '%s.part%d' % (path, index))
+                for index, start in enumerate(range(0, size, split_size))
+            ]
+        else:
+            self.ranges = [_Range(self, 0, size, path + '.part')]
+        self.pending = len(self.ranges)
+
+    def finish(self):
+        """ Joins the ranges into the file. The first range is cut to its
+        length first, so joining again after a crash gives the same file.
+        """
+        first = self.ranges[0]
+        with open(first.path, 'r+b') as output:
+            if len(self.ranges) > 1:
+                output.truncate(first.length)
+                output.seek(0, os.SEEK_END)
+                for part in self.ranges[1:]:
+                    with open(part.path, 'rb') as source:
+                        shutil.copyfileobj(source, output)
+            output.flush()
+            os.fsync(output.fileno())
+            size = output.tell() if len(self.ranges) > 1 \
+                else os.fstat(output.fileno()).st_size
+        if self.size is not None and size != self.size:
+            # the parts do not match, so the next run starts over
+            self.remove_parts()
+            raise PyiCloudException(
+                "Downloaded %d bytes instead of %d" % (size, self.size)
+            )
+        os.rename(first.path, self.path)
+        for part in self.ranges[1:]:
+            os.remove(part.path)
+
+    def remove_parts(self):
+        for part in self.ranges:
+            if os.path.exists(part.path):
+                os.remove(part.path)
+
+
+class _Range(object):
+    """ A range of a file, written to its own `.part` file. The `length`
+    is None when the size of the file is unknown. """
+
+    def __init__(self, target, start, length, path):
+        self.target = target
+        self.start = start
+        self.length = length
+        self.path = path
+
+    def existing(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+
+class DownloadManager(object):
+    """ Downloads photos with `workers` threads sharing `session`.
+
+    The session should be pooled with at least `workers` connections per
+    host, as `PyiCloudSession` is, or the workers wait for each other.
+    Photos are written to `directory`, named by `path_for(photo, version)`
+    (default: `default_path`). The `progress` callback, if given, is
+    called with the `DownloadProgress` at most every `report_interval`
+    seconds, and once when the download has finished.
+    """
+
+    def __init__(
+        self, session, directory, workers=DEFAULT_WORKERS, split_size=None,
+        retries=DEFAULT_RETRIES, path_for=default_path, progress=None,
+        report_interval=DEFAULT_REPORT_INTERVAL
+    ):
+        self.session = session
+        self.directory = directory
+        self.workers = workers
+        self.split_size = split_size
+        self.retries = retries
+        self.path_for = path_for
+        self.progress_callback = progress
+        self.report_interval = report_interval
+        self._lock = threading.Lock()
+        self._progress = None
+        self._reported_timestamp = 0
+
+    def download(self, photos, version='original'):
+        """ Downloads the version of the photos, and returns the
+        `DownloadProgress`. Photos which fail are logged and reported in
+        its `failed` results, the others are still downloaded. """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._progress = DownloadProgress()
+        # the photos are listed while the first ones are downloaded
+        tasks = queue.Queue(maxsize=self.workers * 2)
+        threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, args=(tasks,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            for photo in photos:
+                target = self._plan(photo, version)
+                if target is not None:
+                    for part in target.ranges:
+                        tasks.put(part)
+        finally:
+            for thread in threads:
+                tasks.put(None)
+            for thread in threads:
+                thread.join()
+        self._report(force=True)
+        return self._progress
+
+    def _plan(self, photo, version):
+        """ Returns the `_File` to download, or None if it is already
+        downloaded or has no such version. """
+        if version not in photo.versions:
+            return None
+        details = photo.versions[version]
+        path = os.path.join(self.directory, self.path_for(photo, version))
+        size = details.get('size')
+        with self._lock:
+            progress = self._progress
+            progress.files_total += 1
+            progress.bytes_total += size or 0
+            if os.path.exists(path) and \
+                    (size is None or os.path.getsize(path) == size):
+                progress.files_done += 1
+                progress.bytes_done += size or 0
+                progress.results.append((photo, path, SKIPPED, None))
+                return None
+        target = _File(photo, details['url'], size, path, self.split_size)
+        with self._lock:
+            for part in target.ranges:
+                progress.bytes_done += part.existing()
+        return target
+
+    def _work(self, tasks):
+        while True:
+            part = tasks.get()
+            if part is None:
+                return
+            target = part.target
+            if target.error is None:
+                try:
+                    self._download_range(part)
+                except Exception as error:
+                    logger.warning(
+                        "Unable to download %s: %s", target.path, error
+                    )
+                    target.error = error
+            with self._lock:
+                target.pending -= 1
+                if target.pending:
+                    continue
+            self._finish(target)
+
+    def _download_range(self, part):
+        attempt = 0
+        while True:
+            existing = part.existing()
+            if part.length is not None and existing >= part.length:
+                return
+            try:
+                self._request_range(part, existing)
+                return
+            except (
+                requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError
+            ) as error:
+                # the transfer broke off, it continues where it stopped
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+                logger.info(
+                    "Download of %s interrupted (%s), resuming",
+                    part.path, error
+                )
+
+    def _request_range(self, part, existing):
+        headers = {}
+        start = part.start + existing
+        if part.length is not None:
+            end = part.start + part.length - 1
+            if start > 0 or end < part.target.size - 1:
+                headers['Range'] = 'bytes=%d-%d' % (start, end)
+        elif start > 0:
+            headers['Range'] = 'bytes=%d-' % start
+
+        response = None
+        try:
+            response = self.session.get(
+                part.target.url, headers=headers, stream=True
+            )
+            if response.status_code not in (200, 206):
+                raise PyiCloudException(
+                    "Unexpected status %d" % response.status_code
+                )
+            mode = 'ab'
+            if 'Range' in headers and response.status_code != 206:
+                if len(part.target.ranges) > 1:
+                    raise PyiCloudException(
+                        "The server does not support range requests"
+                    )
+                # the whole file is sent, so it is written from the start
+                with self._lock:
+                    self._progress.bytes_done -= existing
+                mode = 'wb'
+            with open(part.path, mode) as output:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    output.write(chunk)
+                    with self._lock:
+                        self._progress.bytes_done += len(chunk)
+                        self._progress.bytes_downloaded += len(chunk)
+                    self._report()
+                output.flush()
+                os.fsync(output.fileno())
+        finally:
+            if response is not None:
+                response.close()
+
+    def _finish(self, target):
+        if target.error is None:
+            try:
+                target.finish()
+            except (PyiCloudException, IOError, OSError) as error:
+                logger.warning("Unable to save %s: %s", target.path, error)
+                target.error = error
+        with self._lock:
+            progress = self._progress
+            if target.error is None:
+                progress.files_done += 1
+                progress.results.append(
+                    (target.photo, target.path, DOWNLOADED, None)
+                )
+            else:
+                progress.files_failed += 1
+                progress.results.append(
+                    (target.photo, target.path, FAILED, target.error)
+                )
+        self._report()
+
+    def _report(self, force=False):
+        if self.progress_callback is None:
+            return
+        with self._lock:
+            now = time.time()
+            if not force and \
+                    now - self._reported_timestamp < self.report_interval:
+                return
+            self._reported_timestamp = now
+        try:
+            self.progress_callback(self._progress)
+        except Exception:
+            # a failing callback does not stop the worker which reports
+            logger.exception("The progress callback failed")
@@ -7,6 +7,13 @@ class PyiCloudNoDevicesException(PyiCloudException):
     pass
 
 
+class PyiCloudDevicesNotRefreshedException(PyiCloudException):
+    def __init__(self):
+        super(PyiCloudDevicesNotRefreshedException, self).__init__(
+            "The devices are not loaded yet, call refresh_client() first"
+        )
+
+
 class PyiCloudAPIResponseError(PyiCloudException):
     def __init__(self, reason, code):
         self.reason = reason
@@ -18,6 +25,16 @@ class PyiCloudAPIResponseError(PyiCloudException):
         super(PyiCloudAPIResponseError, self).__init__(message)
 
 
+class PyiCloudRateLimitExceeded(PyiCloudException):
+    def __init__(self, endpoint, wait_time):
+        self.endpoint = endpoint
+        self.wait_time = wait_time
+        message = "Rate limit of %s reached, retry in %.1f seconds" % (
+            endpoint, wait_time
+        )
+        super(PyiCloudRateLimitExceeded, self).__init__(message)
+
+
 class PyiCloudFailedLoginException(PyiCloudException):
     pass
 
@@ -0,0 +1,138 @@
+import codecs
+import itertools
+import json
+
+
+CHUNK_SIZE = 16 * 1024
+WHITESPACE = ' \t\n\r'
+# responses without the array up to this size are checked for errors
+MAX_SKIPPED_SIZE = 64 * 1024
+
+
+class _KeyScanner(object):
+    """ Finds the array of a key of the top-level JSON object, skipping the
+    text before it, which can be fed in parts."""
+
+    def __init__(self, key):
+        self.key = key
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.string = None
+        self.expect = None
+
+    def scan(self, text):
+        """ Returns the position in `text` just after the '[' of the array,
+        or None if the array does not start in `text`."""
+        for position, char in enumerate(text):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.string is not None and \
+                            ''.join(self.string) == self.key:
+                        self.expect = ':'
+                    continue
+                if self.string is not None:
+                    self.string.append(char)
+                continue
+
+            if char in WHITESPACE:
+                continue
+            if self.expect == ':' and char == ':':
+                self.expect = '['
+                continue
+            if self.expect == '[' and char == '[':
+                return position + 1
+            self.expect = None
+
+            if char == '"':
+                self.in_string = True
+                # only the keys of the top-level object are of interest
+                self.string = [] if self.depth == 1 else None
+            elif char in '{[':
+                self.depth += 1
+            elif char in '}]':
+                self.depth -= 1
+        return None
+
+
+def iter_json_array(response, key, chunk_size=CHUNK_SIZE):
+    """ Yields the items of the array `key` of the top-level JSON object of
+    a streamed response (requested with `stream=True`) as they arrive.
+
+    Only the item being decoded and the last chunk are kept in memory, not
+    the whole response. Compressed responses are decompressed while they
+    are read. The rest of the response after the array is read and
+    skipped, so the connection can be used again, and the response is
+    closed when the generator ends, also when it is not used up.
+
+    A response without the array, e.g. an error, is passed to the
+    `check_json` function of the response if it has one, as set by
+    `PyiCloudSession`, which raises the error of the response.
+    """
+    decoder = json.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+    scanner = _KeyScanner(key)
+    # the text before the array, kept to check a response without it
+    skipped = []
+    skipped_size = 0
+    text = ''
+    chunks = response.iter_content(chunk_size)
+    try:
+        for chunk in itertools.chain(chunks, [None]):
+            finished = chunk is None
+            text += utf8_decoder.decode(chunk or b'', final=finished)
+            if scanner is not None:
+                start = scanner.scan(text)
+                if start is None:
+                    if skipped is not None:
+                        skipped.append(text)
+                        skipped_size += len(text)
+                        if skipped_size > MAX_SKIPPED_SIZE:
+                            skipped = None
+                    text = ''
+                    continue
+                scanner = None
+                skipped = None
+                text = text[start:]
+
+            position = 0
+            while True:
+                while position < len(text) and \
+                        text[position] in WHITESPACE + ',':
+                    position += 1
+                if position == len(text):
+                    break
+                if text[position] == ']':
+                    for chunk in chunks:
+                        pass
+                    return
+                try:
+                    item, end = decoder.raw_decode(text, position)
+                except ValueError:
+                    if finished:
+                        raise
+                    # the item continues in the next chunk
+                    break
+                if end == len(text) and not finished:
+                    # e.g. a number might continue in the next chunk
+                    break
+                yield item
+                position = end
+            text = text[position:]
+    finally:
+        response.close()
+
+    check_json = getattr(response, 'check_json', None)
+    if skipped is not None and check_json is not None:
+        try:
+            data = json.loads(''.join(skipped))
+        except ValueError:
+            data = None
+        if isinstance(data, dict):
+            check_json(data)
+    raise ValueError("No complete array '%s' in the response" % key)
@@ -0,0 +1,200 @@
+import logging
+import threading
+import time
+
+from six.moves.urllib.parse import urlparse
+
+from pyicloud.exceptions import PyiCloudRateLimitExceeded
+
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Fraction of the bucket which is kept free for requests of a higher priority
+PRIORITY_RESERVE = {
+    PRIORITY_HIGH: 0.0,
+    PRIORITY_NORMAL: 0.25,
+    PRIORITY_LOW: 0.5,
+}
+
+# Endpoint name: (number of requests, per number of seconds), suggested
+# limits for long running clients, requests are not limited by default
+DEFAULT_RATE_LIMITS = {
+    'login': (4, 600),
+    'refreshClient': (10, 60),
+}
+ANY_ENDPOINT = '*'
+
+THROTTLE_STATUS_CODES = (429, 503)  # 450 is an expired session
+THROTTLE_RATE_DECREASE_FACTOR = 0.5
+THROTTLE_RATE_INCREASE_FACTOR = 0.1
+THROTTLE_MIN_RATE_FACTOR = 0.1
+
+
+class TokenBucket(object):
+    """ A token bucket which adapts its refill rate.
+
+    The bucket holds at most `capacity` tokens and is refilled with `rate`
+    tokens per second. After a throttling response the rate is halved, and
+    every successful request increases it again until the configured rate
+    is reached.
+    """
+
+    def __init__(self, requests, seconds):
+        self.capacity = float(requests)
+        self.max_rate = float(requests) / seconds
+        self.rate = self.max_rate
+        self.tokens = self.capacity
+        self.timestamp = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.timestamp) * self.rate
+        )
+        self.timestamp = now
+
+    def _required(self, reserve):
+        return 1 + self.capacity * reserve
+
+    def available(self):
+        with self._lock:
+            self._refill()
+            return self.tokens
+
+    def wait_time(self, reserve=0.0):
+        """ Returns the seconds until a request with the given reserve
+        would be admitted."""
+        with self._lock:
+            self._refill()
+            missing = self._required(reserve) - self.tokens
+            if missing <= 0:
+                return 0.0
+            return missing / self.rate
+
+    def consume(self, reserve=0.0):
+        with self._lock:
+            self._refill()
+            if self.tokens < self._required(reserve):
+                return False
+            self.tokens -= 1
+            return True
+
+    def decrease_rate(self):
+        with self._lock:
+            self._refill()
+            self.rate = max(
+                self.rate * THROTTLE_RATE_DECREASE_FACTOR,
+                self.max_rate * THROTTLE_MIN_RATE_FACTOR
+            )
+            self.tokens = 0.0
+
+    def increase_rate(self):
+        with self._lock:
+            self._refill()
+            self.rate = min(
+                self.rate + self.max_rate * THROTTLE_RATE_INCREASE_FACTOR,
+                self.max_rate
+            )
+
+
+class RateLimiter(object):
+    """ Limits the requests to the iCloud endpoints of one account.
+
+    Limits are given per endpoint name, being the last part of the url
+    path (e.g. `refreshClient`), with `*` matching all other endpoints.
+    Endpoints without a limit are not limited, and without `limits` no
+    endpoint is limited, see `DEFAULT_RATE_LIMITS` for suggested limits.
+
+    The limiter is shared by all sessions of the same account, so a
+    re-created `PyiCloudService` does not start with a full bucket.
+    """
+    _accounts = {}
+    _accounts_lock = threading.Lock()
+
+    def __init__(self, limits=None):
+        self._buckets = {}
+        self.configure(limits)
+
+    @classmethod
+    def for_account(cls, account, limits=None):
+        with cls._accounts_lock:
+            limiter = cls._accounts.get(account)
+            if limiter is None:
+                limiter = cls(limits)
+                cls._accounts[account] = limiter
+            elif limits is not None:
+                limiter.configure(limits)
+            return limiter
+
+    def configure(self, limits):
+        if limits is None:
+            limits = {}
+        buckets = {}
+        for endpoint, (requests, seconds) in limits.items():
+            bucket = self._buckets.get(endpoint)
+            if bucket is None or \
+                    (bucket.capacity, bucket.max_rate) != \
+                    (float(requests), float(requests) / seconds):
+                bucket = TokenBucket(requests, seconds)
+            buckets[endpoint] = bucket
+        self._buckets = buckets
+
+    @staticmethod
+    def endpoint_for_url(url):
+        return urlparse(url).path.rstrip('/').split('/')[-1]
+
+    def _bucket(self, endpoint):
+        return self._buckets.get(endpoint, self._buckets.get(ANY_ENDPOINT))
+
+    def admit(self, endpoint, priority=PRIORITY_NORMAL):
+        """ Returns True if a request with this priority would be admitted
+        now, without using a token."""
+        return self.wait_time(endpoint, priority) == 0
+
+    def wait_time(self, endpoint, priority=PRIORITY_NORMAL):
+        bucket = self._bucket(endpoint)
+        if bucket is None:
+            return 0.0
+        return bucket.wait_time(PRIORITY_RESERVE[priority])
+
+    def acquire(self, endpoint, priority=PRIORITY_HIGH, max_wait=0.0):
+        """ Uses a token for the endpoint, waiting at most `max_wait`
+        seconds for one to become available.
+
+        Raises `PyiCloudRateLimitExceeded`, with the `wait_time` until a
+        token is available, if that is longer than `max_wait`.
+        """
+        bucket = self._bucket(endpoint)
+        if bucket is None:
+            return
+        reserve = PRIORITY_RESERVE[priority]
+        deadline = time.time() + max_wait
+        while not bucket.consume(reserve):
+            wait_time = bucket.wait_time(reserve)
+            if time.time() + wait_time > deadline:
+                raise PyiCloudRateLimitExceeded(endpoint, wait_time)
+            logger.info(
+                "Rate limit reached for %s, waiting %.1f seconds",
+                endpoint, wait_time
+            )
+            time.sleep(wait_time)
+
+    def throttled(self, endpoint):
+        bucket = self._bucket(endpoint)
+        if bucket is not None:
+            bucket.decrease_rate()
+            logger.warning(
+                "Throttled by %s, reducing rate to %.3f requests per second",
+                endpoint, bucket.rate
+            )
+
+    def succeeded(self, endpoint):
+        bucket = self._bucket(endpoint)
+        if bucket is not None and bucket.rate < bucket.max_rate:
+            bucket.increase_rate()
@@ -1,7 +1,50 @@
-from pyicloud.services.calendar import CalendarService
-from pyicloud.services.findmyiphone import FindMyiPhoneServiceManager
-from pyicloud.services.ubiquity import UbiquityService
-from pyicloud.services.contacts import ContactsService
-from pyicloud.services.reminders import RemindersService
-from pyicloud.services.photos import PhotosService
-from pyicloud.services.account import AccountService
+""" The iCloud services.
+
+The services are not imported with this package, as some of them have
+heavy dependencies (e.g. pytz, tzlocal). They can still be imported from
+it, e.g. `from pyicloud.services import CalendarService`, which imports
+the module of the service on first use.
+"""
+import importlib
+import sys
+import types
+
+SERVICES = {
+    'AccountService': 'pyicloud.services.account',
+    'CalendarService': 'pyicloud.services.calendar',
+    'ContactsService': 'pyicloud.services.contacts',
+    'FindMyiPhoneServiceManager': 'pyicloud.services.findmyiphone',
+    'PhotosService': 'pyicloud.services.photos',
+    'RemindersService': 'pyicloud.services.reminders',
+    'UbiquityService': 'pyicloud.services.ubiquity',
+}
+
+__all__ = sorted(SERVICES)
+
+
+class _ServicesModule(types.ModuleType):
+    """ This package, importing the services when they are first used.
+
+    A module level `__getattr__` is not supported by Python 2, so the
+    package is replaced by an instance of this class.
+    """
+
+    def __getattr__(self, name):
+        if name not in SERVICES:
+            raise AttributeError(
+                "module %r has no attribute %r" % (self.__name__, name)
+            )
+        value = getattr(importlib.import_module(SERVICES[name]), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(SERVICES))
+
+
+_module = _ServicesModule(__name__, __doc__)
+_module.__dict__.update(sys.modules[__name__].__dict__)
+# Python 2 clears the globals of a module when it is deleted, and they are
+# still used by _ServicesModule
+_module._original_module = sys.modules[__name__]
+sys.modules[__name__] = _module
@@ -10,14 +10,16 @@ class AccountService(object):
         self.session = session
         self.params = params
         self._service_root = service_root
-        self._devices = []
+        self._devices = None
 
         self._acc_endpoint = '%s/setup/web/device' % self._service_root
         self._account_devices_url = '%s/getDevices' % self._acc_endpoint
 
+    def refresh(self):
         req = self.session.get(self._account_devices_url, params=self.params)
         self.response = req.json()
 
+        self._devices = []
         for device_info in self.response['devices']:
             # device_id = device_info['udid']
             # self._devices[device_id] = AccountDevice(device_info)
@@ -25,6 +27,8 @@ class AccountService(object):
 
     @property
     def devices(self):
+        if self._devices is None:
+            self.refresh()
         return self._devices
 
 
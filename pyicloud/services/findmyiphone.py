@@ -1,9 +1,52 @@
 import json
 import sys
+import threading
+import time
 
 import six
 
-from pyicloud.exceptions import PyiCloudNoDevicesException
+from pyicloud.exceptions import (
+    PyiCloudDevicesNotRefreshedException,
+    PyiCloudNoDevicesException
+)
+from pyicloud.jsonstream import iter_json_array
+
+
+LOCATE_ALL = 'all'
+
+CHANGE_LOCATION = 'location'
+CHANGE_LOCATION_FIELDS = (
+    'timeStamp', 'latitude', 'longitude', 'horizontalAccuracy'
+)
+CHANGE_DEVICE_FIELDS = (
+    'name', 'locationEnabled', 'batteryLevel', 'batteryStatus'
+)
+ALL_CHANGES = frozenset((CHANGE_LOCATION,) + CHANGE_DEVICE_FIELDS)
+# the device is not in the account anymore
+CHANGE_REMOVED = 'removed'
+
+
+def device_changes(old_content, new_content):
+    """ Returns the relevant fields which differ between two versions of
+    the device content. Any change of the location fields is reported as
+    `location`."""
+    changes = set(
+        field for field in CHANGE_DEVICE_FIELDS
+        if old_content.get(field) != new_content.get(field)
+    )
+    old_location = old_content.get('location') or {}
+    new_location = new_content.get('location') or {}
+    for field in CHANGE_LOCATION_FIELDS:
+        if old_location.get(field) != new_location.get(field):
+            changes.add(CHANGE_LOCATION)
+            break
+    return changes
+
+
+def stable_device_key(content):
+    """ Returns a key identifying the device, which does not change when
+    the device is renamed."""
+    return content.get('deviceDiscoveryId') or content['id']
 
 
 class FindMyiPhoneServiceManager(object):
@@ -12,6 +55,23 @@ class FindMyiPhoneServiceManager(object):
     This connects to iCloud and return phone data including the near-realtime
     latitude and longitude.
 
+    Devices can be looked up by position, id, name and stable key, which are
+    all indexed, and the indexes are kept up-to-date on every refresh.
+
+    Every refresh is compared to the previous one, and only the devices of
+    which the location, name, battery or location setting changed are
+    passed to the listeners. The raw response is not kept. Devices which
+    are missing from the response of a refresh which is not targeted at
+    one device are removed, and passed to the listeners as `removed`.
+
+    No request is made until `refresh_client` is called, and the devices
+    are only refreshed by it, so using the devices never makes a request.
+    Using them before the first refresh raises
+    `PyiCloudDevicesNotRefreshedException`.
+
+    Refreshes can be done by several threads at once, the responses are
+    applied one at a time.
+
     """
 
     def __init__(self, service_root, session, params):
@@ -25,57 +85,202 @@ class FindMyiPhoneServiceManager(object):
         self._fmip_lost_url = '%s/lostDevice' % self._fmip_endpoint
 
         self._devices = {}
-        self.refresh_client()
-
-    def refresh_client(self):
+        self._device_ids = []
+        self._ids_by_name = {}
+        self._ids_by_stable_key = {}
+        self._listeners = []
+        self.refreshed_timestamp = None
+        self._lock = threading.Lock()
+
+    def refresh_client(self, locate=LOCATE_ALL):
         """ Refreshes the FindMyiPhoneService endpoint,
 
         This ensures that the location data is up-to-date.
 
+        `locate` selects which devices are actively located: all devices
+        (the default), only the device with the given id, or none when
+        `locate` is None. Devices which are not located are refreshed with
+        their last known location.
+
         """
         req = self.session.post(
             self._fmip_refresh_url,
             params=self.params,
-            timeout=30,
             data=json.dumps(
                 {
                     'clientContext': {
                         'fmly': True,
-                        'shouldLocate': True,
-                        'selectedDevice': 'all',
+                        'shouldLocate': locate is not None,
+                        'selectedDevice': locate or LOCATE_ALL,
                     }
                 }
-            )
+            ),
+            stream=True
         )
-        self.response = req.json()
-
-        for device_info in self.response['content']:
-            device_id = device_info['id']
-            if device_id not in self._devices:
-                self._devices[device_id] = AppleDevice(
-                    device_info,
-                    self.session,
-                    self.params,
-                    manager=self,
-                    sound_url=self._fmip_sound_url,
-                    lost_url=self._fmip_lost_url,
-                    message_url=self._fmip_message_url,
-                )
-            else:
-                self._devices[device_id].update(device_info)
 
+        changed_devices = []
+        device_ids = set()
+        try:
+            # the devices are applied one at a time, as they are received
+            for device_info in iter_json_array(req, 'content'):
+                with self._lock:
+                    device, changes = self._update_device(device_info)
+                device_ids.add(device_info['id'])
+                if changes:
+                    changed_devices.append((device, changes))
+        finally:
+            req.close()
+        if locate in (LOCATE_ALL, None):
+            # only a refresh which is not targeted is sure to list all devices
+            with self._lock:
+                changed_devices.extend(
+                    (self._remove_device(device_id), set([CHANGE_REMOVED]))
+                    for device_id in list(self._device_ids)
+                    if device_id not in device_ids
+                )
+        self.refreshed_timestamp = time.time()
         if not self._devices:
             raise PyiCloudNoDevicesException()
 
+        for device, changes in changed_devices:
+            for listener in self._listeners:
+                listener(device, changes)
+
+    def _update_device(self, device_info):
+        """ Applies the info of one device to the devices and indexes,
+        and returns the device and its changes."""
+        device_id = device_info['id']
+        stable_key = stable_device_key(device_info)
+        previous_id = self._ids_by_stable_key.get(stable_key)
+        if previous_id is not None and previous_id != device_id:
+            # same device, registered with a new id
+            self._devices[device_id] = self._devices.pop(previous_id)
+            self._device_ids[self._device_ids.index(previous_id)] = \
+                device_id
+            self._remove_name(self._devices[device_id]['name'],
+                              previous_id)
+            self._ids_by_name.setdefault(
+                self._devices[device_id]['name'], []
+            ).append(device_id)
+
+        if device_id not in self._devices:
+            self._devices[device_id] = AppleDevice(
+                device_info,
+                self.session,
+                self.params,
+                manager=self,
+                sound_url=self._fmip_sound_url,
+                lost_url=self._fmip_lost_url,
+                message_url=self._fmip_message_url,
+            )
+            self._device_ids.append(device_id)
+            self._ids_by_name.setdefault(
+                device_info['name'], []
+            ).append(device_id)
+            changes = set(ALL_CHANGES)
+        else:
+            device = self._devices[device_id]
+            if device['name'] != device_info['name']:
+                self._remove_name(device['name'], device_id)
+                self._ids_by_name.setdefault(
+                    device_info['name'], []
+                ).append(device_id)
+            changes = device_changes(device.content, device_info)
+            device.update(device_info)
+        self._ids_by_stable_key[stable_key] = device_id
+
+        device = self._devices[device_id]
+        if changes:
+            device.add_changes(changes)
+        return device, changes
+
+    def _remove_device(self, device_id):
+        """ Removes a device from the devices and indexes, and returns
+        it."""
+        device = self._devices.pop(device_id)
+        self._device_ids.remove(device_id)
+        self._remove_name(device['name'], device_id)
+        for stable_key, indexed_id in list(self._ids_by_stable_key.items()):
+            if indexed_id == device_id:
+                del self._ids_by_stable_key[stable_key]
+        device.add_changes(set([CHANGE_REMOVED]))
+        return device
+
+    def add_listener(self, listener):
+        """ Calls `listener(device, changes)` for every device which
+        changed during a refresh, `changes` being the set of changed
+        fields, or `removed` for a device which was removed."""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _check_refreshed(self):
+        if self.refreshed_timestamp is None:
+            raise PyiCloudDevicesNotRefreshedException()
+
+    def _remove_name(self, name, device_id):
+        ids = self._ids_by_name.get(name, [])
+        if device_id in ids:
+            ids.remove(device_id)
+        if not ids:
+            self._ids_by_name.pop(name, None)
+
+    def get_by_id(self, device_id):
+        """ Returns the device with the given id, or None."""
+        self._check_refreshed()
+        return self._devices.get(device_id)
+
+    def get_by_name(self, name):
+        """ Returns the first device with the given name, or None."""
+        self._check_refreshed()
+        with self._lock:
+            ids = self._ids_by_name.get(name)
+            if not ids:
+                return None
+            return self._devices[ids[0]]
+
+    def get_by_stable_key(self, stable_key):
+        """ Returns the device with the given stable key, or None.
+
+        Unlike the name and id, the stable key does not change when the
+        device is renamed or registered again.
+        """
+        self._check_refreshed()
+        with self._lock:
+            device_id = self._ids_by_stable_key.get(stable_key)
+            if device_id is None:
+                return None
+            return self._devices[device_id]
+
+    def keys(self):
+        self._check_refreshed()
+        with self._lock:
+            return list(self._device_ids)
+
+    def __len__(self):
+        self._check_refreshed()
+        return len(self._device_ids)
+
+    def __iter__(self):
+        self._check_refreshed()
+        with self._lock:
+            devices = [
+                self._devices[device_id] for device_id in self._device_ids
+            ]
+        return iter(devices)
+
     def __getitem__(self, key):
-        if isinstance(key, int):
-            if six.PY3:
-                key = list(self.keys())[key]
-            else:
-                key = self.keys()[key]
-        return self._devices[key]
+        self._check_refreshed()
+        with self._lock:
+            if isinstance(key, int):
+                key = self._device_ids[key]
+            return self._devices[key]
 
     def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        self._check_refreshed()
         return getattr(self._devices, attr)
 
     def __unicode__(self):
@@ -106,11 +311,34 @@ class AppleDevice(object):
         self.lost_url = lost_url
         self.message_url = message_url
 
+        self._changes = set(ALL_CHANGES)
+
     def update(self, data):
         self.content = data
 
-    def location(self):
-        self.manager.refresh_client()
+    def add_changes(self, changes):
+        self._changes.update(changes)
+
+    def pop_changes(self):
+        """ Returns the fields which changed since the previous call."""
+        changes = self._changes
+        self._changes = set()
+        return changes
+
+    @property
+    def stable_key(self):
+        return stable_device_key(self.content)
+
+    def location(self, targeted=False):
+        """ Returns the location of the device, after refreshing.
+
+        When `targeted`, only this device is located, instead of all devices
+        of the account and family.
+        """
+        if targeted:
+            self.manager.refresh_client(locate=self.content['id'])
+        else:
+            self.manager.refresh_client()
         return self.content['location']
 
     def status(self, additional=[]):
@@ -2,15 +2,26 @@ import sys
 import json
 import logging
 import base64
+import collections
+import threading
+import time
 
 from datetime import datetime
 from pyicloud.exceptions import PyiCloudServiceNotActivatedErrror
+from pyicloud.jsonstream import iter_json_array
 import pytz
 
-#from future.moves.urllib.parse import urlencode
+from six.moves import queue
+from six.moves.urllib.parse import urlencode
 
 logger = logging.getLogger(__name__)
 
+MIN_PAGE_SIZE = 25
+MAX_PAGE_SIZE = 500
+# the page size is doubled when a page takes less than half of this, and
+# halved when it takes longer
+TARGET_PAGE_SECONDS = 2.0
+
 
 class PhotosService(object):
     """ The 'Photos' iCloud service."""
@@ -226,9 +237,18 @@ class PhotosService(object):
 
 
 class PhotoAlbum(object):
+    """ An album of photos.
+
+    By default, one page is requested at a time, and its photos are
+    yielded while it is received. With `prefetch` above 1, the photos are
+    listed with that many page requests in flight, on a pool of as many
+    threads. The offsets of the pages are then planned ahead from the
+    number of photos in the album, and the page size is adapted to how
+    long the pages take. The photos are still yielded in order.
+    """
 
     def __init__(self, service, name, list_type, obj_type, direction,
-                 query_filter=None, page_size=100):
+                 query_filter=None, page_size=100, prefetch=0):
         self.name = name
         self.service = service
         self.list_type = list_type
@@ -236,6 +256,7 @@ class PhotoAlbum(object):
         self.direction = direction
         self.query_filter = query_filter
         self.page_size = page_size
+        self.prefetch = prefetch
 
         self._len = None
 
@@ -265,47 +286,148 @@ class PhotoAlbum(object):
 
     @property
     def photos(self):
+        if self.prefetch > 1:
+            return self._prefetched_photos()
+        return self._sequential_photos()
+
+    def _request_page(self, offset, page_size):
+        url = ('%s/records/query?' % self.service._service_endpoint) + \
+            urlencode(self.service.params)
+        return self.service.session.post(
+            url,
+            data=json.dumps(self._list_query_gen(
+                offset, self.list_type, self.direction,
+                self.query_filter, page_size)),
+            headers={'Content-type': 'text/plain'},
+            stream=True
+        )
+
+    def _pair_records(self, records, counts):
+        """ Yields the photos in the order of their master records, each as
+        soon as its asset record is received too. The master records are
+        counted in `counts['masters']`, and the records which cannot be
+        paired are logged."""
+        asset_records = {}
+        master_records = collections.deque()
+        for rec in records:
+            if rec['recordType'] == "CPLAsset":
+                master_id = \
+                    rec['fields']['masterRef']['value']['recordName']
+                asset_records[master_id] = rec
+            elif rec['recordType'] == "CPLMaster":
+                counts['masters'] += 1
+                master_records.append(rec)
+            while master_records and \
+                    master_records[0]['recordName'] in asset_records:
+                master_record = master_records.popleft()
+                yield PhotoAsset(
+                    self.service, master_record,
+                    asset_records.pop(master_record['recordName']))
+
+        for master_record in master_records:
+            asset_record = asset_records.pop(master_record['recordName'],
+                                             None)
+            if asset_record is None:
+                logger.warning("Skipping photo %s of album %s, which has "
+                               "no asset record",
+                               master_record['recordName'], self.name)
+            else:
+                yield PhotoAsset(self.service, master_record, asset_record)
+        for master_id in asset_records:
+            logger.warning("Skipping photo %s of album %s, which has no "
+                           "master record", master_id, self.name)
+
+    def _sequential_photos(self):
         if self.direction == "DESCENDING":
             offset = len(self) - 1
         else:
             offset = 0
 
         while(True):
-            url = ('%s/records/query?' % self.service._service_endpoint) + \
-                urlencode(self.service.params)
-            request = self.service.session.post(
-                url,
-                data=json.dumps(self._list_query_gen(
-                    offset, self.list_type, self.direction,
-                    self.query_filter)),
-                headers={'Content-type': 'text/plain'}
-            )
-            response = request.json()
-
-            asset_records = {}
-            master_records = []
-            for rec in response['records']:
-                if rec['recordType'] == "CPLAsset":
-                    master_id = \
-                        rec['fields']['masterRef']['value']['recordName']
-                    asset_records[master_id] = rec
-                elif rec['recordType'] == "CPLMaster":
-                    master_records.append(rec)
-
-            master_records_len = len(master_records)
-            if master_records_len:
+            request = self._request_page(offset, self.page_size)
+            counts = {'masters': 0}
+            try:
+                for photo in self._pair_records(
+                    iter_json_array(request, 'records'), counts
+                ):
+                    yield photo
+            finally:
+                # also when the photos are not all used
+                request.close()
+
+            if counts['masters']:
                 if self.direction == "DESCENDING":
-                    offset = offset - master_records_len
+                    offset = offset - counts['masters']
                 else:
-                    offset = offset + master_records_len
-
-                for master_record in master_records:
-                    record_name = master_record['recordName']
-                    yield PhotoAsset(self.service, master_record,
-                                     asset_records[record_name])
+                    offset = offset + counts['masters']
             else:
                 break
 
+    def _fetch_page(self, page):
+        """ Returns the photos of a `_Page`, and its number of master
+        records. The page is no longer received when it is cancelled."""
+        request = self._request_page(page.offset, page.page_size)
+        counts = {'masters': 0}
+        photos = []
+        try:
+            for photo in self._pair_records(
+                iter_json_array(request, 'records'), counts
+            ):
+                if page.cancelled:
+                    break
+                photos.append(photo)
+        finally:
+            request.close()
+        return photos, counts['masters']
+
+    def _prefetched_photos(self):
+        step = -1 if self.direction == "DESCENDING" else 1
+        total = len(self)
+        next_offset = total - 1 if step < 0 else 0
+        page_size = self.page_size
+        in_flight = collections.deque()
+        fetcher = _PageFetcher(self, self.prefetch)
+        try:
+            while True:
+                while len(in_flight) < self.prefetch and \
+                        0 <= next_offset < total:
+                    in_flight.append(fetcher.submit(next_offset, page_size))
+                    next_offset += step * page_size
+                if not in_flight:
+                    if next_offset < 0:
+                        break
+                    # photos added after counting are listed until a page
+                    # is empty, as without prefetching
+                    in_flight.append(fetcher.submit(next_offset, page_size))
+                    next_offset += step * page_size
+
+                page = in_flight.popleft()
+                photos, masters = page.result()
+                for photo in photos:
+                    yield photo
+                if not masters:
+                    break
+                page_size = self._adapt_page_size(page_size, page.duration)
+                if masters < page.page_size:
+                    # the album changed or ended, so the pages planned after
+                    # this one are cancelled and replanned
+                    while in_flight:
+                        in_flight.popleft().cancel()
+                    next_offset = page.offset + step * masters
+        finally:
+            # also when the photos are not all used
+            for page in in_flight:
+                page.cancel()
+            fetcher.close()
+
+    @staticmethod
+    def _adapt_page_size(page_size, duration):
+        if duration < TARGET_PAGE_SECONDS / 2:
+            return min(page_size * 2, MAX_PAGE_SIZE)
+        if duration > TARGET_PAGE_SECONDS:
+            return max(page_size // 2, MIN_PAGE_SIZE)
+        return page_size
+
     def _count_query_gen(self, obj_type):
         query = {
             u'batch': [{
@@ -332,7 +454,9 @@ class PhotoAlbum(object):
 
         return query
 
-    def _list_query_gen(self, offset, list_type, direction, query_filter=None):
+    def _list_query_gen(
+        self, offset, list_type, direction, query_filter=None, page_size=None
+    ):
         query = {
             u'query': {
                 u'filterBy': [
@@ -345,7 +469,7 @@ class PhotoAlbum(object):
                 ],
                 u'recordType': list_type
             },
-            u'resultsLimit': self.page_size * 2,
+            u'resultsLimit': (page_size or self.page_size) * 2,
             u'desiredKeys': [
                 u'resJPEGFullWidth', u'resJPEGFullHeight',
                 u'resJPEGFullFileType', u'resJPEGFullFingerprint',
@@ -412,6 +536,81 @@ class PhotoAlbum(object):
         )
 
 
+class _Page(object):
+    """ A page request of `_PageFetcher`. """
+
+    def __init__(self, offset, page_size):
+        self.offset = offset
+        self.page_size = page_size
+        self.duration = None
+        self.cancelled = False
+        self._done = threading.Event()
+        self._photos = None
+        self._masters = None
+        self._error = None
+
+    def run(self, album):
+        if self.cancelled:
+            return
+        start_time = time.time()
+        try:
+            self._photos, self._masters = album._fetch_page(self)
+        except Exception as error:
+            self._error = error
+        self.duration = time.time() - start_time
+        self._done.set()
+
+    def cancel(self):
+        """ Skips the page when it is not started yet, and otherwise stops
+        receiving it. Its result is not waited for."""
+        self.cancelled = True
+
+    def result(self):
+        """ Waits for the page, and returns its photos and number of master
+        records."""
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._photos, self._masters
+
+
+class _PageFetcher(object):
+    """ Requests the pages of an album on a pool of worker threads. """
+
+    def __init__(self, album, workers):
+        self._album = album
+        self._tasks = queue.Queue()
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, offset, page_size):
+        page = _Page(offset, page_size)
+        self._tasks.put(page)
+        return page
+
+    def close(self):
+        """ Stops the workers after their current page, the pages not
+        started yet are not requested."""
+        while True:
+            try:
+                self._tasks.get_nowait()
+            except queue.Empty:
+                break
+        for thread in self._threads:
+            self._tasks.put(None)
+
+    def _work(self):
+        while True:
+            page = self._tasks.get()
+            if page is None:
+                return
+            page.run(self._album)
+
+
 class PhotoAsset(object):
     def __init__(self, service, master_record, asset_record):
         self._service = service
@@ -12,10 +12,20 @@ class RemindersService(object):
         self.session = session
         self.params = params
         self._service_root = service_root
-        self.lists = {}
-        self.collections = {}
+        self._lists = None
+        self._collections = None
 
-        self.refresh()
+    @property
+    def lists(self):
+        if self._lists is None:
+            self.refresh()
+        return self._lists
+
+    @property
+    def collections(self):
+        if self._collections is None:
+            self.refresh()
+        return self._collections
 
     def refresh(self):
         params_reminders = dict(self.params)
@@ -33,11 +43,11 @@ class RemindersService(object):
 
         startup = req.json()
 
-        self.lists = {}
-        self.collections = {}
+        lists = {}
+        collections = {}
         for collection in startup['Collections']:
             temp = []
-            self.collections[collection['title']] = {
+            collections[collection['title']] = {
                 'guid': collection['guid'],
                 'ctag': collection['ctag']
             }
@@ -65,7 +75,9 @@ class RemindersService(object):
                     "desc": desc,
                     "due": due
                 })
-            self.lists[collection['title']] = temp
+            lists[collection['title']] = temp
+        self._lists = lists
+        self._collections = collections
 
     def post(self, title, description="", collection=None, dueDate=None):
         pguid = 'tasks'
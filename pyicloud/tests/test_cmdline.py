@@ -0,0 +1,42 @@
+import json
+import os
+import shutil
+import stat
+import tempfile
+
+from unittest2 import TestCase
+
+from pyicloud.cmdline import write_snapshot
+
+
+class FakeDevice(object):
+    def __init__(self, content):
+        self.content = content
+
+
+class WriteSnapshotTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'devices.fmip_snapshot')
+        self.umask = os.umask(0o022)
+
+    def tearDown(self):
+        os.umask(self.umask)
+        shutil.rmtree(self.directory)
+
+    def test_write(self):
+        write_snapshot([FakeDevice({'id': 'a'})], self.filename)
+        write_snapshot([FakeDevice({'id': 'b'})], self.filename)
+        with open(self.filename) as source:
+            self.assertEqual(json.load(source), [{'id': 'b'}])
+        self.assertEqual(os.listdir(self.directory), ['devices.fmip_snapshot'])
+        self.assertEqual(stat.S_IMODE(os.stat(self.filename).st_mode), 0o644)
+
+    def test_failure_keeps_snapshot(self):
+        write_snapshot([FakeDevice({'id': 'a'})], self.filename)
+        self.assertRaises(
+            TypeError, write_snapshot, [FakeDevice(object())], self.filename
+        )
+        with open(self.filename) as source:
+            self.assertEqual(json.load(source), [{'id': 'a'}])
+        self.assertEqual(os.listdir(self.directory), ['devices.fmip_snapshot'])
@@ -0,0 +1,161 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from unittest2 import TestCase
+
+from pyicloud.cmdline import device_action
+from pyicloud.daemon import (
+    DaemonClient,
+    DeviceDaemon,
+    PyiCloudDaemonError,
+    PyiCloudDaemonUnavailable,
+    RemoteDevice,
+)
+from pyicloud.exceptions import PyiCloudException
+from pyicloud.services.findmyiphone import FindMyiPhoneServiceManager
+from pyicloud.tests.test_findmyiphone import FakeSession, device_info
+
+
+class FakeApi(object):
+    def __init__(self, *contents):
+        self.user = {'apple_id': 'user@example.com'}
+        self.session = FakeSession(list(contents))
+        self.devices = FindMyiPhoneServiceManager(
+            'https://fmip', self.session, {}
+        )
+
+
+class DeviceDaemonTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, 'daemon.sock')
+        contents = [[device_info('a', 'iPhone A')]] * 3
+        self.api = FakeApi(*contents)
+        self.daemon = DeviceDaemon(self.api, self.socket_path)
+        self.thread = threading.Thread(target=self.daemon.serve_forever)
+        self.thread.start()
+        while self.daemon.server is None:
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        self.thread.join()
+        shutil.rmtree(self.directory)
+
+    def test_devices_are_shared(self):
+        client = DaemonClient('user@example.com', self.socket_path)
+        for i in range(3):
+            devices = client.devices(max_age=60)
+            self.assertEqual([d['name'] for d in devices], ['iPhone A'])
+        self.assertEqual(len(self.api.session.requests), 1)
+
+        client.devices(locate=True, max_age=60)
+        self.assertEqual(len(self.api.session.requests), 2)
+        self.assertTrue(
+            self.api.session.requests[1][1]['clientContext']['shouldLocate']
+        )
+
+    def test_unavailable(self):
+        client = DaemonClient('other@example.com', self.socket_path)
+        self.assertRaises(PyiCloudDaemonUnavailable, client.devices)
+
+        missing = os.path.join(self.directory, 'missing.sock')
+        client = DaemonClient('user@example.com', missing)
+        self.assertRaises(PyiCloudDaemonUnavailable, client.devices)
+
+    def test_failed_action(self):
+        client = DaemonClient('user@example.com', self.socket_path)
+        device = client.devices()[0]
+        # the session has no response left for the action
+        self.api.session.contents = []
+        self.assertRaises(PyiCloudDaemonError, device.play_sound)
+
+        unknown = RemoteDevice(client, {'id': 'unknown'})
+        self.assertRaises(PyiCloudDaemonUnavailable, unknown.play_sound)
+
+    def test_live_socket_is_kept(self):
+        other = DeviceDaemon(self.api, self.socket_path)
+        self.assertRaises(PyiCloudException, other.serve_forever)
+        client = DaemonClient('user@example.com', self.socket_path)
+        self.assertEqual(len(client.devices()), 1)
+
+
+class SocketDirectoryTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, 'daemon.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stale_socket_is_removed(self):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.socket_path)
+        stale.close()
+        daemon = DeviceDaemon(FakeApi(), self.socket_path)
+        thread = threading.Thread(target=daemon.serve_forever)
+        thread.start()
+        while daemon.server is None:
+            time.sleep(0.01)
+        daemon.shutdown()
+        thread.join()
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def test_no_response(self):
+        os.chmod(self.directory, 0o700)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen(1)
+        try:
+            client = DaemonClient(
+                'user@example.com', self.socket_path, timeout=0.1
+            )
+            self.assertRaises(PyiCloudDaemonError, client.devices)
+        finally:
+            server.close()
+
+    def test_unsafe_directory(self):
+        os.chmod(self.directory, 0o755)
+        daemon = DeviceDaemon(FakeApi(), self.socket_path)
+        self.assertRaises(PyiCloudException, daemon.serve_forever)
+        client = DaemonClient('user@example.com', self.socket_path)
+        self.assertRaises(PyiCloudDaemonUnavailable, client.devices)
+
+
+class FakeClient(object):
+    def __init__(self, error):
+        self.error = error
+
+    def request(self, command, **fields):
+        raise self.error
+
+
+class FakeDevice(object):
+    def __init__(self):
+        self.actions = []
+
+    def play_sound(self, subject='Find My iPhone Alert'):
+        self.actions.append(('play_sound', subject))
+
+
+class DeviceActionTestCase(TestCase):
+    def test_falls_back_to_direct(self):
+        client = FakeClient(PyiCloudDaemonUnavailable("Unknown device 'a'"))
+        remote = RemoteDevice(client, {'id': 'a'})
+        direct = FakeDevice()
+        device_action(remote, 'play_sound', lambda dev: direct, subject='Hi')
+        self.assertEqual(direct.actions, [('play_sound', 'Hi')])
+
+    def test_failure_is_not_retried(self):
+        client = FakeClient(PyiCloudDaemonError("No response from daemon"))
+        remote = RemoteDevice(client, {'id': 'a'})
+        direct = FakeDevice()
+        self.assertRaises(
+            SystemExit, device_action, remote, 'play_sound',
+            lambda dev: direct, subject='Hi'
+        )
+        self.assertEqual(direct.actions, [])
@@ -0,0 +1,168 @@
+import os
+import shutil
+import tempfile
+import threading
+
+import requests
+from unittest2 import TestCase
+
+from pyicloud.download import DOWNLOADED, SKIPPED, DownloadManager
+
+
+class FakePhoto(object):
+    def __init__(self, filename, size):
+        self.filename = filename
+        self.versions = {'original': {
+            'url': 'https://photos/%s' % filename,
+            'size': size,
+        }}
+
+
+class FakeDownload(object):
+    def __init__(self, content, status_code=200, fail_after=None):
+        self.content = content
+        self.status_code = status_code
+        self.fail_after = fail_after
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), 10):
+            if self.fail_after is not None and i >= self.fail_after:
+                raise requests.exceptions.ChunkedEncodingError("broken")
+            yield self.content[i:i + 10]
+
+    def close(self):
+        pass
+
+
+class FakeDownloadSession(object):
+    """ Serves `contents` by URL, with Range requests unless
+    `ranges` is False. The first `failures` responses break off halfway.
+    """
+
+    def __init__(self, contents, ranges=True, failures=0):
+        self.contents = contents
+        self.ranges = ranges
+        self.failures = failures
+        self.lock = threading.Lock()
+        self.requests = []
+        self.unreachable = set()
+
+    def get(self, url, headers=None, stream=False):
+        if url in self.unreachable:
+            raise requests.ConnectionError("unreachable")
+        content = self.contents[url]
+        byte_range = (headers or {}).get('Range')
+        with self.lock:
+            self.requests.append((url, byte_range))
+            fail = self.failures > 0
+            self.failures -= 1
+        status_code = 200
+        if byte_range and self.ranges:
+            start, end = byte_range.split('=')[1].split('-')
+            content = content[int(start):int(end) + 1 if end else None]
+            status_code = 206
+        return FakeDownload(
+            content, status_code, len(content) // 2 if fail else None
+        )
+
+
+class DownloadManagerTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.photos = [
+            FakePhoto('IMG_%d.JPG' % i, 100 + i * 50)
+            for i in range(5)
+        ]
+        self.contents = {}
+        for photo in self.photos:
+            self.contents[photo.versions['original']['url']] = \
+                os.urandom(photo.versions['original']['size'])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertDownloaded(self):
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            sorted(photo.filename for photo in self.photos)
+        )
+        for photo in self.photos:
+            with open(os.path.join(self.directory, photo.filename), 'rb') \
+                    as source:
+                self.assertEqual(
+                    source.read(),
+                    self.contents[photo.versions['original']['url']]
+                )
+
+    def test_download(self):
+        session = FakeDownloadSession(self.contents)
+        reports = []
+        manager = DownloadManager(
+            session, self.directory, workers=3, split_size=120,
+            progress=reports.append
+        )
+        progress = manager.download(self.photos)
+        self.assertDownloaded()
+        self.assertEqual(progress.files_done, 5)
+        self.assertEqual(progress.bytes_done, progress.bytes_total)
+        self.assertEqual(
+            set(result[2] for result in progress.results), set([DOWNLOADED])
+        )
+        # the larger photos were split into ranges
+        self.assertGreater(len(session.requests), 5)
+        self.assertTrue(reports)
+
+        # completed photos are not downloaded again
+        session.requests = []
+        progress = manager.download(self.photos)
+        self.assertEqual(session.requests, [])
+        self.assertEqual(
+            set(result[2] for result in progress.results), set([SKIPPED])
+        )
+
+    def test_resume(self):
+        photo = self.photos[-1]
+        url = photo.versions['original']['url']
+        path = os.path.join(self.directory, photo.filename + '.part')
+        with open(path, 'wb') as output:
+            output.write(self.contents[url][:70])
+
+        session = FakeDownloadSession(self.contents, failures=2)
+        manager = DownloadManager(session, self.directory, workers=1)
+        progress = manager.download([photo])
+        self.assertEqual(progress.failed, [])
+        self.assertEqual(session.requests[0], (url, 'bytes=70-299'))
+        with open(os.path.join(self.directory, photo.filename), 'rb') \
+                as source:
+            self.assertEqual(source.read(), self.contents[url])
+        self.assertFalse(os.path.exists(path))
+
+        # without Range support, the photo is downloaded from the start
+        os.rename(os.path.join(self.directory, photo.filename), path)
+        with open(path, 'r+b') as output:
+            output.truncate(70)
+        session = FakeDownloadSession(self.contents, ranges=False)
+        manager = DownloadManager(session, self.directory, workers=1)
+        self.assertEqual(manager.download([photo]).failed, [])
+        with open(os.path.join(self.directory, photo.filename), 'rb') \
+                as source:
+            self.assertEqual(source.read(), self.contents[url])
+
+    def test_failures_do_not_stop_the_download(self):
+        session = FakeDownloadSession(self.contents)
+        failed_photo = self.photos[1]
+        session.unreachable.add(failed_photo.versions['original']['url'])
+
+        def report(progress):
+            raise ValueError("broken callback")
+
+        manager = DownloadManager(
+            session, self.directory, workers=2, retries=1, progress=report,
+            report_interval=0
+        )
+        progress = manager.download(self.photos)
+        self.assertEqual([result[0] for result in progress.failed],
+                         [failed_photo])
+        self.assertEqual(progress.files_done, 4)
+        self.photos.remove(failed_photo)
+        self.assertDownloaded()
@@ -0,0 +1,174 @@
+import json
+
+from unittest2 import TestCase
+
+from pyicloud.exceptions import PyiCloudDevicesNotRefreshedException
+from pyicloud.services.findmyiphone import FindMyiPhoneServiceManager
+
+
+class FakeResponse(object):
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+    def iter_content(self, chunk_size=1):
+        content = json.dumps(self.data).encode('utf-8')
+        for i in range(0, len(content), 7):
+            yield content[i:i + 7]
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    def __init__(self, contents):
+        self.contents = contents
+        self.requests = []
+
+    def post(self, url, **kwargs):
+        self.requests.append((url, json.loads(kwargs.get('data', '{}'))))
+        return FakeResponse({'content': self.contents.pop(0)})
+
+
+def device_info(device_id, name, discovery_id=None, **fields):
+    info = {
+        'id': device_id,
+        'name': name,
+        'deviceDisplayName': 'iPhone',
+        'deviceDiscoveryId': discovery_id or 'discovery-%s' % device_id,
+        'location': None,
+    }
+    info.update(fields)
+    return info
+
+
+class FindMyiPhoneServiceManagerTestCase(TestCase):
+    def create_manager(self, *contents):
+        self.session = FakeSession(list(contents))
+        manager = FindMyiPhoneServiceManager('https://fmip', self.session, {})
+        manager.refresh_client()
+        return manager
+
+    def test_lookup(self):
+        manager = self.create_manager([
+            device_info('a', 'iPhone A'),
+            device_info('b', 'iPhone B'),
+        ])
+        self.assertEqual(manager[0]['name'], 'iPhone A')
+        self.assertEqual(manager[1]['name'], 'iPhone B')
+        self.assertEqual(manager['b']['name'], 'iPhone B')
+        self.assertEqual(manager.get_by_id('a')['name'], 'iPhone A')
+        self.assertEqual(manager.get_by_name('iPhone B')['id'], 'b')
+        self.assertIsNone(manager.get_by_name('iPhone C'))
+        self.assertEqual(
+            [device['id'] for device in manager], ['a', 'b']
+        )
+        self.assertEqual(len(manager), 2)
+
+    def test_rename(self):
+        manager = self.create_manager(
+            [device_info('a', 'iPhone A')],
+            [device_info('a', 'iPhone Renamed')],
+        )
+        device = manager.get_by_name('iPhone A')
+        manager.refresh_client()
+        self.assertIsNone(manager.get_by_name('iPhone A'))
+        self.assertIs(manager.get_by_name('iPhone Renamed'), device)
+        self.assertIs(manager.get_by_stable_key(device.stable_key), device)
+
+    def test_new_id_for_same_device(self):
+        manager = self.create_manager(
+            [device_info('a', 'iPhone A', discovery_id='x')],
+            [device_info('a2', 'iPhone A', discovery_id='x')],
+        )
+        device = manager.get_by_stable_key('x')
+        manager.refresh_client()
+        self.assertIs(manager.get_by_stable_key('x'), device)
+        self.assertIs(manager.get_by_id('a2'), device)
+        self.assertIsNone(manager.get_by_id('a'))
+        self.assertIs(manager.get_by_name('iPhone A'), device)
+        self.assertEqual(len(manager), 1)
+
+    def test_removed_device(self):
+        manager = self.create_manager(
+            [device_info('a', 'iPhone A'), device_info('b', 'iPhone B')],
+            [device_info('a', 'iPhone A')],
+            [device_info('a', 'iPhone A')],
+        )
+        removed = manager['b']
+        removed.pop_changes()
+        events = []
+        manager.add_listener(
+            lambda device, changes: events.append((device['id'], changes))
+        )
+
+        # a targeted refresh does not remove the other devices
+        manager['a'].location(targeted=True)
+        self.assertIs(manager.get_by_id('b'), removed)
+        self.assertEqual(events, [])
+
+        manager.refresh_client(locate=None)
+        self.assertEqual(events, [('b', set(['removed']))])
+        self.assertEqual(removed.pop_changes(), set(['removed']))
+        self.assertEqual(manager.keys(), ['a'])
+        self.assertIsNone(manager.get_by_id('b'))
+        self.assertIsNone(manager.get_by_name('iPhone B'))
+        self.assertIsNone(manager.get_by_stable_key(removed.stable_key))
+        self.assertEqual(len(manager), 1)
+
+    def test_change_events(self):
+        location = {'timeStamp': 1000, 'latitude': 51.5, 'longitude': 5.4,
+                    'horizontalAccuracy': 65.0}
+        moved = dict(location, timeStamp=2000, latitude=51.6)
+        manager = self.create_manager(
+            [device_info('a', 'iPhone A', location=location),
+             device_info('b', 'iPhone B', location=location)],
+            [device_info('a', 'iPhone A', location=moved),
+             device_info('b', 'iPhone B', location=location)],
+        )
+        self.assertIn('location', manager['a'].pop_changes())
+        self.assertEqual(manager['a'].pop_changes(), set())
+        manager['b'].pop_changes()
+        events = []
+        manager.add_listener(
+            lambda device, changes: events.append((device['id'], changes))
+        )
+
+        manager.refresh_client()
+        self.assertEqual(events, [('a', set(['location']))])
+        self.assertEqual(manager['a'].pop_changes(), set(['location']))
+        self.assertNotIn('location', manager['b'].pop_changes())
+        self.assertFalse(hasattr(manager, 'response'))
+
+    def test_requires_refresh(self):
+        self.session = FakeSession([[device_info('a', 'iPhone A')]])
+        manager = FindMyiPhoneServiceManager('https://fmip', self.session, {})
+        self.assertRaises(PyiCloudDevicesNotRefreshedException, len, manager)
+        self.assertRaises(
+            PyiCloudDevicesNotRefreshedException,
+            manager.get_by_name, 'iPhone A'
+        )
+        self.assertEqual(self.session.requests, [])
+
+        manager.refresh_client()
+        self.assertEqual(len(manager), 1)
+        manager.get_by_name('iPhone A')
+        manager.keys()
+        self.assertEqual(len(self.session.requests), 1)
+
+    def test_targeted_locate(self):
+        manager = self.create_manager(
+            [device_info('a', 'iPhone A'), device_info('b', 'iPhone B')],
+            [device_info('a', 'iPhone A'), device_info('b', 'iPhone B')],
+            [device_info('a', 'iPhone A'), device_info('b', 'iPhone B')],
+        )
+        manager['b'].location(targeted=True)
+        manager.refresh_client(locate=None)
+        contexts = [data['clientContext'] for url, data in self.session.requests]
+        self.assertEqual(contexts[0]['selectedDevice'], 'all')
+        self.assertTrue(contexts[0]['shouldLocate'])
+        self.assertEqual(contexts[1]['selectedDevice'], 'b')
+        self.assertTrue(contexts[1]['shouldLocate'])
+        self.assertFalse(contexts[2]['shouldLocate'])
@@ -0,0 +1,70 @@
+""" Guards the import time and memory of pyicloud, which matter when the
+location fetcher starts on small hardware.
+
+Run this module to print the import time and memory:
+    python -m pyicloud.tests.test_imports
+"""
+from __future__ import print_function
+import json
+import subprocess
+import sys
+
+from unittest2 import TestCase
+
+HEAVY_MODULES = ('pytz', 'tzlocal', 'keyring', 'click')
+
+IMPORT_SCRIPT = """
+import json, resource, sys, time
+start = time.time()
+import %s
+print(json.dumps({
+    'seconds': time.time() - start,
+    'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'modules': sorted(sys.modules),
+}))
+"""
+
+
+def import_stats(module):
+    """ Imports `module` in a new interpreter, and returns the import
+    time, the maximum resident memory and the loaded modules."""
+    output = subprocess.check_output(
+        [sys.executable, '-c', IMPORT_SCRIPT % module]
+    )
+    return json.loads(output.decode('utf-8'))
+
+
+def heavy_modules(stats):
+    return sorted(set(
+        module.split('.')[0] for module in stats['modules']
+        if module.split('.')[0] in HEAVY_MODULES
+    ))
+
+
+class ImportsTestCase(TestCase):
+    def test_base_import_is_light(self):
+        stats = import_stats('pyicloud')
+        self.assertEqual(heavy_modules(stats), [])
+        self.assertIn('pyicloud.services.findmyiphone', stats['modules'])
+        self.assertNotIn('pyicloud.services.photos', stats['modules'])
+
+    def test_services_import_from_package(self):
+        stats = import_stats('pyicloud.services')
+        self.assertEqual(heavy_modules(stats), [])
+        self.assertNotIn('pyicloud.services.photos', stats['modules'])
+
+        stats = import_stats(
+            'pyicloud; from pyicloud.services import CalendarService'
+        )
+        self.assertIn('pyicloud.services.calendar', stats['modules'])
+        self.assertNotIn('pyicloud.services.photos', stats['modules'])
+
+
+if __name__ == '__main__':
+    for module in ('pyicloud', 'pyicloud.services.photos',
+                   'pyicloud.services.calendar', 'pyicloud.cmdline'):
+        stats = import_stats(module)
+        print('%-28s %.3fs %6d kB  heavy modules: %s' % (
+            module, stats['seconds'], stats['max_rss_kb'],
+            ', '.join(heavy_modules(stats)) or '-'
+        ))
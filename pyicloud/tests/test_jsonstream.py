@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import json
+
+from unittest2 import TestCase
+
+from pyicloud.jsonstream import iter_json_array
+
+
+class FakeResponse(object):
+    def __init__(self, content, chunk_size):
+        self.content = content
+        self.chunk_size = chunk_size
+        self.chunks_read = 0
+        self.closed = False
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), self.chunk_size):
+            self.chunks_read += 1
+            yield self.content[i:i + self.chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class IterJsonArrayTestCase(TestCase):
+    data = {
+        'serverContext': {'records': 'not this one', 'list': [1, [2]]},
+        'name': 'records',
+        'records': [
+            {'recordName': u'caf\xe9 ☃', 'size': 12345},
+            {'recordName': 'b"\\\\', 'fields': {'a': [1, 2.5, None]}},
+            123456789,
+            'text',
+        ],
+        'syncToken': 'x',
+    }
+
+    def test_items(self):
+        content = json.dumps(self.data, ensure_ascii=False).encode('utf-8')
+        for chunk_size in (1, 2, 3, 5, 16, len(content)):
+            response = FakeResponse(content, chunk_size)
+            self.assertEqual(
+                list(iter_json_array(response, 'records')),
+                self.data['records']
+            )
+
+    def test_yields_while_reading(self):
+        records = [{'recordName': str(i)} for i in range(100)]
+        content = json.dumps({'records': records}).encode('utf-8')
+        response = FakeResponse(content, 32)
+        items = iter_json_array(response, 'records')
+        self.assertEqual(next(items), records[0])
+        self.assertLess(response.chunks_read, 3)
+
+    def test_reads_rest_and_closes(self):
+        content = b'{"records": [1, 2], "trailer": "' + b'x' * 100 + b'"}'
+        response = FakeResponse(content, 8)
+        self.assertEqual(list(iter_json_array(response, 'records')), [1, 2])
+        self.assertEqual(response.chunks_read, (len(content) + 7) // 8)
+        self.assertTrue(response.closed)
+
+    def test_closes_when_abandoned(self):
+        response = FakeResponse(b'{"records": [1, 2, 3]}', 4)
+        items = iter_json_array(response, 'records')
+        next(items)
+        items.close()
+        self.assertTrue(response.closed)
+
+    def test_missing_array(self):
+        response = FakeResponse(b'{"other": [1, 2]}', 4)
+        with self.assertRaises(ValueError):
+            list(iter_json_array(response, 'records'))
+        self.assertTrue(response.closed)
+
+    def test_missing_array_is_checked(self):
+        checked = []
+        response = FakeResponse(b'{"errorCode": "ACCESS_DENIED"}', 4)
+        response.check_json = checked.append
+        with self.assertRaises(ValueError):
+            list(iter_json_array(response, 'records'))
+        self.assertEqual(checked, [{'errorCode': 'ACCESS_DENIED'}])
+
+    def test_truncated(self):
+        response = FakeResponse(b'{"records": [{"a": 1}, {"b":', 4)
+        with self.assertRaises(ValueError):
+            list(iter_json_array(response, 'records'))
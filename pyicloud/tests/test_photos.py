@@ -0,0 +1,172 @@
+import json
+import threading
+
+from unittest2 import TestCase
+
+from pyicloud.services.photos import PhotoAlbum, _PageFetcher
+from pyicloud.tests.test_findmyiphone import FakeResponse
+
+
+def photo_records(rank):
+    master = {'recordType': 'CPLMaster', 'recordName': 'master-%d' % rank}
+    asset = {
+        'recordType': 'CPLAsset',
+        'recordName': 'asset-%d' % rank,
+        'fields': {
+            'masterRef': {'value': {'recordName': master['recordName']}}
+        }
+    }
+    return [asset, master]
+
+
+class FakePhotosSession(object):
+    """ Answers the queries of an album of `count` photos, of which
+    `listed` are listed, to fake photos added or removed after counting.
+    """
+
+    def __init__(self, count, listed=None, masters_first=False,
+                 unpaired=()):
+        self.count = count
+        self.listed = count if listed is None else listed
+        self.masters_first = masters_first
+        self.unpaired = unpaired
+        self.lock = threading.Lock()
+        self.pages = []
+        self.counted = False
+
+    def post(self, url, **kwargs):
+        query = json.loads(kwargs['data'])
+        if 'batch' in query:
+            self.counted = True
+            return FakeResponse({'batch': [{'records': [{'fields': {
+                'itemCount': {'value': self.count}
+            }}]}]})
+        offset = query['query']['filterBy'][0]['fieldValue']['value']
+        direction = query['query']['filterBy'][1]['fieldValue']['value']
+        page_size = query['resultsLimit'] // 2
+        with self.lock:
+            self.pages.append((offset, page_size))
+        if direction == 'DESCENDING':
+            ranks = range(offset, max(offset - page_size, -1), -1)
+        else:
+            ranks = range(max(offset, 0), min(offset + page_size, self.listed))
+        records = []
+        for rank in ranks:
+            if 0 <= rank < self.listed:
+                asset, master = photo_records(rank)
+                if rank in self.unpaired:
+                    records.append(master)
+                elif self.masters_first:
+                    records.insert(0, asset)
+                    records.append(master)
+                else:
+                    records.extend([asset, master])
+        return FakeResponse({'records': records})
+
+
+class FakePhotosService(object):
+    def __init__(self, session):
+        self.session = session
+        self.params = {}
+        self._service_endpoint = 'https://photos'
+
+
+class PhotoAlbumTestCase(TestCase):
+    def list_ranks(self, session, direction='ASCENDING', **kwargs):
+        album = PhotoAlbum(
+            FakePhotosService(session), 'All Photos', 'CPLAssetAndMaster',
+            'CPLAssetByAddedDate', direction, **kwargs
+        )
+        return [int(photo.id.split('-')[1]) for photo in album]
+
+    def test_sequential_by_default(self):
+        session = FakePhotosSession(250)
+        album = PhotoAlbum(
+            FakePhotosService(session), 'All Photos', 'CPLAssetAndMaster',
+            'CPLAssetByAddedDate', 'ASCENDING', page_size=30
+        )
+        threads = set(threading.enumerate())
+        photos = iter(album)
+        self.assertEqual(next(photos).id, 'master-0')
+        self.assertEqual(set(threading.enumerate()) - threads, set())
+        self.assertEqual(len(list(photos)), 249)
+        self.assertFalse(session.counted)
+        self.assertEqual(session.pages,
+                         [(offset, 30) for offset in range(0, 250, 30)] +
+                         [(250, 30)])
+
+    def test_prefetched_in_order(self):
+        for prefetch in (0, 1, 4):
+            session = FakePhotosSession(250)
+            ranks = self.list_ranks(session, page_size=30, prefetch=prefetch)
+            self.assertEqual(ranks, list(range(250)))
+
+        for prefetch in (0, 4):
+            session = FakePhotosSession(250)
+            ranks = self.list_ranks(session, 'DESCENDING', page_size=30,
+                                    prefetch=prefetch)
+            self.assertEqual(ranks, list(range(249, -1, -1)))
+
+    def test_masters_in_order(self):
+        # the asset records are received in reverse order, after the masters
+        for prefetch in (0, 4):
+            session = FakePhotosSession(100, masters_first=True)
+            ranks = self.list_ranks(session, page_size=30, prefetch=prefetch)
+            self.assertEqual(ranks, list(range(100)))
+
+    def test_unpaired_records(self):
+        session = FakePhotosSession(10, unpaired=(3, 7))
+        with self.assertLogs('pyicloud.services.photos', 'WARNING') as logs:
+            ranks = self.list_ranks(session, page_size=5)
+        self.assertEqual(ranks, [0, 1, 2, 4, 5, 6, 8, 9])
+        self.assertEqual(logs.output, [
+            'WARNING:pyicloud.services.photos:Skipping photo master-%d of '
+            'album All Photos, which has no asset record' % rank
+            for rank in (3, 7)
+        ])
+
+    def test_album_changed(self):
+        for prefetch in (0, 4):
+            session = FakePhotosSession(100, listed=130)
+            ranks = self.list_ranks(session, page_size=25, prefetch=prefetch)
+            self.assertEqual(ranks, list(range(130)))
+
+            session = FakePhotosSession(100, listed=70)
+            ranks = self.list_ranks(session, page_size=25, prefetch=prefetch)
+            self.assertEqual(ranks, list(range(70)))
+
+    def test_page_size_adapted(self):
+        session = FakePhotosSession(1000)
+        ranks = self.list_ranks(session, page_size=25, prefetch=2)
+        self.assertEqual(ranks, list(range(1000)))
+        # the fake pages are fast, so the page size grows
+        self.assertGreater(max(size for offset, size in session.pages), 25)
+
+
+class BlockingAlbum(object):
+    def __init__(self):
+        self.offsets = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def _fetch_page(self, page):
+        self.offsets.append(page.offset)
+        self.started.set()
+        self.release.wait()
+        return [], 0
+
+
+class PageFetcherTestCase(TestCase):
+    def test_cancelled_page_not_requested(self):
+        album = BlockingAlbum()
+        fetcher = _PageFetcher(album, 1)
+        first_page = fetcher.submit(0, 25)
+        self.assertTrue(album.started.wait(5))
+        cancelled_page = fetcher.submit(25, 25)
+        last_page = fetcher.submit(50, 25)
+        cancelled_page.cancel()
+        album.release.set()
+        self.assertEqual(first_page.result(), ([], 0))
+        self.assertEqual(last_page.result(), ([], 0))
+        fetcher.close()
+        self.assertEqual(album.offsets, [0, 50])
@@ -0,0 +1,69 @@
+from unittest2 import TestCase
+
+from pyicloud.exceptions import PyiCloudRateLimitExceeded
+from pyicloud.ratelimit import (
+    RateLimiter,
+    PRIORITY_HIGH,
+    PRIORITY_LOW
+)
+
+
+class RateLimiterTestCase(TestCase):
+    def setUp(self):
+        self.limiter = RateLimiter({'refreshClient': (4, 3600)})
+
+    def test_endpoint_for_url(self):
+        self.assertEqual(
+            RateLimiter.endpoint_for_url(
+                'https://p01-fmipweb.icloud.com/fmipservice/client/web/'
+                'refreshClient?dsid=1'
+            ),
+            'refreshClient'
+        )
+
+    def test_unlimited_endpoint(self):
+        for i in range(10):
+            self.limiter.acquire('login')
+        self.assertTrue(self.limiter.admit('login', PRIORITY_LOW))
+
+    def test_not_limited_by_default(self):
+        limiter = RateLimiter()
+        for i in range(20):
+            limiter.acquire('login')
+        self.assertTrue(limiter.admit('refreshClient', PRIORITY_LOW))
+
+    def test_acquire_does_not_wait(self):
+        for i in range(4):
+            self.limiter.acquire('refreshClient')
+        with self.assertRaises(PyiCloudRateLimitExceeded) as context:
+            self.limiter.acquire('refreshClient')
+        self.assertGreater(context.exception.wait_time, 0)
+
+        limiter = RateLimiter({'refreshClient': (1, 0.05)})
+        limiter.acquire('refreshClient')
+        limiter.acquire('refreshClient', max_wait=1)
+        self.assertRaises(
+            PyiCloudRateLimitExceeded, limiter.acquire, 'refreshClient'
+        )
+
+    def test_low_priority_keeps_reserve(self):
+        self.limiter.acquire('refreshClient')
+        self.limiter.acquire('refreshClient')
+        self.assertFalse(self.limiter.admit('refreshClient', PRIORITY_LOW))
+        self.assertTrue(self.limiter.admit('refreshClient', PRIORITY_HIGH))
+        self.assertGreater(
+            self.limiter.wait_time('refreshClient', PRIORITY_LOW), 0
+        )
+
+    def test_throttled_reduces_rate(self):
+        self.limiter.throttled('refreshClient')
+        self.assertFalse(self.limiter.admit('refreshClient', PRIORITY_HIGH))
+        bucket = self.limiter._bucket('refreshClient')
+        self.assertLess(bucket.rate, bucket.max_rate)
+        self.limiter.succeeded('refreshClient')
+        self.assertGreater(bucket.rate, bucket.max_rate / 2)
+
+    def test_shared_per_account(self):
+        limiter = RateLimiter.for_account('test@example.com')
+        self.assertIs(limiter, RateLimiter.for_account('test@example.com'))
+        self.assertIsNot(limiter, RateLimiter.for_account('other@example.com'))
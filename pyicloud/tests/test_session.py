@@ -0,0 +1,198 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+from unittest2 import TestCase
+
+from pyicloud.base import PyiCloudCookieJar, PyiCloudSession, cookielib
+from pyicloud.exceptions import PyiCloudAPIResponseError
+from pyicloud.jsonstream import iter_json_array
+from pyicloud.ratelimit import RateLimiter
+from pyicloud.transport import TransportPolicy
+
+
+def create_cookie(name, value):
+    return cookielib.Cookie(
+        0, name, value, None, False, '.icloud.com', True, True, '/', False,
+        False, None, False, None, None, {}
+    )
+
+
+class PyiCloudCookieJarTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cookies')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save_and_load(self):
+        jar = PyiCloudCookieJar(filename=self.path)
+        jar.set_cookie(create_cookie('X-APPLE-WEB-KB', 'token'))
+        jar.save(ignore_discard=True)
+
+        loaded = PyiCloudCookieJar(filename=self.path)
+        loaded.load(ignore_discard=True)
+        self.assertEqual([c.value for c in loaded], ['token'])
+        self.assertEqual(os.listdir(self.directory), ['cookies'])
+
+    def test_concurrent_updates(self):
+        jar = PyiCloudCookieJar(filename=self.path)
+        errors = []
+
+        def add_cookies(thread_number):
+            try:
+                for i in range(200):
+                    jar.set_cookie(
+                        create_cookie('c-%d-%d' % (thread_number, i), 'v')
+                    )
+            except Exception as e:
+                errors.append(e)
+
+        def save_and_iterate():
+            try:
+                for i in range(20):
+                    jar.save(ignore_discard=True)
+                    list(jar)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [
+            threading.Thread(target=add_cookies, args=(n,)) for n in range(4)
+        ] + [threading.Thread(target=save_and_iterate) for n in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(jar), 800)
+        self.assertEqual(os.listdir(self.directory), ['cookies'])
+
+
+class ScriptedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        status_code, body = self.server.responses.pop(0)
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ScriptedServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Answers the requests with the (status code, body) `responses`. """
+    daemon_threads = True
+
+    def __init__(self, responses):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('localhost', 0), ScriptedHandler
+        )
+        self.responses = [
+            (status_code, json.dumps(body).encode('utf-8')
+             if not isinstance(body, bytes) else body)
+            for status_code, body in responses
+        ]
+        self.url = 'http://localhost:%d' % self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+class FakeService(object):
+    requires_2sa = False
+
+    def __init__(self, rate_limits=None, pool_size=10, transport=None):
+        self._password_filter = logging.Filter()
+        self.rate_limiter = RateLimiter(rate_limits)
+        self.transport = transport or TransportPolicy()
+        self.session = PyiCloudSession(self, pool_size)
+
+
+class PyiCloudSessionTestCase(TestCase):
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_throttled_once(self):
+        self.server = ScriptedServer([
+            (503, {'errorCode': 'ACCESS_DENIED', 'reason': 'Denied'}),
+        ])
+        service = FakeService({'*': (10, 60)})
+        bucket = service.rate_limiter._bucket('refreshClient')
+        self.assertRaises(
+            PyiCloudAPIResponseError,
+            service.session.post, self.server.url + '/refreshClient'
+        )
+        self.assertEqual(bucket.rate, bucket.max_rate / 2)
+
+    def test_no_retry_after_deadline(self):
+        self.server = ScriptedServer([(502, {}), (502, {}), (200, {})])
+        # the token for a retry is only available after the deadline
+        service = FakeService({'refreshClient': (1, 60)})
+        start_time = time.time()
+        response = service.session.post(
+            self.server.url + '/refreshClient', deadline=10
+        )
+        self.assertEqual(response.status_code, 502)
+        self.assertLess(time.time() - start_time, 5)
+        self.assertEqual(len(self.server.responses), 2)
+
+        # without a limit the request is retried
+        self.server.responses = [(502, b'{}'), (200, b'{}')]
+        service = FakeService()
+        response = service.session.post(
+            self.server.url + '/refreshClient', deadline=10
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_streamed_responses_release_connections(self):
+        body = {'content': [1, 2, 3], 'trailer': 'x' * 40000}
+        self.server = ScriptedServer([(200, body)] * 6)
+        service = FakeService(pool_size=2)
+        results = []
+
+        def stream():
+            for i in range(6):
+                response = service.session.post(
+                    self.server.url + '/refreshClient', stream=True
+                )
+                items = iter_json_array(response, 'content')
+                if i % 2:
+                    # abandoned after the first item
+                    results.append(next(items))
+                    items.close()
+                else:
+                    results.append(list(items))
+
+        # with the connections of the pool not released, this would hang
+        thread = threading.Thread(target=stream)
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        self.assertEqual(results, [[1, 2, 3], 1] * 3)
+
+    def test_streamed_error(self):
+        self.server = ScriptedServer([
+            (200, {'errorCode': 'ACCESS_DENIED', 'reason': 'Denied'}),
+        ])
+        service = FakeService({'*': (10, 60)})
+        bucket = service.rate_limiter._bucket('refreshClient')
+        response = service.session.post(
+            self.server.url + '/refreshClient', stream=True
+        )
+        with self.assertRaises(PyiCloudAPIResponseError):
+            list(iter_json_array(response, 'content'))
+        self.assertEqual(bucket.rate, bucket.max_rate / 2)
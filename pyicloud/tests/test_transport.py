@@ -0,0 +1,51 @@
+from requests.exceptions import ConnectTimeout, ReadTimeout
+from unittest2 import TestCase
+
+from pyicloud.transport import TransportPolicy
+
+
+class TransportPolicyTestCase(TestCase):
+    def setUp(self):
+        self.policy = TransportPolicy(
+            timeouts={'refreshClient': (5, 20)},
+            deadlines={'refreshClient': 30}
+        )
+
+    def test_timeouts(self):
+        self.assertEqual(self.policy.timeout('refreshClient', 100), (5, 20))
+        self.assertEqual(self.policy.timeout('refreshClient', 12), (5, 12))
+        self.assertEqual(self.policy.timeout('playSound', 100), (10, 60))
+        self.assertEqual(self.policy.deadline('refreshClient'), 30)
+        self.assertEqual(self.policy.deadline('playSound'), 120)
+
+    def test_retry_idempotent(self):
+        self.assertIsNotNone(self.policy.retry_delay(
+            'GET', 'getDevices', 0, 100, error=ReadTimeout()
+        ))
+        self.assertIsNotNone(self.policy.retry_delay(
+            'POST', 'refreshClient', 0, 100, status_code=502
+        ))
+        self.assertIsNone(self.policy.retry_delay(
+            'POST', 'refreshClient', 0, 100, status_code=503
+        ))
+        self.assertIsNone(self.policy.retry_delay(
+            'GET', 'getDevices', 0, 100, status_code=200
+        ))
+
+    def test_retry_not_idempotent(self):
+        self.assertIsNone(self.policy.retry_delay(
+            'POST', 'playSound', 0, 100, error=ReadTimeout()
+        ))
+        # the request did not reach the server
+        self.assertIsNotNone(self.policy.retry_delay(
+            'POST', 'playSound', 0, 100, error=ConnectTimeout()
+        ))
+
+    def test_retry_limits(self):
+        self.assertIsNone(self.policy.retry_delay(
+            'GET', 'getDevices', 2, 100, error=ReadTimeout()
+        ))
+        # the backoff of the second retry is at least 1 second
+        self.assertIsNone(self.policy.retry_delay(
+            'GET', 'getDevices', 1, 0.5, error=ReadTimeout()
+        ))
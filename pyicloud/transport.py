@@ -0,0 +1,100 @@
+import logging
+import random
+
+from requests.exceptions import ConnectTimeout
+
+from pyicloud.ratelimit import ANY_ENDPOINT
+
+
+logger = logging.getLogger(__name__)
+
+# Endpoint name: (connect timeout, read timeout) in seconds
+DEFAULT_TIMEOUTS = {
+    'login': (10, 30),
+    'refreshClient': (10, 30),
+    ANY_ENDPOINT: (10, 60),
+}
+# Endpoint name: seconds after which no more attempts are made
+DEFAULT_DEADLINES = {
+    'login': 60,
+    'refreshClient': 60,
+    ANY_ENDPOINT: 120,
+}
+DEFAULT_MAX_RETRIES = 2
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+# POST endpoints which only read, so they can be retried as well
+IDEMPOTENT_ENDPOINTS = ('refreshClient', 'query')
+# 503 is not retried, as it is a throttling response
+RETRY_STATUS_CODES = (500, 502, 504)
+RETRY_BACKOFF_BASE = 1.0
+
+
+class TransportPolicy(object):
+    """ Decides the timeouts, retries and deadlines of the requests.
+
+    Timeouts and deadlines are given per endpoint name, as for the rate
+    limits (see `pyicloud.ratelimit`), with `*` matching all other
+    endpoints. The deadline limits the total time of a request including
+    its retries: the read timeout of an attempt is reduced to the time
+    left, and no attempt is started after the deadline.
+
+    Connection errors, timeouts and server errors are retried, up to
+    `max_retries` times, with a jittered exponential backoff. A request
+    which did not reach the server (a connect timeout) is always retried,
+    other requests only when the method or endpoint is idempotent.
+    """
+
+    def __init__(
+        self, timeouts=None, deadlines=None, max_retries=DEFAULT_MAX_RETRIES,
+        idempotent_endpoints=IDEMPOTENT_ENDPOINTS
+    ):
+        self.timeouts = dict(DEFAULT_TIMEOUTS)
+        self.timeouts.update(timeouts or {})
+        self.deadlines = dict(DEFAULT_DEADLINES)
+        self.deadlines.update(deadlines or {})
+        self.max_retries = max_retries
+        self.idempotent_endpoints = idempotent_endpoints
+
+    @staticmethod
+    def _for_endpoint(values, endpoint):
+        return values.get(endpoint, values[ANY_ENDPOINT])
+
+    def deadline(self, endpoint):
+        return self._for_endpoint(self.deadlines, endpoint)
+
+    def timeout(self, endpoint, remaining):
+        """ Returns the (connect, read) timeout of an attempt, with
+        `remaining` seconds left until the deadline."""
+        connect_timeout, read_timeout = \
+            self._for_endpoint(self.timeouts, endpoint)
+        remaining = max(remaining, 0.1)
+        return min(connect_timeout, remaining), min(read_timeout, remaining)
+
+    def is_idempotent(self, method, endpoint):
+        return method.upper() in IDEMPOTENT_METHODS or \
+            endpoint in self.idempotent_endpoints
+
+    def retry_delay(
+        self, method, endpoint, attempt, remaining,
+        error=None, status_code=None
+    ):
+        """ Returns the number of seconds to wait before retrying a failed
+        attempt, or None if it should not be retried.
+
+        `attempt` is the number of the failed attempt, starting at 0, and
+        the failure is either the `error` raised, or the `status_code`.
+        """
+        if error is None and status_code not in RETRY_STATUS_CODES:
+            return None
+        if attempt >= self.max_retries:
+            return None
+        if not isinstance(error, ConnectTimeout) and \
+                not self.is_idempotent(method, endpoint):
+            return None
+
+        backoff = RETRY_BACKOFF_BASE * 2 ** attempt
+        delay = backoff / 2.0 + random.uniform(0, backoff / 2.0)
+        if delay >= remaining:
+            return None
+        return delay
@@ -1,11 +1,11 @@
 import getpass
-import keyring
 import sys
 
 from .exceptions import NoStoredPasswordAvailable
 
 
 KEYRING_SYSTEM = 'pyicloud://icloud-password'
+# keyring is imported when used, as importing it loads all of its backends
 
 
 def get_password(username, interactive=sys.stdout.isatty()):
@@ -32,6 +32,7 @@ def password_exists_in_keyring(username):
 
 
 def get_password_from_keyring(username):
+    import keyring
     result = keyring.get_password(
         KEYRING_SYSTEM,
         username
@@ -50,6 +51,7 @@ def get_password_from_keyring(username):
 
 
 def store_password_in_keyring(username, password):
+    import keyring
     return keyring.set_password(
         KEYRING_SYSTEM,
         username,
@@ -58,6 +60,7 @@ def store_password_in_keyring(username, password):
 
 
 def delete_password_in_keyring(username):
+    import keyring
     return keyring.delete_password(
         KEYRING_SYSTEM,
         username,
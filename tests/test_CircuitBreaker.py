@@ -0,0 +1,135 @@
+import time
+
+import requests
+from unittest2 import TestCase
+
+import CircuitBreaker as circuit_breaker_module
+from CircuitBreaker import (CircuitBreaker, classify_error, BACKOFF_BASE_IN_S, MAX_BACKOFF_IN_S, ERROR_ACTION_NEEDED,
+                            ERROR_AUTH, ERROR_BUG, ERROR_THROTTLE, ERROR_TRANSIENT, STATE_CLOSED, STATE_HALF_OPEN,
+                            STATE_OPEN)
+from pyicloud.exceptions import (PyiCloud2SARequiredError, PyiCloudAPIResponseError, PyiCloudFailedLoginException,
+                                 PyiCloudRateLimitExceeded, PyiCloudServiceNotActivatedErrror)
+
+
+class FixedRandom(object):
+    '''
+    Returns the given fraction of the range, instead of a random value
+    '''
+
+    def __init__(self, fraction):
+        self.fraction = fraction
+
+    def uniform(self, a, b):
+        return a + (b - a) * self.fraction
+
+
+class ClassifyErrorTestCase(TestCase):
+    def test_throttle(self):
+        for code in 429, 503, 'ACCESS_DENIED':
+            self.assertEqual(classify_error(PyiCloudAPIResponseError("throttled", code)), ERROR_THROTTLE)
+        self.assertEqual(classify_error(PyiCloudRateLimitExceeded('refreshClient', 10)), ERROR_THROTTLE)
+
+    def test_auth(self):
+        for code in 401, 421, 450, 'AUTHENTICATION_FAILED':
+            self.assertEqual(classify_error(PyiCloudAPIResponseError("unauthorized", code)), ERROR_AUTH)
+        self.assertEqual(classify_error(PyiCloudFailedLoginException("invalid password")), ERROR_AUTH)
+
+    def test_action_needed(self):
+        self.assertEqual(classify_error(PyiCloud2SARequiredError('apple id')), ERROR_ACTION_NEEDED)
+        self.assertEqual(classify_error(PyiCloudServiceNotActivatedErrror("not activated", 'ZONE_NOT_FOUND')),
+                         ERROR_ACTION_NEEDED)
+
+    def test_transient(self):
+        self.assertEqual(classify_error(PyiCloudAPIResponseError("server error", 500)), ERROR_TRANSIENT)
+        self.assertEqual(classify_error(requests.ConnectionError("refused")), ERROR_TRANSIENT)
+        self.assertEqual(classify_error(requests.Timeout("timed out")), ERROR_TRANSIENT)
+
+    def test_bug(self):
+        self.assertEqual(classify_error(KeyError('latitude')), ERROR_BUG)
+        self.assertEqual(classify_error(TypeError("unsupported operand")), ERROR_BUG)
+
+
+class CircuitBreakerTestCase(TestCase):
+    def setUp(self):
+        self.random = circuit_breaker_module.random
+        circuit_breaker_module.random = FixedRandom(1.0)
+        self.breaker = CircuitBreaker('login')
+
+    def tearDown(self):
+        circuit_breaker_module.random = self.random
+
+    def test_backoff_doubles_up_to_max(self):
+        for error_type, base in BACKOFF_BASE_IN_S.items():
+            breaker = CircuitBreaker(error_type)
+            backoffs = [breaker.record_failure(error_type) for _ in range(12)]
+            expected = [min(base * 2 ** i, MAX_BACKOFF_IN_S) for i in range(12)]
+            self.assertEqual(backoffs, expected)
+            self.assertEqual(backoffs[-1], MAX_BACKOFF_IN_S)
+
+    def test_success_resets_backoff(self):
+        self.breaker.record_failure(ERROR_TRANSIENT)
+        self.assertEqual(self.breaker.record_failure(ERROR_TRANSIENT), 30)
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.record_failure(ERROR_TRANSIENT), 15)
+
+    def test_jitter(self):
+        circuit_breaker_module.random = FixedRandom(0.0)
+        self.assertEqual(self.breaker.record_failure(ERROR_THROTTLE), 60)
+        circuit_breaker_module.random = self.random
+        for _ in range(100):
+            self.breaker.record_success()
+            backoff = self.breaker.record_failure(ERROR_THROTTLE)
+            self.assertGreaterEqual(backoff, 60)
+            self.assertLessEqual(backoff, 120)
+            self.assertAlmostEqual(self.breaker.get_retry_delay(), backoff, delta=1)
+
+    def test_states(self):
+        self.assertEqual(self.breaker.state, STATE_CLOSED)
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.get_retry_delay(), 0)
+
+        self.breaker.record_failure(ERROR_AUTH)
+        self.assertEqual(self.breaker.state, STATE_OPEN)
+        self.assertFalse(self.breaker.allow())
+
+        # a failing probe opens the breaker again, with a longer backoff
+        self.breaker.retry_timestamp = time.time() - 1
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, STATE_HALF_OPEN)
+        self.assertEqual(self.breaker.record_failure(ERROR_AUTH), 120)
+        self.assertEqual(self.breaker.state, STATE_OPEN)
+        self.assertFalse(self.breaker.allow())
+
+        self.breaker.retry_timestamp = time.time() - 1
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, STATE_CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_cancel_probe(self):
+        self.breaker.record_failure(ERROR_BUG)
+        self.breaker.retry_timestamp = time.time() - 1
+        self.assertTrue(self.breaker.allow())
+        self.breaker.cancel_probe()
+        self.assertEqual(self.breaker.state, STATE_OPEN)
+        self.assertEqual(self.breaker.failure_count, 1)
+        # the probe is allowed again
+        self.assertTrue(self.breaker.allow())
+
+    def test_is_open_has_no_side_effects(self):
+        self.assertFalse(self.breaker.is_open())
+        self.breaker.record_failure(ERROR_AUTH)
+        self.assertTrue(self.breaker.is_open())
+        self.assertFalse(self.breaker.allow())
+
+        self.breaker.retry_timestamp = time.time() - 1
+        self.assertFalse(self.breaker.is_open())
+        self.assertEqual(self.breaker.state, STATE_OPEN)
+        # allow() starts the probe, during which no other calls are allowed
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, STATE_HALF_OPEN)
+        self.assertTrue(self.breaker.is_open())
+        self.assertFalse(self.breaker.allow())
+
+        self.breaker.record_success()
+        self.assertFalse(self.breaker.is_open())
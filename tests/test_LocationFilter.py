@@ -0,0 +1,66 @@
+import random
+
+from unittest2 import TestCase
+
+from Location import Location, distance_meters
+from LocationFilter import LocationFilter
+
+HOME = (52.0, 5.0)
+SPOT = (52.1, 5.1)
+METERS_PER_DEGREE = 111320.0
+
+
+def location_near(position, offset_m, accuracy, timestamp):
+    latitude, longitude = position
+    return Location(latitude + offset_m / METERS_PER_DEGREE, longitude, accuracy, timestamp)
+
+
+class LocationFilterTestCase(TestCase):
+    def setUp(self):
+        Location.set_home_position(HOME)
+        self.location_filter = LocationFilter()
+
+    def test_first_fix(self):
+        fix = location_near(SPOT, 0, 80, 1000)
+        self.assertIs(self.location_filter.process(fix), fix)
+        self.assertEqual(self.location_filter.fused_count, 1)
+
+    def test_same_fix_is_fused_once(self):
+        self.location_filter.process(location_near(SPOT, 0, 80, 1000))
+        estimate = self.location_filter.process(location_near(SPOT, 30, 80, 1000))
+        self.assertEqual(self.location_filter.fused_count, 1)
+        self.assertEqual(estimate.latitude, SPOT[0])
+
+    def test_stationary_noisy_fixes(self):
+        random.seed(1)
+        for i in range(10):
+            estimate = self.location_filter.process(location_near(SPOT, random.uniform(-60, 60), 80, 1000 + i))
+        self.assertEqual(self.location_filter.fused_count, 10)
+        # the estimate is more accurate than each fix, and closer to the real spot than the noise
+        self.assertLess(estimate.accuracy, 80)
+        self.assertLess(distance_meters((estimate.latitude, estimate.longitude), SPOT), 40)
+
+    def test_accurate_fix_weighs_more(self):
+        self.location_filter.process(location_near(SPOT, 0, 100, 1000))
+        estimate = self.location_filter.process(location_near(SPOT, 50, 10, 1001))
+        self.assertGreater(distance_meters((estimate.latitude, estimate.longitude), SPOT), 45)
+        self.assertLessEqual(estimate.accuracy, 10)
+
+    def test_moving_device_restarts(self):
+        self.location_filter.process(location_near(SPOT, 0, 50, 1000))
+        self.location_filter.process(location_near(SPOT, 10, 50, 1010))
+        fix = location_near(SPOT, 2000, 50, 1070)
+        self.assertIs(self.location_filter.process(fix), fix)
+        self.assertEqual(self.location_filter.fused_count, 1)
+
+    def test_uncertainty_grows_with_time(self):
+        self.location_filter.process(location_near(SPOT, 0, 50, 1000))
+        # after an hour the old estimate hardly counts
+        estimate = self.location_filter.process(location_near(SPOT, 100, 50, 4600))
+        self.assertGreater(distance_meters((estimate.latitude, estimate.longitude), SPOT), 95)
+
+    def test_reset(self):
+        self.location_filter.process(location_near(SPOT, 0, 50, 1000))
+        self.location_filter.reset()
+        self.assertIsNone(self.location_filter.estimate)
+        self.assertEqual(str(self.location_filter), 'No estimate')
@@ -0,0 +1,75 @@
+import threading
+import urllib2
+
+from unittest2 import TestCase
+
+import Metrics
+from Metrics import Counter, Gauge, Histogram, MetricsRequestHandler, Registry, ThreadingHTTPServer
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = Counter('test_requests_total', 'Requests', ['endpoint'], registry=self.registry)
+        counter.inc(endpoint='login')
+        counter.inc(2, endpoint='login')
+        counter.inc(endpoint='refresh"Client')
+        self.assertEqual(self.registry.expose(), '\n'.join([
+            '# HELP test_requests_total Requests',
+            '# TYPE test_requests_total counter',
+            'test_requests_total{endpoint="login"} 3.0',
+            'test_requests_total{endpoint="refresh\\"Client"} 1.0',
+        ]) + '\n')
+        self.assertRaises(ValueError, counter.inc)
+
+    def test_gauge(self):
+        gauge = Gauge('test_devices', 'Devices', ['device'], registry=self.registry)
+        gauge.set(4, device='a')
+        gauge.set_function(lambda: None, device='b')
+        gauge.set_function(lambda: 1.5, device='c')
+        lines = self.registry.expose().splitlines()
+        self.assertEqual(lines[2:], ['test_devices{device="a"} 4.0', 'test_devices{device="c"} 1.5'])
+        gauge.remove(device='a')
+        self.assertEqual(self.registry.expose().splitlines()[2:], ['test_devices{device="c"} 1.5'])
+
+    def test_histogram(self):
+        histogram = Histogram('test_duration_seconds', 'Duration', buckets=(1, 5), registry=self.registry)
+        histogram.observe(0.5)
+        histogram.observe(3)
+        histogram.observe(10)
+        self.assertEqual(self.registry.expose().splitlines()[2:], [
+            'test_duration_seconds_bucket{le="1.0"} 1.0',
+            'test_duration_seconds_bucket{le="5.0"} 2.0',
+            'test_duration_seconds_bucket{le="+Inf"} 3.0',
+            'test_duration_seconds_count 3.0',
+            'test_duration_seconds_sum 13.5',
+        ])
+
+
+class ScrapedRequestHandler(MetricsRequestHandler):
+    registry = Registry()
+
+
+class MetricsServerTestCase(TestCase):
+    def setUp(self):
+        Counter('test_scrapes_total', 'Scrapes', registry=ScrapedRequestHandler.registry).inc()
+        self.server = ThreadingHTTPServer(('localhost', 0), ScrapedRequestHandler)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.url = 'http://localhost:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        ScrapedRequestHandler.registry.metrics = []
+
+    def test_metrics(self):
+        response = urllib2.urlopen(self.url + '/metrics')
+        self.assertEqual(response.info()['Content-Type'], Metrics.CONTENT_TYPE)
+        self.assertIn('test_scrapes_total 1.0\n', response.read())
+
+    def test_unknown_path(self):
+        with self.assertRaises(urllib2.HTTPError) as context:
+            urllib2.urlopen(self.url + '/other')
+        self.assertEqual(context.exception.code, 404)
@@ -0,0 +1,159 @@
+import socket
+import struct
+import threading
+import time
+
+from unittest2 import TestCase
+
+import MqttPublisher
+from MqttPublisher import CONNACK, CONNECT, DISCONNECT, PINGREQ, PINGRESP, PUBACK, PUBLISH, encode_packet
+
+
+def read_packet(connection):
+    def read_bytes(length):
+        data = ''
+        while len(data) < length:
+            chunk = connection.recv(length - len(data))
+            if not chunk:
+                raise IOError("connection closed")
+            data += chunk
+        return data
+
+    header = ord(read_bytes(1))
+    remaining_length = 0
+    multiplier = 1
+    while True:
+        digit = ord(read_bytes(1))
+        remaining_length += (digit & 0x7f) * multiplier
+        if not digit & 0x80:
+            break
+        multiplier *= 128
+    return header >> 4, header & 0x0f, read_bytes(remaining_length)
+
+
+class FakeBroker(object):
+    '''
+    Accepts MQTT connections on a free local port, with the connect return code, and records the published
+    messages as (topic, payload, flags)
+    '''
+
+    def __init__(self, return_code=0, stalled=False):
+        self.return_code = return_code
+        # stop reading after the connect, like a broker which hangs
+        self.stalled = stalled
+        self.closed = threading.Event()
+        self.connections = 0
+        self.messages = []
+        self.disconnected = False
+        self.server = socket.socket()
+        self.server.bind(('localhost', 0))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+
+    def accept(self):
+        while True:
+            try:
+                connection = self.server.accept()[0]
+            except socket.error:
+                return
+            self.connections += 1
+            thread = threading.Thread(target=self.serve, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def serve(self, connection):
+        try:
+            packet_type, flags, body = read_packet(connection)
+            assert packet_type == CONNECT
+            connection.sendall(encode_packet(CONNACK, 0, chr(0) + chr(self.return_code)))
+            if self.stalled:
+                self.closed.wait()
+                return
+            while self.return_code == 0:
+                packet_type, flags, body = read_packet(connection)
+                if packet_type == PUBLISH:
+                    topic_length = struct.unpack('!H', body[:2])[0]
+                    topic = body[2:2 + topic_length]
+                    payload = body[2 + topic_length:]
+                    if flags & 0x06:
+                        connection.sendall(encode_packet(PUBACK, 0, payload[:2]))
+                        payload = payload[2:]
+                    self.messages.append((topic, payload, flags))
+                elif packet_type == PINGREQ:
+                    connection.sendall(encode_packet(PINGRESP, 0, ''))
+                elif packet_type == DISCONNECT:
+                    self.disconnected = True
+                    return
+        except IOError:
+            pass
+        finally:
+            connection.close()
+
+    def close(self):
+        self.closed.set()
+        self.server.close()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class MqttPublisherTestCase(TestCase):
+    def tearDown(self):
+        self.publisher.stop()
+        self.broker.close()
+
+    def test_publish(self):
+        self.broker = FakeBroker()
+        self.publisher = MqttPublisher.MqttPublisher('localhost', self.broker.port)
+        self.publisher.start()
+        self.publisher.publish_device_state('iPhone Bassie', {'distance': 1.5})
+        self.assertTrue(wait_for(lambda: self.broker.messages))
+        # retained, with QoS 1
+        self.assertEqual(self.broker.messages, [('icloudlocationfetcher/iphone_bassie/distance', '1.5', 0x03)])
+        self.assertTrue(wait_for(lambda: not self.publisher.in_flight))
+        self.assertEqual(self.publisher.connection.gettimeout(), 60)
+
+        self.publisher.stop()
+        self.assertTrue(wait_for(lambda: self.broker.disconnected))
+
+    def test_latest_message_per_topic(self):
+        self.broker = FakeBroker()
+        self.publisher = MqttPublisher.MqttPublisher('localhost', self.broker.port, qos=0)
+        self.publisher.publish('a', '1')
+        self.publisher.publish('b', '2')
+        self.publisher.publish('a', '3')
+        self.publisher.start()
+        self.assertTrue(wait_for(lambda: len(self.broker.messages) == 2))
+        self.assertEqual(self.broker.messages, [('b', '2', 0x01), ('a', '3', 0x01)])
+
+    def test_publish_does_not_end_backoff(self):
+        self.broker = FakeBroker(return_code=5)
+        self.publisher = MqttPublisher.MqttPublisher('localhost', self.broker.port)
+        self.publisher.start()
+        self.assertTrue(wait_for(lambda: self.broker.connections == 1))
+        for i in range(10):
+            self.publisher.publish('a', str(i))
+            time.sleep(0.02)
+        self.assertEqual(self.broker.connections, 1)
+
+        # the messages are sent when the broker accepts the connection again
+        self.broker.return_code = 0
+        self.assertTrue(wait_for(lambda: self.broker.messages))
+        self.assertEqual(self.broker.messages, [('a', '9', 0x03)])
+
+    def test_stalled_broker(self):
+        self.broker = FakeBroker(stalled=True)
+        self.publisher = MqttPublisher.MqttPublisher('localhost', self.broker.port, keepalive=1)
+        self.publisher.start()
+        # more than the socket buffers hold, so sending blocks until the timeout
+        for i in range(32):
+            self.publisher.publish('topic%d' % i, 'x' * 1024 * 1024)
+        # the send timed out, and the publisher reconnected
+        self.assertTrue(wait_for(lambda: self.broker.connections == 2))
@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+
+from unittest2 import TestCase
+
+from Outbox import Outbox
+
+UPDATE = {'device': 'a', 'distance_km': 1.5}
+NEWER_UPDATE = {'device': 'a', 'distance_km': 2.0}
+
+
+class OutboxTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'outbox')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_put_and_load(self):
+        outbox = Outbox(self.path)
+        self.assertEqual(outbox.get('sink'), {})
+        outbox.put('sink', 'a', UPDATE)
+        outbox.put('sink', 'a', NEWER_UPDATE)
+        outbox.put('other', 'b', UPDATE)
+        self.assertEqual(Outbox(self.path).get('sink'), {'a': NEWER_UPDATE})
+        self.assertEqual(Outbox(self.path).get('other'), {'b': UPDATE})
+        self.assertEqual(os.listdir(self.directory), ['outbox'])
+
+    def test_remove(self):
+        outbox = Outbox(self.path)
+        outbox.put('sink', 'a', NEWER_UPDATE)
+        # a newer update is kept
+        outbox.remove('sink', 'a', UPDATE)
+        self.assertEqual(Outbox(self.path).get('sink'), {'a': NEWER_UPDATE})
+        outbox.remove('sink', 'a')
+        self.assertEqual(Outbox(self.path).updates, {})
+
+    def test_unreadable(self):
+        with open(self.path, 'w') as output:
+            output.write('{"sink": ')
+        outbox = Outbox(self.path)
+        self.assertEqual(outbox.get('sink'), {})
+        outbox.put('sink', 'a', UPDATE)
+        self.assertEqual(Outbox(self.path).get('sink'), {'a': UPDATE})
@@ -0,0 +1,92 @@
+from unittest2 import TestCase
+
+import SendPolicy as send_policy_module
+from SendPolicy import SendPolicy
+
+
+class FakeTime(object):
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class FakeLocation(object):
+    def __init__(self, rounded_distance_km):
+        self.rounded_distance_km = rounded_distance_km
+
+    def is_home(self):
+        return self.rounded_distance_km == 0.0
+
+
+NOW = 1000000.0
+
+
+class SendPolicyTestCase(TestCase):
+    def setUp(self):
+        self.time = send_policy_module.time
+        send_policy_module.time = FakeTime(NOW)
+
+    def tearDown(self):
+        send_policy_module.time = self.time
+
+    def should_send(self, policy, sent_distance_km, distance_km, seconds_since_sent=3600, moving=True):
+        sent_location = FakeLocation(sent_distance_km) if sent_distance_km is not None else None
+        return policy.should_send(sent_location, FakeLocation(distance_km), NOW - seconds_since_sent, moving)
+
+    def test_first_distance(self):
+        policy = SendPolicy(min_distance_change_km=10.0, min_interval=600)
+        self.assertEqual(self.should_send(policy, None, 5.0, seconds_since_sent=0), (True, "first distance"))
+
+    def test_same_distance(self):
+        self.assertEqual(self.should_send(SendPolicy(), 5.0, 5.0), (False, "same distance"))
+        self.assertEqual(self.should_send(SendPolicy(), 0.0, 0.0, moving=False), (False, "same distance"))
+
+    def test_default_sends_every_change(self):
+        self.assertEqual(self.should_send(SendPolicy(), 5.0, 5.1, seconds_since_sent=0), (True, "changed 0.1 km"))
+
+    def test_km_deadband(self):
+        policy = SendPolicy(min_distance_change_km=1.0)
+        self.assertEqual(self.should_send(policy, 5.0, 5.5),
+                         (False, "changed 0.5 km, which is within 1.0 km"))
+        self.assertEqual(self.should_send(policy, 5.0, 6.0),
+                         (False, "changed 1.0 km, which is within 1.0 km"))
+        self.assertEqual(self.should_send(policy, 5.0, 6.1), (True, "changed 1.1 km"))
+        self.assertEqual(self.should_send(policy, 5.0, 3.9), (True, "changed 1.1 km"))
+
+    def test_percentage_deadband(self):
+        policy = SendPolicy(min_distance_change_km=1.0, min_distance_change_percentage=10)
+        # far away the percentage is larger than the km
+        self.assertEqual(self.should_send(policy, 50.0, 55.0),
+                         (False, "changed 5.0 km, which is within 5.0 km"))
+        self.assertEqual(self.should_send(policy, 50.0, 55.1), (True, "changed 5.1 km"))
+        # close to home the km is larger than the percentage
+        self.assertEqual(self.should_send(policy, 5.0, 5.9),
+                         (False, "changed 0.9 km, which is within 1.0 km"))
+        self.assertEqual(self.should_send(policy, 5.0, 6.1), (True, "changed 1.1 km"))
+
+    def test_min_interval(self):
+        policy = SendPolicy(min_interval=60)
+        self.assertEqual(self.should_send(policy, 5.0, 8.0, seconds_since_sent=59),
+                         (False, "sent 59 seconds ago"))
+        self.assertEqual(self.should_send(policy, 5.0, 8.0, seconds_since_sent=60), (True, "changed 3.0 km"))
+
+    def test_zone_change_is_always_sent(self):
+        policy = SendPolicy(min_distance_change_km=10.0, min_interval=600)
+        self.assertEqual(self.should_send(policy, 0.5, 0.0, seconds_since_sent=0), (True, "arrived home"))
+        self.assertEqual(self.should_send(policy, 0.0, 0.1, seconds_since_sent=0), (True, "left home"))
+
+    def test_stopped_moving(self):
+        policy = SendPolicy(min_distance_change_km=10.0, min_interval=60)
+        self.assertEqual(self.should_send(policy, 5.0, 5.2, moving=False), (True, "stopped moving"))
+        # the interval still applies
+        self.assertEqual(self.should_send(policy, 5.0, 5.2, seconds_since_sent=30, moving=False),
+                         (False, "sent 30 seconds ago"))
+        self.assertEqual(self.should_send(policy, 5.0, 5.2, moving=True),
+                         (False, "changed 0.2 km, which is within 10.0 km"))
+
+    def test_equality(self):
+        self.assertEqual(SendPolicy(min_interval=60), SendPolicy(min_interval=60))
+        self.assertNotEqual(SendPolicy(min_interval=60), SendPolicy(min_interval=30))
+        self.assertNotEqual(SendPolicy(), None)
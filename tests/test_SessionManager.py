@@ -0,0 +1,99 @@
+import threading
+
+from unittest2 import TestCase
+
+from SessionManager import SessionManager
+
+
+class FakeRequestsSession(object):
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeICloud(object):
+    def __init__(self, number):
+        self.number = number
+        self.session = FakeRequestsSession()
+
+
+class FakeLogin(object):
+    '''
+    Returns a new FakeICloud per login, or raises the next of the errors
+    '''
+
+    def __init__(self, *errors):
+        self.count = 0
+        self.errors = list(errors)
+        self.called = threading.Event()
+
+    def __call__(self):
+        self.called.set()
+        if self.errors:
+            raise self.errors.pop(0)
+        self.count += 1
+        return FakeICloud(self.count)
+
+
+class SessionManagerTestCase(TestCase):
+    def setUp(self):
+        self.login = FakeLogin()
+        self.session_manager = SessionManager(self.login)
+
+    def tearDown(self):
+        self.session_manager.stop()
+
+    def wait_for_rotation(self):
+        self.session_manager.worker.join(5)
+        self.assertFalse(self.session_manager.worker.is_alive())
+
+    def test_login_now(self):
+        self.assertIsNone(self.session_manager.get_session())
+        first = self.session_manager.login_now()
+        self.assertEqual(first.number, 1)
+        second = self.session_manager.login_now()
+        self.assertIs(self.session_manager.get_session(), second)
+        self.assertTrue(first.session.closed)
+        self.assertFalse(second.session.closed)
+
+    def test_rotate_and_swap(self):
+        first = self.session_manager.login_now()
+        self.assertEqual(self.session_manager.swap(), (False, None))
+        self.assertTrue(self.session_manager.rotate("test"))
+        self.assertTrue(self.session_manager.is_rotating())
+        # only one rotation at a time
+        self.assertFalse(self.session_manager.rotate("test"))
+        self.wait_for_rotation()
+        # the session is only replaced by swap
+        self.assertIs(self.session_manager.get_session(), first)
+
+        self.assertEqual(self.session_manager.swap(), (True, None))
+        self.assertEqual(self.session_manager.get_session().number, 2)
+        self.assertTrue(first.session.closed)
+        self.assertFalse(self.session_manager.is_rotating())
+
+    def test_failed_rotation(self):
+        first = self.session_manager.login_now()
+        error = ValueError("login failed")
+        self.login.errors.append(error)
+        self.session_manager.rotate("test")
+        self.wait_for_rotation()
+        self.assertEqual(self.session_manager.swap(), (False, error))
+        self.assertIs(self.session_manager.get_session(), first)
+        self.assertFalse(first.session.closed)
+        self.assertFalse(self.session_manager.is_rotating())
+
+    def test_delayed_rotation_stops(self):
+        self.session_manager.rotate("test", delay=60)
+        self.session_manager.stop()
+        self.wait_for_rotation()
+        self.assertFalse(self.login.called.is_set())
+
+    def test_discard(self):
+        first = self.session_manager.login_now()
+        self.session_manager.discard("expired")
+        self.assertIsNone(self.session_manager.get_session())
+        self.assertTrue(first.session.closed)
+        self.session_manager.discard("expired")
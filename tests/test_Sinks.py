@@ -0,0 +1,210 @@
+import BaseHTTPServer
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from unittest2 import TestCase
+
+import Sinks
+from Outbox import Outbox
+from Sinks import BACKPRESSURE_QUEUE, MAX_REJECTIONS, FileSink, HttpSink, LocationUpdate, Sink, fill_template
+
+
+def create_update(device='iPhone Bassie', distance_km=1.5):
+    return LocationUpdate(device, 52.0, 5.0, 10, 1000, distance_km, 1.0, 'not_home')
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class RecordingSink(Sink):
+    '''
+    Records the sent updates, and accepts them according to results, then always
+    '''
+
+    def __init__(self, name, results=(), **kwargs):
+        super(RecordingSink, self).__init__(name, **kwargs)
+        self.results = list(results)
+        self.sent = []
+
+    def send(self, update):
+        self.sent.append(update)
+        result = self.results.pop(0) if self.results else True
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class SinkTestCase(TestCase):
+    def setUp(self):
+        Sink.set_outbox(None)
+        self.min_retry_delay = Sinks.MIN_RETRY_DELAY_IN_S
+        Sinks.MIN_RETRY_DELAY_IN_S = 0.05
+
+    def tearDown(self):
+        Sinks.MIN_RETRY_DELAY_IN_S = self.min_retry_delay
+
+    def test_coalesce(self):
+        sink = RecordingSink('test')
+        first = create_update('a')
+        other = create_update('b')
+        latest = create_update('a', 2.0)
+        for update in first, other, latest:
+            sink.submit(update)
+        self.assertEqual(list(sink.pending.values()), [other, latest])
+
+    def test_queue_drops_oldest(self):
+        sink = RecordingSink('test', backpressure=BACKPRESSURE_QUEUE, queue_size=2)
+        updates = [create_update(distance_km=x) for x in range(3)]
+        for update in updates:
+            sink.submit(update)
+        self.assertEqual(list(sink.pending), updates[1:])
+
+    def test_accepts(self):
+        self.assertTrue(RecordingSink('test').accepts('a'))
+        self.assertTrue(RecordingSink('test', devices=['a']).accepts('a'))
+        self.assertFalse(RecordingSink('test', devices=['a']).accepts('b'))
+
+    def test_retry(self):
+        sink = RecordingSink('test', results=[False])
+        sink.start()
+        update = create_update()
+        sink.submit(update)
+        self.assertTrue(wait_for(lambda: len(sink.sent) == 2))
+        sink.stop()
+        self.assertEqual(sink.sent, [update, update])
+        self.assertEqual(sink.retry_delay, 0)
+
+    def test_rejected_update_is_dropped(self):
+        sink = RecordingSink('test', results=[False] * (MAX_REJECTIONS + 1))
+        sink.start()
+        sink.submit(create_update())
+        self.assertTrue(wait_for(lambda: len(sink.sent) == MAX_REJECTIONS))
+        time.sleep(0.3)
+        sink.stop()
+        self.assertEqual(len(sink.sent), MAX_REJECTIONS)
+        self.assertEqual(len(sink.pending), 0)
+
+    def test_queue_retries_in_order(self):
+        sink = RecordingSink('test', results=[IOError("unreachable")], backpressure=BACKPRESSURE_QUEUE)
+        updates = [create_update(distance_km=x) for x in range(2)]
+        for update in updates:
+            sink.submit(update)
+        sink.start()
+        self.assertTrue(wait_for(lambda: len(sink.sent) == 3))
+        sink.stop()
+        self.assertEqual(sink.sent, [updates[0]] + updates)
+
+    def test_queue_drops_failed_update_when_full(self):
+        sink = RecordingSink('test', backpressure=BACKPRESSURE_QUEUE, queue_size=1)
+        failed, pending = create_update(distance_km=1), create_update(distance_km=2)
+        sink.submit(pending)
+        sink.failed(failed)
+        self.assertEqual(list(sink.pending), [pending])
+
+    def test_fill_template(self):
+        update = create_update()
+        self.assertEqual(fill_template('__DEVICE__: __DISTANCE__ (__ZONE__)', update),
+                         'iPhone Bassie: 1.5 (not_home)')
+        self.assertEqual(fill_template('?device=__DEVICE__', update, quote=True), '?device=iPhone%20Bassie')
+
+
+class SinkOutboxTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'outbox')
+        Sink.set_outbox(Outbox(self.path))
+
+    def tearDown(self):
+        Sink.set_outbox(None)
+        shutil.rmtree(self.directory)
+
+    def test_submit_does_not_write(self):
+        sink = RecordingSink('test')
+        sink.submit(create_update())
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_failed_update_is_kept(self):
+        sink = RecordingSink('test', results=[IOError("unreachable")])
+        update = create_update()
+        sink.start()
+        sink.submit(update)
+        self.assertTrue(wait_for(lambda: sink.outbox.get('test')))
+        sink.stop()
+        self.assertEqual(Outbox(self.path).get('test'), {update.device: update.as_dict()})
+
+        # after a restart it is sent, and removed from the outbox
+        Sink.set_outbox(Outbox(self.path))
+        sink = RecordingSink('test')
+        sink.start()
+        self.assertTrue(wait_for(lambda: sink.sent))
+        sink.stop()
+        self.assertEqual(sink.sent[0].as_dict(), update.as_dict())
+        self.assertEqual(Outbox(self.path).get('test'), {})
+
+    def test_pending_update_is_kept_when_stopping(self):
+        sink = RecordingSink('test')
+        sink.retry_timestamp = time.time() + 60
+        sink.start()
+        update = create_update()
+        sink.submit(update)
+        sink.stop()
+        self.assertEqual(Outbox(self.path).get('test'), {update.device: update.as_dict()})
+
+
+class RecordingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        self.send_response(self.server.status_code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HttpSinkTestCase(TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('localhost', 0), RecordingHandler)
+        self.server.paths = []
+        self.server.status_code = 200
+        threading.Thread(target=self.server.serve_forever).start()
+        self.url = 'http://localhost:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_send(self):
+        sink = HttpSink('test', self.url + '/update?svalue=__DISTANCE__&device=__DEVICE__')
+        self.assertTrue(sink.send(create_update()))
+        self.assertEqual(self.server.paths, ['/update?svalue=1.5&device=iPhone%20Bassie'])
+
+        self.server.status_code = 500
+        self.assertFalse(sink.send(create_update()))
+        sink.close()
+
+
+class FileSinkTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_send(self):
+        path = os.path.join(self.directory, 'updates.jsonl')
+        sink = FileSink('test', path)
+        for distance_km in 1.5, 2.0:
+            self.assertTrue(sink.send(create_update(distance_km=distance_km)))
+        with open(path) as source:
+            lines = [json.loads(line) for line in source]
+        self.assertEqual([x['distance_km'] for x in lines], [1.5, 2.0])
+        self.assertEqual(lines[0]['device'], 'iPhone Bassie')
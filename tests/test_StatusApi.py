@@ -0,0 +1,91 @@
+import json
+import urllib2
+
+from unittest2 import TestCase
+
+from Location import Location
+from MonitorDevice import MonitorDevice
+from StatusApi import CONTENT_TYPE, StatusClient, start_status_server
+
+HOME = (52.0, 5.0)
+
+
+class StatusApiTestCase(TestCase):
+    def setUp(self):
+        Location.set_home_position(HOME)
+        self.monitor_device = MonitorDevice('iPhone Bassie', 'http://localhost/update?svalue=__DISTANCE__')
+        for timestamp, latitude in (1000, 52.1), (1060, 52.2):
+            location = Location(latitude, 5.0, 50, timestamp)
+            self.monitor_device.history.append(location)
+            self.monitor_device.location_stored = location
+        self.monitor_device.location_sent = self.monitor_device.location_stored
+        self.server = start_status_server([self.monitor_device, MonitorDevice('iPad', None)], 0)
+        self.url = 'http://localhost:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, path):
+        response = urllib2.urlopen(self.url + path)
+        self.assertEqual(response.info()['Content-Type'], CONTENT_TYPE)
+        return json.load(response)
+
+    def assertNotFound(self, path):
+        with self.assertRaises(urllib2.HTTPError) as context:
+            urllib2.urlopen(self.url + path)
+        self.assertEqual(context.exception.code, 404)
+
+    def test_devices(self):
+        devices = self.get('/devices')['devices']
+        self.assertEqual([x['name'] for x in devices], ['iPhone Bassie', 'iPad'])
+        self.assertIsNone(devices[1]['location'])
+        self.assertIsNone(devices[1]['fix_age_s'])
+
+    def test_device(self):
+        state = self.get('/devices/iPhone%20Bassie')
+        self.assertEqual(sorted(state), ['fix_age_s', 'found', 'location', 'moving', 'name', 'next_update_timestamp',
+                                         'sent_distance_km'])
+        self.assertEqual(state['name'], 'iPhone Bassie')
+        self.assertFalse(state['found'])
+        self.assertEqual(state['location'], {
+            'latitude': 52.2,
+            'longitude': 5.0,
+            'accuracy': 50,
+            'timestamp': 1060,
+            'distance_km': self.monitor_device.location_stored.rounded_distance_km,
+            'zone': 'not_home',
+        })
+        self.assertEqual(state['sent_distance_km'], state['location']['distance_km'])
+        self.assertGreater(state['fix_age_s'], 0)
+
+    def test_history(self):
+        history = self.get('/devices/iPhone%20Bassie/history')
+        self.assertEqual(history['name'], 'iPhone Bassie')
+        self.assertEqual([x['timestamp'] for x in history['history']], [1000, 1060])
+        self.assertEqual([x['latitude'] for x in history['history']], [52.1, 52.2])
+
+    def test_not_found(self):
+        self.assertNotFound('/')
+        self.assertNotFound('/other')
+        self.assertNotFound('/devices/unknown')
+        self.assertNotFound('/devices/iPad/other')
+        self.assertNotFound('/devices/iPad/history/more')
+
+    def test_client(self):
+        client = StatusClient(self.url)
+        # first the current location of each device
+        updates = client.new_updates()
+        self.assertEqual([(x.device, x.timestamp, x.old_distance_km) for x in updates],
+                         [('iPhone Bassie', 1060, -1.0)])
+        self.assertEqual(client.new_updates(), [])
+
+        # then the locations stored since, also those in between
+        for timestamp, latitude in (1120, 52.3), (1180, 52.4):
+            location = Location(latitude, 5.0, 50, timestamp)
+            self.monitor_device.history.append(location)
+            self.monitor_device.location_stored = location
+        updates = client.new_updates()
+        self.assertEqual([(x.timestamp, x.latitude) for x in updates], [(1120, 52.3), (1180, 52.4)])
+        self.assertEqual(updates[1].old_distance_km, updates[0].distance_km)
+        self.assertEqual(updates[1].as_dict()['zone'], 'not_home')
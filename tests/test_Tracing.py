@@ -0,0 +1,119 @@
+import json
+import logging
+import threading
+
+from unittest2 import TestCase
+
+import Tracing
+from Tracing import SUMMARY_INTERVAL_IN_CYCLES, Tracer
+
+
+class FakeTime(object):
+    '''
+    A clock which only moves when told to
+    '''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TracerTestCase(TestCase):
+    def setUp(self):
+        self.time = Tracing.time
+        Tracing.time = FakeTime()
+        self.handler = RecordingHandler()
+        self.logger_level = Tracing.logger.level
+        Tracing.logger.addHandler(self.handler)
+        Tracing.logger.setLevel(logging.DEBUG)
+        self.tracer = Tracer()
+
+    def tearDown(self):
+        Tracing.time = self.time
+        Tracing.logger.removeHandler(self.handler)
+        Tracing.logger.setLevel(self.logger_level)
+
+    def trace_cycle(self):
+        self.tracer.start_cycle()
+        with self.tracer.span('monitor_device'):
+            Tracing.time.sleep(1)
+            with self.tracer.span('refresh_client'):
+                Tracing.time.sleep(2)
+                self.tracer.record('http', 1.5)
+            with self.tracer.span('sink'):
+                Tracing.time.sleep(0.5)
+        self.tracer.end_cycle()
+
+    def test_nesting(self):
+        self.trace_cycle()
+        spans = dict((span.name, span) for span in self.tracer.spans)
+        self.assertEqual(sorted(spans), ['http', 'monitor_device', 'refresh_client', 'sink'])
+        self.assertIsNone(spans['monitor_device'].parent)
+        self.assertIs(spans['refresh_client'].parent, spans['monitor_device'])
+        self.assertIs(spans['http'].parent, spans['refresh_client'])
+        self.assertIs(spans['sink'].parent, spans['monitor_device'])
+        self.assertEqual([spans[x].depth for x in 'monitor_device', 'refresh_client', 'http', 'sink'], [0, 1, 2, 1])
+
+    def test_durations(self):
+        self.trace_cycle()
+        spans = dict((span.name, span) for span in self.tracer.spans)
+        self.assertEqual(spans['monitor_device'].duration, 3.5)
+        self.assertEqual(spans['monitor_device'].self_duration(), 1.0)
+        self.assertEqual(spans['refresh_client'].duration, 2.0)
+        self.assertEqual(spans['refresh_client'].self_duration(), 0.5)
+        self.assertEqual(spans['http'].duration, 1.5)
+        self.assertEqual(spans['http'].start_timestamp, 1001.5)
+        self.assertEqual(spans['sink'].duration, 0.5)
+
+    def test_cycle_trace(self):
+        self.trace_cycle()
+        self.assertEqual(len(self.handler.messages), 1)
+        prefix = "Cycle trace: "
+        self.assertTrue(self.handler.messages[0].startswith(prefix))
+        record = json.loads(self.handler.messages[0][len(prefix):])
+        self.assertEqual(record['cycle'], 1)
+        self.assertEqual(record['duration'], 3.5)
+        # ordered by start
+        self.assertEqual([x['name'] for x in record['spans']], ['monitor_device', 'refresh_client', 'http', 'sink'])
+        self.assertEqual(record['spans'][1], {'name': 'refresh_client', 'depth': 1, 'start': 1.0, 'duration': 2.0,
+                                              'self': 0.5})
+
+    def test_summary(self):
+        for _ in range(SUMMARY_INTERVAL_IN_CYCLES):
+            self.trace_cycle()
+        self.assertEqual(len(self.handler.messages), SUMMARY_INTERVAL_IN_CYCLES + 1)
+        self.assertEqual(self.handler.messages[-1],
+                         "Cycle timings of the last %d cycles: %s" % (SUMMARY_INTERVAL_IN_CYCLES,
+                                                                      self.tracer.get_summary()))
+        self.assertIn("sink: n=100, mean=0.500s, p95=0.500s, max=0.500s", self.tracer.get_summary())
+
+    def test_ignored_spans(self):
+        # outside of a cycle
+        with self.tracer.span('sink') as span:
+            self.assertIsNone(span)
+        self.tracer.record('http', 1)
+        self.assertEqual(self.tracer.spans, [])
+
+        # on another thread than the cycle
+        self.tracer.start_cycle()
+        thread = threading.Thread(target=self.tracer.record, args=('http', 1))
+        thread.start()
+        thread.join()
+        with self.tracer.span('sink'):
+            pass
+        self.tracer.end_cycle()
+        self.assertEqual([x.name for x in self.tracer.spans], ['sink'])
@@ -0,0 +1,199 @@
+import BaseHTTPServer
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from unittest2 import TestCase
+
+import iCloudLocationFetcher
+from iCloudLocationFetcher import reload_config
+from Location import Location
+from MonitorDevice import MonitorDevice
+from SendPolicy import SendPolicy
+from Sinks import Sink
+from pyicloud.ratelimit import RateLimiter
+
+APPLE_ID = 'reload@example.com'
+RATE_LIMITS = {'refreshClient': (10, 60)}
+
+CONFIG = '''[GENERAL]
+home_location = %(home_location)s
+devices_to_monitor =
+    %(devices)s
+icloud_rate_limits = %(rate_limits)s
+send_min_distance_change_km = 1.0
+'''
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class UrlHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeAppleDevice(object):
+    def __init__(self, name):
+        self.name = name
+        self.stable_key = 'key of %s' % name
+
+    def __str__(self):
+        return self.name
+
+
+class FakeDevices(object):
+    def __init__(self, *names):
+        self.devices = dict((name, FakeAppleDevice(name)) for name in names)
+
+    def get_by_stable_key(self, stable_key):
+        return None
+
+    def get_by_name(self, name):
+        return self.devices.get(name)
+
+
+class ReloadConfigTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        self.home = os.environ.get('HOME')
+        # the configuration file is read from the current and home directories
+        os.chdir(self.directory)
+        os.environ['HOME'] = self.directory
+
+        self.server = BaseHTTPServer.HTTPServer(('localhost', 0), UrlHandler)
+        self.server.paths = []
+        threading.Thread(target=self.server.serve_forever).start()
+        self.url = 'http://localhost:%d' % self.server.server_address[1]
+
+        self.handler = RecordingHandler()
+        iCloudLocationFetcher.logger = logging.getLogger('locations2domoticz.test')
+        iCloudLocationFetcher.logger.addHandler(self.handler)
+        MonitorDevice.set_logger(iCloudLocationFetcher.logger)
+        Sink.set_outbox(None)
+        self.home_position = Location.home_position
+        Location.set_home_position([52.0, 5.0])
+
+        self.monitor_devices = []
+        self.rate_limits = self.reload(devices=['a', 'b'])
+
+    def tearDown(self):
+        for monitor_device in self.monitor_devices:
+            monitor_device.unregister()
+        iCloudLocationFetcher.logger.removeHandler(self.handler)
+        MonitorDevice.set_send_to_server(True)
+        MonitorDevice.set_smooth_locations(True)
+        Location.set_home_position(self.home_position)
+        self.server.shutdown()
+        self.server.server_close()
+        os.chdir(self.cwd)
+        if self.home is not None:
+            os.environ['HOME'] = self.home
+        shutil.rmtree(self.directory)
+
+    def write_config(self, devices, home_location='52.0, 5.0', rate_limits='refreshClient:10/60', extra=''):
+        urls = ['%s,%s/%s?distance=__DISTANCE__' % (x, self.url, x) if ',' not in x else x for x in devices]
+        with open(os.path.join(self.directory, 'iCloudLocationFetcher.conf'), 'w') as target:
+            target.write(CONFIG % {'home_location': home_location, 'devices': '\n    '.join(urls),
+                                   'rate_limits': rate_limits} + extra)
+
+    def reload(self, icloud_devices=None, **kwargs):
+        self.write_config(**kwargs)
+        return reload_config(self.monitor_devices, icloud_devices, APPLE_ID, RATE_LIMITS)
+
+    def get_device(self, name):
+        return [x for x in self.monitor_devices if x.name == name][0]
+
+    def store_location(self, name, location):
+        monitor_device = self.get_device(name)
+        monitor_device.location_stored = location
+        monitor_device.location_sent = location
+
+    def test_add_device(self):
+        self.reload(FakeDevices('a', 'c'), devices=['a', 'b', 'c'])
+        self.assertEqual([x.name for x in self.monitor_devices], ['a', 'b', 'c'])
+        new_device = self.get_device('c')
+        self.assertEqual(new_device.get_apple_device_key(), 'key of c')
+        self.assertEqual(new_device.send_policy, SendPolicy(min_distance_change_km=1.0))
+        self.assertTrue(new_device.update_url_sink.thread.is_alive())
+        # the devices which were monitored already are left alone
+        self.assertIsNone(self.get_device('a').get_apple_device())
+
+    def test_remove_device(self):
+        removed_device = self.get_device('b')
+        self.reload(devices=['a'])
+        self.assertEqual([x.name for x in self.monitor_devices], ['a'])
+        self.assertFalse(removed_device.update_url_sink.thread.is_alive())
+
+    def test_change_url_and_send_policy(self):
+        self.store_location('a', Location(52.0, 5.015, 10, time.time()))
+        self.reload(devices=['a,%s/new?distance=__DISTANCE__' % self.url, 'b'],
+                    extra='[device:a]\nsend_min_distance_change_km = 5.0\n')
+        monitor_device = self.get_device('a')
+        self.assertEqual(monitor_device.update_url, '%s/new?distance=__DISTANCE__' % self.url)
+        self.assertEqual(monitor_device.send_policy, SendPolicy(min_distance_change_km=5.0))
+        self.assertEqual(self.get_device('b').send_policy, SendPolicy(min_distance_change_km=1.0))
+        # the new url receives the current distance
+        self.assertTrue(wait_for(lambda: self.server.paths))
+        self.assertEqual(self.server.paths, ['/new?distance=1.0'])
+
+    def test_change_home(self):
+        self.store_location('a', Location(52.0, 5.015, 10, time.time()))
+        self.reload(devices=['a', 'b'], home_location='52.0, 5.045')
+        self.assertEqual(Location.home_position, [52.0, 5.045])
+        self.assertEqual(self.get_device('a').location_sent.rounded_distance_km, 2.0)
+        self.assertTrue(wait_for(lambda: self.server.paths))
+        self.assertEqual(self.server.paths, ['/a?distance=2.0'])
+
+        # the distance did not change, so nothing is sent
+        self.store_location('a', Location(52.0, 5.045, 10, time.time()))
+        self.server.paths = []
+        self.reload(devices=['a', 'b'], home_location='52.0, 5.0451')
+        time.sleep(0.2)
+        self.assertEqual(self.server.paths, [])
+
+    def test_change_rate_limits(self):
+        rate_limits = self.reload(devices=['a', 'b'], rate_limits='refreshClient:5/60, login:2/600')
+        self.assertEqual(rate_limits, {'refreshClient': (5, 60), 'login': (2, 600)})
+        bucket = RateLimiter.for_account(APPLE_ID)._bucket('refreshClient')
+        self.assertEqual(bucket.capacity, 5)
+
+    def test_invalid_config(self):
+        self.store_location('a', Location(52.0, 5.015, 10, time.time()))
+        rate_limits = self.reload(devices=['a'], home_location='north pole', rate_limits='refreshClient:1/60')
+        self.assertIs(rate_limits, RATE_LIMITS)
+        self.assertEqual([x.name for x in self.monitor_devices], ['a', 'b'])
+        self.assertEqual(Location.home_position, [52.0, 5.0])
+        self.assertEqual(RateLimiter.for_account(APPLE_ID)._bucket('refreshClient').capacity, 10)
+        errors = [x.getMessage() for x in self.handler.records if x.levelno == logging.ERROR]
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith("Invalid configuration, keeping the current configuration"))
+
+    def test_missing_config(self):
+        os.remove(os.path.join(self.directory, 'iCloudLocationFetcher.conf'))
+        self.assertIs(reload_config(self.monitor_devices, None, APPLE_ID, RATE_LIMITS), RATE_LIMITS)
+        self.assertEqual([x.name for x in self.monitor_devices], ['a', 'b'])
+        self.assertEqual(self.handler.records[-1].levelno, logging.ERROR)
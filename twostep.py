@@ -42,5 +42,6 @@ if api.requires_2sa:
 
 # provide some information on the devices
 devices = api.devices
+devices.refresh_client(locate=None)
 for i, device in enumerate(devices):
     print("%s: type: %s, name: %s, location enabled: %s" % (i, device.content['deviceDisplayName'], device.content['name'], str(device.content['locationEnabled'])))